@@ -1,69 +1,5259 @@
 # Скрипт для бэкапов (ark от англ. - ковчег)
 
-from typing import Callable
+from typing import BinaryIO, Callable, Iterable, Iterator
 from types import FrameType
 from enum import Enum
+import concurrent.futures
+import collections
+import ctypes.util
+import contextlib
+import subprocess
+import threading
+import functools
+import itertools
 import argparse
+import tempfile
+import hashlib
+import marshal
+import tarfile
+import fnmatch
+import sqlite3
+import select
+import shutil
 import signal
+import struct
+import bisect
+import random
+import errno
+import heapq
+import queue
+import json
+import gzip
+import copy
+import lzma
+import stat
+import time
+import bz2
 import sys
+import io
 import os
+import re
+
+class Constants(Enum):
+    """
+    Константы уровня приложения
+    """
+
+    BLOCK_SIZE = 1024 * 1024 # Размер блока, которым читаются файлы источника (байт)
+    QUEUE_SIZE = 64 # Сколько блоков может ждать записи в очереди одного приемника
+    SCAN_THREADS = 8 # Сколько потоков обходят дерево источника (для сетевых дисков можно больше)
+    TMP_SUFFIX = ".ark-tmp" # Суффикс недописанных файлов (переименовываются после записи)
+    META_DIR = ".ark" # Служебная папка в корне каждого приемника (индекс и прочее)
+    HASH = "sha256" # Алгоритм хеширования содержимого файлов
+    VERIFY_THREADS = 8 # Сколько потоков считают хеши в режиме --verify
+    CHECKPOINT = 256 * 1024 * 1024 # Через сколько байт недописанный файл отмечается в журнале (с этого места продолжится прерванный бэкап)
+    DELTA_MIN = 64 # С какого размера (МиБ) файлы в режиме --delta обновляются поблочно
+    WATCH_DELAY = 2 # Сколько секунд изменения должны затихнуть, чтобы режим --watch их забэкапил
+    RESCAN = 60 # Раз в сколько минут режим --watch все равно проходит всё дерево
+    RESTORE_THREADS = 8 # Сколько файлов восстанавливается параллельно
+    SLOWEST = 10 # Сколько самых долгих файлов каждого приемника попадает в отчет (--stats-json)
+    INDEX_MEMORY = 200000 # Сколько путей индекс приемника держит в памяти (больший уходит во временную базу на диске)
+    LAG = 1 # На сколько секунд работы приемник может отстать (в его очереди), прежде чем он дочитывает файлы из источника сам, не держа остальных
+    PIPELINE_MIN = 64 # С какого размера (МиБ) файлы читаются конвейером: наперед, в заранее выделенные буферы, мимо кеша страниц
+    GIT_CHAIN = 30 # Сколько бандлов набирается у git-репозитория в режиме --git, прежде чем он бандлится заново целиком
 
 class App:
     """Основной класс приложения"""
 
-    @classmethod
-    def _args_parse(cls) -> argparse.Namespace:
-        parser = argparse.ArgumentParser()
+    @classmethod
+    def _args_parse(cls) -> argparse.Namespace:
+        parser = argparse.ArgumentParser()
+
+        script_name = os.path.basename(__file__)
+        
+        usage = \
+f"""
+ark - hard drive backuper
+
+Usage examples:
+    Backup files/folders (src) to multiple destinations:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ...
+
+    Every source file is read once and written to all destinations in parallel,
+    each source ends up as dstN/<source name>
+
+    Incremental backup (copy only new/changed files, delete removed ones):
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --incremental
+
+    Backup into deduplicating repositories (every run adds a snapshot):
+        {script_name} --src src1 src2 ... --dst repo1 repo2 ... --format repo
+
+    Dated snapshots (unchanged files are hard links to the previous snapshot), keep last 30:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --snapshots --keep 30
+
+    Backup into compressed tar archives (dstN/<time>.tar.gz, compressed on all cores):
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --format archive --compress gz|bz2|xz
+
+    Interrupted backup (Ctrl+C, kill, crash) continues from where it stopped, just run it again
+
+    Rewrite only changed blocks of big files (disk images, databases), files from 64 MiB:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --incremental --delta --delta-min 64
+
+    Store files smaller than 64 KiB inside pack files of the mirror (fast for millions of tiny files):
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --incremental --pack-small 64
+
+    Back up git repositories as chains of incremental bundles (only refs changed since the last run)
+    instead of .git files, working trees without changes are not copied at all (restore rebuilds them):
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --incremental --git
+
+    A destination that falls behind (slow or shared disk) doesn't hold the others back: it reads
+    the files it missed from the source by itself, write speed caps in MiB/s (one for all or one per --dst, 0 - none):
+        {script_name} --src src1 src2 ... --dst nvme usb nfs --incremental --bwlimit 0 30 10
+
+    Keep running and back up changed paths as they change (Linux inotify), full rescan every 60 minutes:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --watch [--watch-delay 2] [--rescan 60]
+
+    Restore paths or glob patterns (everything if none) from one destination into a directory,
+    paths inside start with the source name; --snapshot picks a snapshot/archive by name prefix (last by default):
+        {script_name} restore --backup dst1 --to dir [path|pattern ...] [--snapshots] [--snapshot 2024-05-01]
+        {script_name} restore --backup dst1 --to dir 'src1/docs' 'src1/**.conf' [--format repo|archive] [--threads 8]
+
+    Progress line while backuping, timings per phase and destination (what was the bottleneck) in the end,
+    the same as a JSON report:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --stats-json report.json
+
+    Benchmark on a reproducible synthetic tree (full, no-change, 1% churn backups and restore),
+    save the numbers and compare the next run against them:
+        {script_name} bench [--format mirror repo archive] [--scale 1.0] [--seed 1] [--runs 3] [--dir tmp] [--keep]
+        {script_name} bench --json before.json
+        {script_name} bench --baseline before.json
+
+    Verify that destinations hold the same data as sources (same --format/--snapshots as the backup),
+    hashes are cached in ~/.cache/ark, --no-cache rereads everything:
+        {script_name} --src src1 src2 ... --dst dst1 dst2 ... --verify [--verify-threads 8] [--no-cache]
+"""
+
+        def custom_print_help():
+            ColorPrinter.blue(usage)
+
+        def custom_error(message):
+            custom_print_help()
+            ColorPrinter.red(f"{message}")
+            sys.exit(1)
+
+        parser.print_help = custom_print_help
+        parser.error = custom_error
+
+        # без подкоманды - бэкап (или его проверка), тогда --src и --dst обязательны
+        parser.add_argument('--src', nargs='+')
+        parser.add_argument('--dst', nargs='+')
+        parser.add_argument('--incremental', action='store_true')
+        parser.add_argument('--snapshots', action='store_true')
+        parser.add_argument('--keep', type=int, default=0)
+        parser.add_argument('--format', choices=[f.value for f in Format], default=Format.MIRROR.value)
+        parser.add_argument('--compress', choices=list(ParallelCompressor.CODECS), default="gz")
+        parser.add_argument('--scan-threads', type=int, default=Constants.SCAN_THREADS.value)
+        parser.add_argument('--delta', action='store_true')
+        parser.add_argument('--delta-min', type=int, default=Constants.DELTA_MIN.value)
+        parser.add_argument('--pack-small', type=int, default=0)
+        parser.add_argument('--git', action='store_true')
+        parser.add_argument('--bwlimit', nargs='+', type=float)
+        parser.add_argument('--stats-json')
+        parser.add_argument('--watch', action='store_true')
+        parser.add_argument('--watch-delay', type=float, default=Constants.WATCH_DELAY.value)
+        parser.add_argument('--rescan', type=float, default=Constants.RESCAN.value)
+        parser.add_argument('--verify', action='store_true')
+        parser.add_argument('--verify-threads', type=int, default=Constants.VERIFY_THREADS.value)
+        parser.add_argument('--no-cache', action='store_true')
+
+        action_subparsers = parser.add_subparsers(dest='action')
+
+        # Парсер для восстановления
+        restore_parser = action_subparsers.add_parser('restore',)
+        restore_parser.print_help = custom_print_help
+        restore_parser.error = custom_error
+        restore_parser.add_argument('--backup', required=True)
+        restore_parser.add_argument('--to', required=True)
+        restore_parser.add_argument('paths', nargs='*')
+        restore_parser.add_argument('--format', choices=[f.value for f in Format], default=Format.MIRROR.value)
+        restore_parser.add_argument('--snapshots', action='store_true')
+        restore_parser.add_argument('--snapshot')
+        restore_parser.add_argument('--threads', type=int, default=Constants.RESTORE_THREADS.value)
+
+        # Парсер для замеров
+        bench_parser = action_subparsers.add_parser('bench',)
+        bench_parser.print_help = custom_print_help
+        bench_parser.error = custom_error
+        bench_parser.add_argument('--format', nargs='+', choices=[f.value for f in Format], default=[Format.MIRROR.value])
+        bench_parser.add_argument('--scale', type=float, default=1.0)
+        bench_parser.add_argument('--seed', type=int, default=1)
+        bench_parser.add_argument('--runs', type=int, default=1)
+        bench_parser.add_argument('--dir')
+        bench_parser.add_argument('--keep', action='store_true')
+        bench_parser.add_argument('--json')
+        bench_parser.add_argument('--baseline')
+
+        args = parser.parse_args()
+        if args.action is None and not (args.src and args.dst):
+            parser.error("the following arguments are required: --src, --dst")
+        return args
+
+    @classmethod
+    def main(cls) -> None:
+        job = None
+
+        def on_exit():
+            # первый сигнал останавливает бэкап так, чтобы следующий запуск продолжил с того же места,
+            # второй - выходит сразу
+            if job is None or job.stopping:
+                ColorPrinter.red("\nhandle exit signal")
+                sys.exit(1)
+            ColorPrinter.red("\nhandle exit signal, saving progress (repeat to exit right away)...")
+            job.stop()
+
+        SignalHandler(on_exit)
+        args = cls._args_parse()
+        action = {'restore': "restoring", 'bench': "benchmarking"}.get(args.action) \
+            or ("verifying" if args.verify else "backuping")
+        try:
+            if args.action == 'bench':
+                Bench(
+                    args.dir,
+                    formats=[Format(f) for f in args.format],
+                    seed=args.seed,
+                    scale=args.scale,
+                    runs=args.runs,
+                    keep=args.keep,).run(args.baseline, args.json)
+                return
+
+            if args.action == 'restore':
+                job = Restore(
+                    args.backup, args.to, args.paths,
+                    fmt=Format(args.format),
+                    snapshots=args.snapshots,
+                    name=args.snapshot,
+                    threads=args.threads,)
+                job.run()
+                return
+
+            if args.verify:
+                Verifier(
+                    args.src, args.dst,
+                    snapshots=args.snapshots,
+                    fmt=Format(args.format),
+                    threads=args.verify_threads,
+                    cache=not args.no_cache,
+                    scan_threads=args.scan_threads,
+                    git=args.git,).run()
+                return
+
+            make_backup = functools.partial(
+                Backup,
+                args.src, args.dst,
+                incremental=args.incremental or args.watch,
+                snapshots=args.snapshots,
+                keep=args.keep,
+                fmt=Format(args.format),
+                compress=args.compress,
+                scan_threads=args.scan_threads,
+                delta_min=args.delta_min * 1024 * 1024 if args.delta else None,
+                pack_below=args.pack_small * 1024,
+                git=args.git,
+                limits=[limit * 1024 * 1024 for limit in args.bwlimit or []],
+                stats_json=args.stats_json,)
+            if args.watch:
+                if Format(args.format) is Format.ARCHIVE:
+                    raise RuntimeError("archives are always full, --watch needs another --format")
+                job = Watcher(make_backup, args.src, args.dst, args.watch_delay, args.rescan * 60)
+            else:
+                job = make_backup()
+            job.run()
+        except Exception as e:
+            ColorPrinter.red(f"{action} error: {str(e).rstrip()}")
+        finally:
+            ColorPrinter.blue("\nsee you later!")
+
+# backup
+
+class Format(Enum):
+    """Формат приемника"""
+
+    MIRROR = "mirror" # обычное дерево файлов
+    REPO = "repo" # хранилище кусков с дедупликацией и снимками
+    ARCHIVE = "archive" # сжатый tar, каждый проход - новый архив
+
+class Op(Enum):
+    """Команды, которые читатель отправляет писателям приемников"""
+
+    DIR = 1
+    SYMLINK = 2
+    OPEN = 3
+    DATA = 4
+    CHUNK = 5
+    CLOSE = 6
+    ABORT = 7
+    COPY = 8
+    KEEP = 9
+    META = 10
+    PRUNE = 11
+    STOP = 12
+    SUSPEND = 13
+    HOLE = 14
+    FETCH = 15
+
+class Entry:
+    """Элемент дерева источника (файл, папка или симлинк)"""
+
+    __slots__ = ("path", "rel", "st") # элементов в очередях и пулах много, словарь атрибутов у каждого ни к чему
+
+    def __init__(self, path: str, rel: str, st: os.stat_result) -> None:
+        self.path = path # абсолютный путь в источнике
+        self.rel = rel # путь относительно приемника (всегда через '/')
+        self.st = st
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.st.st_mode)
+
+    @property
+    def is_file(self) -> bool:
+        return stat.S_ISREG(self.st.st_mode)
+
+    @property
+    def is_symlink(self) -> bool:
+        return stat.S_ISLNK(self.st.st_mode)
+
+class Interrupted(Exception):
+    """Бэкап остановлен по сигналу (см. Backup.stop)"""
+
+class ScanError:
+    """Путь источника, который не удалось прочитать при обходе"""
+
+    def __init__(self, path: str, rel: str, error: Exception) -> None:
+        self.path = path
+        self.rel = rel
+        self.error = error
+
+class Scanner:
+    """
+    **Параллельный обход дерева источника**
+
+    Папки обходятся пулом потоков через os.scandir. У каждого потока своя очередь папок:
+    свои он берет с конца (обход в глубину, очередь не разрастается), а когда они кончились -
+    ворует самые старые (верхние, то есть самые большие поддеревья) у соседей.
+    stat берется из DirEntry и повторно не делается
+
+    Найденное отдается пачками через ограниченную очередь, поэтому копирование начинается
+    сразу, а память не зависит от размера дерева: если копирование не успевает, обход ждет
+
+    С repos git-репозитории отдаются бандлами (см. GitBundles): .git не обходится,
+    а рабочее дерево без изменений - вовсе
+    """
+
+    BATCH = 256 # сколько элементов отдается за раз
+    QUEUE_SIZE = 64 # сколько пачек может ждать копирования
+
+    def __init__(self, threads: int, excluded: set[str], repos: "GitBundles | None" = None) -> None:
+        self.threads = max(1, threads)
+        self.excluded = excluded # эти пути (папки приемников) не обходятся
+        self.repos = repos
+
+    def scan(self, src: str, top: str) -> Iterator[Entry | ScanError]:
+        """Обходит источник src, пути элементов начинаются с top. Симлинки не разыменовываются"""
+
+        try:
+            root = Entry(src, top, os.lstat(src))
+        except OSError as e:
+            yield ScanError(src, top, e)
+            return
+        yield root
+        if not root.is_dir:
+            return
+
+        self._out: queue.Queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._dirs = [collections.deque() for _ in range(self.threads)]
+        self._dirs[0].append((src, top))
+        self._pending = 1 # папки, которые ждут обхода или обходятся прямо сейчас
+        self._alive = self.threads
+        self._stop = False
+        self._cond = threading.Condition()
+
+        for i in range(self.threads):
+            threading.Thread(target=self._work, args=(i,), name=f"ark-scan-{i}", daemon=True).start()
+
+        try:
+            while (batch := self._out.get()) is not None:
+                yield from batch
+        finally:
+            # потребитель мог бросить обход на середине - отпускаем потоки, застрявшие на полной очереди
+            with self._cond:
+                if self._alive:
+                    self._stop = True
+                    self._cond.notify_all()
+                else:
+                    return
+            while self._out.get() is not None:
+                pass
+
+    def _work(self, i: int) -> None:
+        try:
+            while (item := self._take(i)) is not None:
+                try:
+                    self._scan_dir(i, *item)
+                finally:
+                    with self._cond:
+                        self._pending -= 1
+                        if self._pending == 0:
+                            self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._alive -= 1
+                last = self._alive == 0
+            if last:
+                self._out.put(None)
+
+    def _take(self, i: int) -> tuple[str, str] | None:
+        """Следующая папка для потока i или None, если обход закончен"""
+
+        while True:
+            try:
+                return self._dirs[i].pop()
+            except IndexError:
+                pass
+
+            for j in range(1, self.threads):
+                try:
+                    return self._dirs[(i + j) % self.threads].popleft()
+                except IndexError:
+                    pass
+
+            with self._cond:
+                if self._pending == 0 or self._stop:
+                    return None
+                # работа появится либо у соседей, либо никогда (тогда разбудит последний)
+                self._cond.wait(0.01)
+
+    def _scan_dir(self, i: int, path: str, rel: str) -> None:
+        batch: list[Entry | ScanError] = []
+        skipped = None # .git репозитория, вместо которого отданы бандлы
+        if self.repos is not None:
+            try:
+                found = self.repos.backup(path, rel)
+            except (OSError, RuntimeError) as e:
+                # репозиторий, с которым не справился git, копируется как обычная папка
+                found = None
+                batch.append(ScanError(path, rel, e))
+            if found is not None:
+                entries, tree = found
+                batch.extend(entries)
+                if not tree:
+                    self._out.put(batch)
+                    return
+                skipped = os.path.join(path, GitBundles.GIT)
+
+        try:
+            with os.scandir(path) as it:
+                for child in it:
+                    if self._stop:
+                        return
+                    if child.path in self.excluded or child.path == skipped:
+                        continue
+
+                    child_rel = f"{rel}/{child.name}"
+                    try:
+                        entry = Entry(child.path, child_rel, child.stat(follow_symlinks=False))
+                    except OSError as e:
+                        batch.append(ScanError(child.path, child_rel, e))
+                        continue
+
+                    batch.append(entry)
+                    if entry.is_dir:
+                        with self._cond:
+                            self._pending += 1
+                        self._dirs[i].append((entry.path, child_rel))
+                    if len(batch) >= self.BATCH:
+                        self._out.put(batch)
+                        batch = []
+        except OSError as e:
+            batch.append(ScanError(path, rel, e))
+
+        if batch:
+            self._out.put(batch)
+
+class GitBundles:
+    """
+    **git-репозитории источника - цепочками бандлов (--git)**
+
+    Вместо тысяч мелких файлов .git (которые к тому же переписываются при каждой упаковке)
+    репозиторий хранится в приемнике папкой DIR: бандлы (git bundle) и файл состояния.
+    Первый бандл - весь репозиторий, каждый следующий - только ссылки, изменившиеся
+    с прошлого прохода, и объекты, которых нет в предыдущих. Бандлы собираются в кеше
+    (path) и уходят в приемники обычными файлами: неизменившиеся пропускаются как любые
+    другие, а новому приемнику достается вся цепочка. Через Constants.GIT_CHAIN бандлов
+    (и когда история переписана так, что старых объектов уже нет) цепочка начинается заново
+
+    Рабочее дерево без изменений (git status пуст, игнорируемые файлы тоже считаются)
+    не копируется вовсе - restore() достанет его из бандлов. Иначе оно копируется как обычно,
+    без .git. Деревья с подмодулями обходятся всегда: подмодули - отдельные репозитории.
+    Из служебного в бэкап попадают объекты, ссылки, HEAD и config (хуков и reflog там нет)
+
+    Формат файла состояния - текст: заголовок, затем
+    head<TAB>ref: ветка или хеш (пусто у репозитория без коммитов)
+    tree<TAB>clean, dirty или bare
+    bundles<TAB>сколько бандлов в цепочке
+    и по строке на ссылку: хеш<TAB>имя
+    """
+
+    HEADER = "ark-git 1"
+    DIR = ".ark-git" # папка репозитория в приемнике
+    GIT = ".git"
+    STATE = "state"
+    CONFIG = "config"
+
+    def __init__(self, path: str, update: bool = True) -> None:
+        """path - кеш бандлов, без update бандлы не собираются (для --verify)"""
+
+        self.path = path
+        self.update = update
+
+    @classmethod
+    def default_path(cls) -> str:
+        return os.path.join(os.path.dirname(HashCache.default_path()), "git")
+
+    @classmethod
+    def kind(cls, path: str) -> str | None:
+        """'tree' для рабочего дерева, 'bare' для голого репозитория, None - если path не репозиторий"""
+
+        if os.path.lexists(os.path.join(path, cls.GIT)):
+            return "tree"
+        if os.path.isfile(os.path.join(path, "HEAD")) \
+                and os.path.isdir(os.path.join(path, "objects")) and os.path.isdir(os.path.join(path, "refs")):
+            return "bare"
+        return None
+
+    @classmethod
+    def outermost(cls, src: str, rel: str) -> str | None:
+        """Путь (как rel) самого внешнего репозитория, внутри которого лежит rel источника src"""
+
+        parts = rel.split("/")
+        for i in range(2, len(parts) + 1):
+            path = os.path.join(src, *parts[1:i])
+            if os.path.isdir(path) and not os.path.islink(path) and cls.kind(path):
+                return "/".join(parts[:i])
+        return None
+
+    def backup(self, path: str, rel: str) -> tuple[list[Entry], bool] | None:
+        """
+        **Бандлит репозиторий в папке path источника, если она репозиторий**
+
+        Возвращает элементы папки DIR (пути внутри rel) и нужно ли обходить рабочее дерево.
+        Вызывается из потоков обхода, у каждого репозитория свой кеш
+        """
+
+        kind = self.kind(path)
+        if kind is None:
+            return None
+
+        refs = {}
+        for line in self._git(path, "for-each-ref", "--format=%(objectname) %(refname)").splitlines():
+            sha, ref = line.split(" ", 1)
+            refs[ref] = sha
+        symbolic = self._git(path, "symbolic-ref", "-q", "HEAD", ok=(0, 1)).strip()
+        head = self._git(path, "rev-parse", "-q", "--verify", "HEAD", ok=(0, 1)).strip()
+        if head:
+            refs["HEAD"] = head # отсоединенный HEAD может не быть ни в одной ветке
+        if kind == "bare":
+            tree = "bare"
+        elif os.path.lexists(os.path.join(path, ".gitmodules")):
+            tree = "dirty"
+        else:
+            status = self._git(path, "status", "--porcelain", "--ignored")
+            tree = "dirty" if status else "clean"
+
+        store = os.path.join(self.path, hashlib.sha1(os.fsencode(os.path.realpath(path))).hexdigest())
+        old = self._load(store)
+        if self.update:
+            os.makedirs(store, exist_ok=True)
+            bundles = old[2] if old is not None else 0
+            changed = [ref for ref, sha in refs.items() if old is None or old[3].get(ref) != sha]
+            if old is not None and changed and bundles < Constants.GIT_CHAIN.value:
+                try:
+                    bundles += self._bundle(path, store, bundles + 1, changed, set(old[3].values()))
+                except RuntimeError:
+                    old = None # прежних объектов нет (история переписана) - цепочка начинается заново
+            if old is None or changed and bundles >= Constants.GIT_CHAIN.value:
+                for name in os.listdir(store):
+                    if name != self.STATE:
+                        os.remove(os.path.join(store, name))
+                bundles = self._bundle(path, store, 1, list(refs), set()) if refs else 0
+
+            lines = [self.HEADER, f"head\t{'ref: ' + symbolic if symbolic else head}", f"tree\t{tree}", f"bundles\t{bundles}"]
+            lines.extend(f"{sha}\t{ref}" for ref, sha in sorted(refs.items()))
+            self._write_state(store, "\n".join(lines) + "\n")
+        elif old is None:
+            return [], True # бандлов еще не было - проверять нечего, кроме рабочего дерева
+
+        base = f"{rel}/{self.DIR}"
+        entries = [Entry(store, base, os.lstat(store))]
+        for name in sorted(os.listdir(store)):
+            if name.endswith(".bundle") or name == self.STATE:
+                entries.append(Entry(os.path.join(store, name), f"{base}/{name}", os.lstat(os.path.join(store, name))))
+        config = os.path.join(self._git(path, "rev-parse", "--absolute-git-dir").strip(), self.CONFIG)
+        with contextlib.suppress(FileNotFoundError):
+            entries.append(Entry(config, f"{base}/{self.CONFIG}", os.lstat(config)))
+        return entries, tree == "dirty"
+
+    @classmethod
+    def restore(cls, path: str) -> None:
+        """
+        **Пересобирает репозиторий в папке path из восстановленной в нее папки DIR**
+
+        Объекты распаковываются из всех бандлов по порядку, ссылки и HEAD ставятся как в файле
+        состояния. Чистое рабочее дерево достается из HEAD, а скопированное остается как есть
+        (индекс строится заново). Папка DIR после этого удаляется
+        """
+
+        store = os.path.join(path, cls.DIR)
+        state = cls._load(store)
+        if state is None:
+            raise RuntimeError(f"no git bundles in '{store}'")
+        head, tree, bundles, refs = state
+
+        cls._git(path, "init", "-q", *(["--bare"] if tree == "bare" else []))
+        gitdir = cls._git(path, "rev-parse", "--absolute-git-dir").strip()
+        with contextlib.suppress(FileNotFoundError):
+            shutil.copyfile(os.path.join(store, cls.CONFIG), os.path.join(gitdir, cls.CONFIG))
+        for n in range(1, bundles + 1):
+            cls._git(path, "bundle", "unbundle", os.path.join(store, cls._name(n)))
+        updates = "".join(f"update {ref} {sha}\n" for ref, sha in refs.items() if ref != "HEAD")
+        if updates:
+            cls._git(path, "update-ref", "--stdin", stdin=updates)
+        if head.startswith("ref: "):
+            cls._git(path, "symbolic-ref", "HEAD", head[5:])
+        elif head:
+            cls._git(path, "update-ref", "--no-deref", "HEAD", head)
+        if head and tree != "bare":
+            cls._git(path, "reset", "-q", *(["--hard"] if tree == "clean" else []))
+        shutil.rmtree(store)
+
+    def _bundle(self, path: str, store: str, n: int, refs: list[str], basis: set[str]) -> int:
+        """Бандл номер n со ссылками refs без объектов из basis, возвращает сколько бандлов добавилось"""
+
+        bundle = os.path.join(store, self._name(n))
+        tmp = bundle + Constants.TMP_SUFFIX.value
+        revs = "".join(f"{ref}\n" for ref in refs) + "".join(f"^{sha}\n" for sha in sorted(basis))
+        try:
+            self._git(path, "bundle", "create", "-q", tmp, "--stdin", stdin=revs)
+        except RuntimeError as e:
+            if "empty bundle" in str(e):
+                return 0 # ссылки переставлены на уже сохраненные объекты - хватит файла состояния
+            raise
+        os.replace(tmp, bundle)
+        return 1
+
+    def _write_state(self, store: str, text: str) -> None:
+        """Неизменившееся состояние не переписывается - приемники его пропустят"""
+
+        path = os.path.join(store, self.STATE)
+        with contextlib.suppress(FileNotFoundError):
+            with open(path, encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+                if f.read() == text:
+                    return
+        tmp = path + Constants.TMP_SUFFIX.value
+        with open(tmp, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    @classmethod
+    def _load(cls, store: str) -> tuple[str, str, int, dict[str, str]] | None:
+        """head, tree, сколько бандлов и ссылки из файла состояния или None, если его нет (или он битый)"""
+
+        try:
+            with open(os.path.join(store, cls.STATE), encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+                if f.readline().rstrip("\n") != cls.HEADER:
+                    raise ValueError("unknown format")
+                fields = dict(f.readline().rstrip("\n").split("\t", 1) for _ in range(3))
+                refs = {}
+                for line in f:
+                    sha, ref = line.rstrip("\n").split("\t", 1)
+                    refs[ref] = sha
+            return fields["head"], fields["tree"], int(fields["bundles"]), refs
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            ColorPrinter.red(f"ignoring broken git bundles state in '{store}': {e}")
+            return None
+
+    @classmethod
+    def _name(cls, n: int) -> str:
+        return f"{n:06d}.bundle"
+
+    @classmethod
+    def _git(cls, path: str, *args: str, ok: tuple[int, ...] = (0,), stdin: str | None = None) -> str:
+        # GIT_OPTIONAL_LOCKS=0 - git status не переписывает индекс источника
+        env = {**os.environ, "GIT_OPTIONAL_LOCKS": "0", "LC_ALL": "C"}
+        try:
+            result = subprocess.run(
+                ["git", "-C", path, *args],
+                input=stdin.encode("utf-8", "surrogateescape") if stdin is not None else None,
+                capture_output=True, env=env)
+        except OSError as e:
+            raise RuntimeError(f"git is not available: {e}")
+        if result.returncode not in ok:
+            error = result.stderr.decode("utf-8", "replace").strip()
+            raise RuntimeError(f"git {args[0]} failed: {error}")
+        return result.stdout.decode("utf-8", "surrogateescape")
+
+class Backup:
+    """
+    **Копирует источники во все приемники за один проход**
+
+    Каждый файл источника читается ровно один раз, а прочитанные блоки
+    раздаются писателям (по одному потоку на приемник) через ограниченные очереди
+
+    В инкрементальном режиме файл отправляется только тем приемникам,
+    в индексе которых он отсутствует или отличается, а удаленные из источника пути удаляются.
+    Хранилища (Format.REPO) и снимки-папки всегда работают так: новый снимок строится от предыдущего.
+    Архивы (Format.ARCHIVE) всегда полные: tar-поток собирается и сжимается здесь же,
+    один раз на все приемники, а писатели только пишут готовые сжатые блоки
+
+    С delta_min большие файлы в зеркалах обновляются поблочно (см. Signature),
+    а с pack_below мелкие файлы зеркал складываются в паки (см. PackFiles).
+    С git репозитории источников бэкапятся цепочками бандлов (см. GitBundles)
+
+    Медленный приемник не держит остальных: отставшие дочитывают файлы из источника
+    сами (см. DestinationWriter), а limits ограничивают скорость записи в приемники
+
+    Прерванный бэкап (stop() или падение) продолжается следующим запуском с тем же
+    приемником: каждый писатель ведет журнал сделанного (см. Manifest), так что готовые
+    файлы пропускаются, а недописанные большие файлы дописываются с места остановки
+
+    Время прохода раскладывается по фазам: читатель считает обход (scan), чтение (read),
+    хеши, куски и подписи (hash), сжатие архива (compress), а писатели - свою работу,
+    простой и сколько читатель простоял на их полной очереди. Пока идет бэкап, выводится
+    строка прогресса (см. Progress), в конце - сводка и узкое место (см. report())
+    """
+
+    def __init__(
+        self,
+        sources: list[str],
+        destinations: list[str],
+        incremental: bool = False,
+        snapshots: bool = False,
+        keep: int = 0,
+        fmt: Format = Format.MIRROR,
+        compress: str = "gz",
+        scan_threads: int = Constants.SCAN_THREADS.value,
+        delta_min: int | None = None,
+        pack_below: int = 0,
+        git: bool = False,
+        limits: list[float] | None = None,
+        stats_json: str | None = None,
+        block_size: int = Constants.BLOCK_SIZE.value,
+        queue_size: int = Constants.QUEUE_SIZE.value,
+    ) -> None:
+        """
+        limits - ограничения скорости записи (байт в секунду, 0 - без ограничения): по одному
+        на приемник или одно на все. stats_json - куда записать отчет о проходе (см. report())
+        """
+
+        self.sources = [os.path.abspath(s) for s in sources]
+        self.destinations = [os.path.abspath(d) for d in destinations]
+        if snapshots and fmt is not Format.MIRROR:
+            raise RuntimeError(f"--snapshots works only with --format {Format.MIRROR.value}")
+        if delta_min is not None and fmt is not Format.MIRROR:
+            raise RuntimeError(f"--delta works only with --format {Format.MIRROR.value}")
+        if pack_below and (fmt is not Format.MIRROR or snapshots):
+            raise RuntimeError(f"--pack-small works only with --format {Format.MIRROR.value} without --snapshots")
+        if block_size % Signature.BLOCK:
+            raise RuntimeError(f"block size must be a multiple of {Signature.BLOCK}")
+        if git and shutil.which("git") is None:
+            raise RuntimeError("--git needs git in PATH")
+        limits = limits or [0]
+        if len(limits) not in (1, len(self.destinations)):
+            raise RuntimeError("--bwlimit needs one value or one per --dst")
+
+        self.incremental = incremental or snapshots or fmt is Format.REPO
+        self.snapshots = snapshots
+        self.keep = keep
+        self.fmt = fmt
+        self.compress = compress
+        self.scan_threads = scan_threads
+        self.delta_min = delta_min
+        self.pack_below = pack_below
+        self.repos = GitBundles(GitBundles.default_path()) if git else None
+        self.limits = limits * len(self.destinations) if len(limits) == 1 else limits
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.stats_json = stats_json
+        self.errors: list[str] = []
+
+        self.scanned = 0 # элементов источника
+        self.bytes_read = 0
+        self.timings: collections.Counter = collections.Counter() # фаза читателя -> секунды
+        self._started = time.monotonic()
+        self._last_tick = (self._started, 0, {}) # время, прочитано, скопировано приемниками - для скорости в прогрессе
+
+        # пути, которые не удалось прочитать: их (и все внутри) нельзя считать удаленными
+        self._unreadable: set[str] = set()
+        self._tar: TarStream | None = None
+        self._writers: list[DestinationWriter] = []
+        self._stop = threading.Event()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def stop(self) -> None:
+        """
+        Просит бэкап остановиться как можно скорее, сохранив сделанное для следующего запуска.
+        Можно звать из обработчика сигнала
+        """
+
+        self._stop.set()
+        for w in self._writers:
+            w.stopping.set()
+
+    def run(self, changes: dict[str, bool] | None = None, after: "Backup | None" = None) -> None:
+        """
+        **Запускает бэкап**
+
+        Ошибки отдельных файлов не прерывают работу, а собираются и выводятся в конце.
+        Если хоть что-то не скопировалось (или бэкап остановили) инициирует RuntimeError
+
+        changes - бэкапить только эти пути (см. Watcher): путь -> вместе ли со всем содержимым.
+        Остальное в приемниках остается как было. after - прошлый благополучный проход тех же
+        приемников: тогда их индексы не читаются заново, а переходят от его писателей (см. successor)
+        """
+
+        tops = set()
+        for src in self.sources:
+            if not os.path.lexists(src):
+                raise RuntimeError(f"source not found: {src}")
+            top = self._top_name(src)
+            if top in tops:
+                raise RuntimeError(f"several sources are named '{top}'")
+            tops.add(top)
+
+        if changes is not None and self.repos is not None:
+            changes = self._widen(changes)
+
+        self._started = time.monotonic()
+        self._last_tick = (self._started, 0, {})
+        previous = after._writers if after is not None and changes is not None else []
+        writers = self._writers = self._make_writers(previous)
+        for w in writers:
+            w.start()
+
+        # папки приемников (и кеш бандлов) внутри источника не бэкапятся
+        excluded = set(self.destinations) | ({self.repos.path} if self.repos is not None else set())
+        scanner = Scanner(self.scan_threads, excluded, self.repos)
+        with Progress(self._tick):
+            try:
+                for src in self.sources:
+                    top = self._top_name(src)
+                    if changes is None:
+                        ColorPrinter.blue(f"backuping '{src}'...")
+                        items = scanner.scan(src, top)
+                    else:
+                        items = self._changed(scanner, src, top, changes)
+                    items = iter(items)
+                    t = time.perf_counter()
+                    while batch := list(itertools.islice(items, Scanner.BATCH)):
+                        self._time("scan", t)
+                        if self.incremental:
+                            # записи индексов для всей пачки - одним запросом (см. RecordIndex)
+                            rels = [item.rel for item in batch]
+                            for w in writers:
+                                w.manifest.old.prefetch(rels)
+                        for item in batch:
+                            self._check_stop()
+                            self.scanned += 1
+                            if isinstance(item, ScanError):
+                                self._fail(item.path, item.rel, item.error)
+                            else:
+                                self._process(item, writers)
+                        t = time.perf_counter()
+                if self._tar is not None:
+                    self._compress(self._tar.close)
+                for w in writers:
+                    w.put(Op.PRUNE, frozenset(tops), frozenset(self._unreadable), self.incremental, changes)
+            except Interrupted:
+                pass # писатели без PRUNE только сбросят журналы
+            finally:
+                for w in writers:
+                    w.finish()
+
+        report = self.report()
+        for w, r in zip(writers, report["destinations"]):
+            methods = ", ".join(f"{m}: {n}" for m, n in w.methods.most_common())
+            ColorPrinter.green(
+                f"'{w.root}': {w.files} files copied ({Humanize.size(w.bytes)}), "
+                f"{w.kept} unchanged, {w.deleted} deleted" + (f" [{methods}]" if methods else ""))
+            if w.deleted_snapshots:
+                ColorPrinter.green(f"'{w.root}': {w.deleted_snapshots} old snapshots removed")
+            ColorPrinter.blue(
+                f"'{w.root}': {Humanize.size(r['bytes_per_s'])}/s, {r['files_per_s']:.0f} files/s, "
+                f"write {r['seconds']['write']:.1f}s, idle {r['seconds']['idle']:.1f}s, "
+                f"reader waited {r['seconds']['wait']:.1f}s, queue avg {r['queue']['avg']:.1f} max {r['queue']['max']}"
+                + (f", throttled {r['seconds']['throttle']:.1f}s" if w.limit else "")
+                + (f", {w.fetched} files read by itself, done at {r['finished']:.1f}s" if w.fetched else ""))
+            self.errors.extend(f"'{w.root}': {e}" for e in w.errors)
+
+        phases = ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in report["source"]["seconds"].items())
+        ColorPrinter.blue(
+            f"source: {self.scanned} scanned, {Humanize.size(self.bytes_read)} read ({phases}), "
+            f"total {report['elapsed']:.1f}s")
+        if report["bottleneck"]:
+            ColorPrinter.blue(f"bottleneck: {report['bottleneck']['what']} ({report['bottleneck']['share']:.0%} of the time)")
+
+        if self.stats_json:
+            report["status"] = "interrupted" if self.stopping else "errors" if self.errors else "ok"
+            report["errors"] = len(self.errors)
+            with open(self.stats_json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+        if self.errors:
+            for e in self.errors:
+                ColorPrinter.red(e)
+        if self.stopping:
+            raise RuntimeError("backup is interrupted, run the same command again to continue")
+        if self.errors:
+            raise RuntimeError(f"{len(self.errors)} errors while backuping")
+
+    def report(self) -> dict:
+        """
+        **Отчет о проходе (он же --stats-json)**
+
+        Секунды по фазам у источника и у каждого приемника, скорости, глубина очередей,
+        самые долгие файлы. bottleneck - на что ушла самая большая доля времени прохода:
+        чтение или обход источника, хеши (процессор), сжатие или конкретный приемник
+        (читатель стоял на его полной очереди)
+        """
+
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        # остальное время читатель сам работал: открывал файлы, разбирал пути, раздавал команды
+        other = max(elapsed - sum(self.timings.values()) - sum(w.waited for w in self._writers), 0.0)
+        report = {
+            "elapsed": round(elapsed, 3),
+            "source": {
+                "scanned": self.scanned,
+                "bytes_read": self.bytes_read,
+                "bytes_per_s": round(self.bytes_read / elapsed),
+                "seconds": {
+                    **{phase: round(seconds, 3) for phase, seconds in self.timings.most_common()},
+                    "other": round(other, 3)},
+            },
+            "destinations": [w.report(self._started, elapsed) for w in self._writers],
+        }
+
+        candidates = {
+            "reading the source": self.timings["read"],
+            "scanning the source": self.timings["scan"],
+            "cpu (hashing)": self.timings["hash"],
+            "cpu (compression)": self.timings["compress"],
+            "cpu (per-file work in the reader)": other,
+        }
+        for w in self._writers:
+            candidates[f"destination '{w.root}'"] = w.waited
+        what, seconds = max(candidates.items(), key=lambda item: item[1])
+        report["bottleneck"] = {"what": what, "share": round(seconds / elapsed, 3)} if seconds else None
+        return report
+
+    def _tick(self) -> str:
+        """Снимает глубину очередей и возвращает строку прогресса (см. Progress)"""
+
+        now = time.monotonic()
+        then, read_then, copied_then = self._last_tick
+        span = max(now - then, 1e-9)
+        self._last_tick = (now, self.bytes_read, {w.root: w.bytes for w in self._writers})
+
+        parts = [
+            f"{self.scanned} scanned, read {Humanize.size(self.bytes_read)} "
+            f"{Humanize.size((self.bytes_read - read_then) / span)}/s"]
+        for w in self._writers:
+            depth = w.sample_queue()
+            rate = (w.bytes - copied_then.get(w.root, 0)) / span
+            parts.append(
+                f"{os.path.basename(w.root)} {w.files} files {Humanize.size(rate)}/s q {depth}/{w.queue.maxsize}")
+        return " | ".join(parts)
+
+    def _time(self, phase: str, since: float) -> float:
+        """Добавляет к фазе время с момента since, возвращает текущий момент"""
+
+        now = time.perf_counter()
+        self.timings[phase] += now - since
+        return now
+
+    def _compress(self, func: Callable, *args) -> None:
+        """
+        Сжатие идет в пуле, а здесь - ожидание его результатов (это время сжатия). Готовые блоки
+        уходят писателям тут же, но ожидание их очередей уже посчитано у приемников
+        """
+
+        waited = sum(w.waited for w in self._writers)
+        t = time.perf_counter()
+        func(*args)
+        self.timings["compress"] += time.perf_counter() - t - (sum(w.waited for w in self._writers) - waited)
+
+    def _make_writers(self, previous: list["DestinationWriter"]) -> list["DestinationWriter"]:
+        """previous - писатели прошлого прохода, если их состояние можно продолжить"""
+
+        writers = [w.successor() for w in previous]
+        if not writers or None in writers:
+            writers = self._create_writers()
+        for w, limit in zip(writers, self.limits):
+            w.limit = limit
+        return writers
+
+    def _create_writers(self) -> list["DestinationWriter"]:
+        if self.fmt is Format.REPO:
+            return [RepoWriter(d, self.queue_size) for d in self.destinations]
+        if self.fmt is Format.MIRROR and self.snapshots:
+            return [SnapshotWriter(d, self.queue_size, self.keep, self.delta_min) for d in self.destinations]
+        if self.fmt is Format.MIRROR:
+            return [
+                MirrorWriter(d, self.queue_size, delta_min=self.delta_min, pack_below=self.pack_below)
+                for d in self.destinations]
+
+        name = Stamp.unique(self.destinations[0], f".tar.{self.compress}")
+        writers = [ArchiveWriter(d, self.queue_size, name) for d in self.destinations]
+
+        def sink(blob: bytes) -> None:
+            for w in writers:
+                w.put(Op.DATA, blob)
+
+        self._tar = TarStream(self.compress, sink)
+        return writers
+
+    def _changed(self, scanner: Scanner, src: str, top: str, changes: dict[str, bool]) -> Iterator[Entry | ScanError]:
+        """Изменившиеся пути источника. Пропавшие пути не отдаются - их удалит PRUNE"""
+
+        rels = sorted(rel for rel in changes if rel.split("/")[0] == top)
+        if rels:
+            ColorPrinter.blue(f"backuping {len(rels)} changed paths of '{src}'...")
+        for rel in rels:
+            if Watcher.inside(changes, rel):
+                continue # уже обходится вместе с папкой
+            path = os.path.join(src, *rel.split("/")[1:])
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                yield ScanError(path, rel, e)
+                continue
+            if changes[rel] and stat.S_ISDIR(st.st_mode):
+                yield from scanner.scan(path, rel)
+            else:
+                yield Entry(path, rel, st)
+
+    def _widen(self, changes: dict[str, bool]) -> dict[str, bool]:
+        """Изменения внутри git-репозиториев - это изменения всего репозитория: он бандлится заново"""
+
+        sources = {self._top_name(src): src for src in self.sources}
+        widened: dict[str, bool] = {}
+        for rel, recursive in changes.items():
+            src = sources.get(rel.split("/")[0])
+            repo = GitBundles.outermost(src, rel) if src is not None else None
+            if repo is not None:
+                widened[repo] = True
+            else:
+                widened[rel] = widened.get(rel, False) or recursive
+        return widened
+
+    def _process(self, entry: Entry, writers: list["DestinationWriter"]) -> None:
+        """Раздает элемент источника писателям, которым он нужен"""
+
+        if entry.is_dir:
+            if self._tar is not None:
+                self._tar.add(entry)
+            for w in writers:
+                self._send(w, Op.DIR, entry)
+            return
+
+        if not (entry.is_symlink or entry.is_file):
+            # сокеты, fifo, устройства - в бэкапе им делать нечего
+            self._fail(entry.path, entry.rel, "unsupported file type, skipped")
+            return
+
+        targets = []
+        for w in writers:
+            # сделанное прерванным проходом не повторяется даже в полном режиме
+            resumed = entry.rel in w.manifest.journaled
+            change, old = w.manifest.change(entry) if self.incremental or resumed else (Change.DATA, None)
+            if change is Change.SAME:
+                self._send(w, Op.KEEP, entry, old)
+            elif change is Change.META:
+                self._send(w, Op.META, entry, old)
+            else:
+                targets.append(w)
+
+        if not targets:
+            return
+
+        if entry.is_symlink:
+            try:
+                link = os.readlink(entry.path)
+            except OSError as e:
+                self._fail(entry.path, entry.rel, e)
+                for w in targets:
+                    self._send(w, Op.KEEP, entry)
+                return
+            if self._tar is not None:
+                self._tar.add(entry, link)
+            for w in targets:
+                self._send(w, Op.SYMLINK, entry, link)
+        else:
+            self._copy_file(entry, targets)
+
+    def _copy_file(self, entry: Entry, writers: list["DestinationWriter"]) -> None:
+        """
+        **Читает файл один раз и раздает его блоки всем писателям**
+
+        bytes неизменяемы, поэтому один и тот же блок безопасно лежит сразу во всех очередях.
+        Большие файлы читаются наперед отдельным потоком, мимо кеша страниц (см. Pipeline).
+        Хеш содержимого считается по ходу чтения и уходит в индексы приемников.
+        Для хранилищ файл режется на куски (и хешируется каждый кусок) тоже здесь, один раз на все
+
+        Писатели, которые могут скопировать файл сами средствами ядра (см. FastCopy) не нарушая
+        правило одного чтения, получают только команду COPY: файл нужен им одним, или его удалось
+        склонировать reflink'ом, не читая (см. DestinationWriter.clone)
+
+        Подписи блоков для поблочного обновления (см. Signature) тоже считаются здесь, один раз на все зеркала
+
+        Если все зеркала уже дописали часть файла прерванным проходом, чтение начинается с этого места.
+        Хеш содержимого у такого файла остается пустым - начало файла не читалось
+
+        Отстающим приемникам (см. DestinationWriter.lagging) файл не раздается - они прочитают его сами,
+        а те, что отстали посреди файла, дальше дочитывают его сами
+
+        У разреженных файлов (см. Sparse) читаются только куски с данными, а вместо дыр зеркала
+        получают команду HOLE и сами оставляют в копии дыру. Хеш у них тоже остается пустым
+        """
+
+        writers = [w for w in writers if not self._divert(w, Op.FETCH, entry)]
+        alone = len(writers) == 1
+        copiers = [w for w in writers if w.wants_copy(entry, alone)]
+        for w in copiers:
+            w.put(Op.COPY, entry)
+
+        writers = [w for w in writers if w not in copiers]
+        cloned = [w for w in writers if w.clone(entry)]
+        for w in cloned:
+            w.put(Op.COPY, entry, True)
+
+        writers = [w for w in writers if w not in cloned]
+        if not writers:
+            return
+
+        try:
+            f = open(entry.path, "rb")
+        except OSError as e:
+            self._fail(entry.path, entry.rel, e)
+            for w in writers:
+                self._send(w, Op.KEEP, entry)
+            return
+
+        start = 0
+        if self.fmt is Format.MIRROR:
+            start = min(w.resume_offset(entry) for w in writers)
+        sign = self.delta_min is not None and entry.st.st_size >= self.delta_min
+        sparse = self.fmt is Format.MIRROR and not sign and Sparse.is_sparse(entry.st)
+        digest = hashlib.new(Constants.HASH.value) if not start and not sparse else None
+
+        with f:
+            for w in writers:
+                w.put(Op.OPEN, entry, start)
+            try:
+                if self.fmt is Format.REPO:
+                    pos = 0
+                    t = time.perf_counter()
+                    for chunk in Chunker.split(f, self.block_size):
+                        t = self._time("read", t) # вместе с поиском границ кусков
+                        self._check_stop()
+                        self.bytes_read += len(chunk)
+                        if not (writers := self._detach(writers, entry, pos, digest)):
+                            return
+                        digest.update(chunk)
+                        chunk_id = hashlib.sha256(chunk).digest()
+                        self._time("hash", t)
+                        for w in writers:
+                            w.put(Op.CHUNK, chunk_id, chunk)
+                        pos += len(chunk)
+                        t = time.perf_counter()
+                elif self._tar is not None:
+                    self._tar.add(entry)
+                    t = time.perf_counter()
+                    for block in Pipeline.blocks(f, self.block_size):
+                        t = self._time("read", t)
+                        self._check_stop()
+                        self.bytes_read += len(block)
+                        digest.update(block)
+                        self._time("hash", t)
+                        self._compress(self._tar.write, block)
+                        t = time.perf_counter()
+                elif sparse:
+                    self._copy_sparse(f.fileno(), start, writers)
+                else:
+                    pos = f.seek(start)
+                    t = time.perf_counter()
+                    for block in Pipeline.blocks(f, self.block_size):
+                        t = self._time("read", t)
+                        self._check_stop()
+                        self.bytes_read += len(block)
+                        if not (writers := self._detach(writers, entry, pos, digest)):
+                            return
+                        pos += len(block)
+                        if digest is not None:
+                            digest.update(block)
+                        sigs = Signature.of(block) if sign else None
+                        self._time("hash", t)
+                        for w in writers:
+                            w.put(Op.DATA, block, sigs)
+                        t = time.perf_counter()
+            except Interrupted:
+                for w in writers:
+                    w.put(Op.SUSPEND)
+                raise
+            except OSError as e:
+                self._fail(entry.path, entry.rel, e)
+                if self._tar is not None:
+                    self._tar.end_file()
+                for w in writers:
+                    w.put(Op.ABORT)
+                return
+
+        if self._tar is not None and not self._tar.end_file():
+            self._fail(entry.path, entry.rel, "file changed while archiving, archived copy is inconsistent")
+        for w in writers:
+            w.put(Op.CLOSE, digest.hexdigest() if digest is not None else "")
+
+    def _send(self, w: "DestinationWriter", op: Op, *args) -> None:
+        if not self._divert(w, op, *args):
+            w.put(op, *args)
+
+    def _divert(self, w: "DestinationWriter", op: Op, *args) -> bool:
+        """Откладывает команду отстающему приемнику (см. DestinationWriter.defer), если из-за него простаивают другие"""
+
+        if not w.deferring() and (not w.lagging() or not any(v.starving() for v in self._writers if v is not w)):
+            return False
+        w.defer(op, *args)
+        return True
+
+    def _detach(
+        self,
+        writers: list["DestinationWriter"],
+        entry: Entry,
+        offset: int,
+        digest: "hashlib._Hash | None",
+    ) -> list["DestinationWriter"]:
+        """
+        Приемники, которым дальше раздаются блоки файла. Те, что отстали, пока остальные
+        простаивают, дочитывают файл с места offset сами (см. DestinationWriter.detach)
+        """
+
+        if len(self._writers) < 2:
+            return writers
+        streaming = []
+        for w in writers:
+            if w.lagging() and any(v.starving() for v in self._writers if v is not w):
+                w.detach(entry, offset, digest.copy() if digest is not None else None)
+            else:
+                streaming.append(w)
+        return streaming
+
+    def _copy_sparse(self, fd: int, start: int, writers: list["DestinationWriter"]) -> None:
+        """Раздает только куски с данными, дыры между ними (и в конце) уходят командой HOLE"""
+
+        pos = start
+        for data, hole in Sparse.extents(fd, start):
+            if data > pos:
+                for w in writers:
+                    w.put(Op.HOLE, data - pos)
+            pos = data
+            while pos < hole:
+                self._check_stop()
+                t = time.perf_counter()
+                block = os.pread(fd, min(self.block_size, hole - pos), pos)
+                self._time("read", t)
+                if not block:
+                    break
+                self.bytes_read += len(block)
+                for w in writers:
+                    w.put(Op.DATA, block, None)
+                pos += len(block)
+
+        size = os.fstat(fd).st_size
+        if size > pos:
+            for w in writers:
+                w.put(Op.HOLE, size - pos)
+
+    def _check_stop(self) -> None:
+        if self._stop.is_set():
+            raise Interrupted()
+
+    def _fail(self, path: str, rel: str, error: Exception | str) -> None:
+        self.errors.append(f"{path}: {error}")
+        self._unreadable.add(rel)
+
+    @classmethod
+    def _top_name(cls, src: str) -> str:
+        """Имя, под которым источник лежит в приемнике"""
+
+        return os.path.basename(src.rstrip(os.sep)) or src
+
+class DestinationWriter(threading.Thread):
+    """
+    **Поток записи в один приемник**
+
+    Команды приходят через ограниченную очередь, поэтому читатель не может
+    убежать вперед больше чем на queue_size блоков, а память не растет.
+    Общая часть для всех форматов приемника: индекс, подсчеты, обработка ошибок
+
+    Приемник, который отстал (см. lagging), пока другие простаивают, не держит их: читатель
+    перестает слать ему блоки и откладывает команды (см. defer, detach), а файлы писатель
+    потом дочитывает из источника сам, когда разберет очередь. Сколько блоков в очереди - это
+    уже отставание, считается по замеренному времени записи блока: у медленного приемника
+    меньше. С limit запись не быстрее limit байт в секунду
+
+    Индекс сохраняется только если проход дошел до конца (пришел PRUNE),
+    иначе сбрасывается журнал - по нему следующий запуск продолжит с того же места.
+    У писателей с batches итог прохода только по изменениям (см. Watcher) тоже остается
+    в журнале, а загруженное состояние приемника переходит писателю следующего такого
+    прохода (см. successor) - так проход стоит пропорционально изменениям, а не дереву
+    """
+
+    BACKLOG = 10000 # сколько команд можно отложить отстающему приемнику (дальше читатель ждет)
+    MIN_INFLIGHT = 4 # меньше стольких блоков в очереди приемник отстающим не считается
+    STREAM = (Op.DATA, Op.HOLE, Op.CHUNK) # блоки файла, который сейчас пишется
+    fetches = True # может ли писатель сам читать файлы источника
+    batches = False # может ли проход по изменениям обойтись журналом вместо сохранения индекса
+
+    def __init__(self, root: str, queue_size: int, manifest: "Manifest") -> None:
+        super().__init__(name=f"ark-writer:{root}", daemon=True)
+        self.root = root
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.manifest = manifest
+        self.errors: list[str] = []
+        self.files = 0
+        self.bytes = 0
+        self.kept = 0
+        self.deleted = 0
+        self.deleted_snapshots = 0
+        self.methods: collections.Counter = collections.Counter() # каким способом копировались файлы
+        self.timings: collections.Counter = collections.Counter() # write - работа, idle - ожидание команд (секунды)
+        self.waited = 0.0 # сколько читатель простоял на полной очереди (считает сам читатель)
+        self.slowest: list[tuple[float, str]] = [] # куча самых долгих файлов: секунды записи, путь
+        self.complete = False # проход дошел до конца
+        self.batch = False # проход только по изменениям, итог которого остается в журнале (см. batches)
+        self.stopping = threading.Event() # бэкап останавливают - долгие операции надо прервать
+        self.limit = 0 # байт в секунду (0 - без ограничения)
+        self.latency = 0.0 # среднее время записи блока из очереди (секунды)
+        self.fetched = 0 # файлов, которые писатель дочитал из источника сам
+        self.finished = 0.0 # когда поток закончил работу (time.monotonic)
+
+        self._entry: Entry | None = None # элемент, который сейчас пишется
+        self._backlog: collections.deque = collections.deque() # отложенные команды (см. defer)
+        self._backlog_cond = threading.Condition()
+        self._detached: tuple[Entry, int, "hashlib._Hash | None"] | None = None # недочитанный файл (см. detach)
+        self._held: tuple[Op, tuple] | None = None # команда из очереди, которая ждет отложенного
+        self._streaming: Entry | None = None # файл, блоки которого шлет читатель
+        self._fetching = False # писатель сам читает файл из источника
+        self._paced = 0 # сколько записанных байт уже учтено ограничением скорости
+        self._due = 0.0 # когда запись уложится в limit
+
+        self._queue_max = 0
+        self._queue_sum = 0
+        self._queue_samples = 0
+        self._timed: str | None = None # файл, время записи которого сейчас копится
+        self._timed_seconds = 0.0
+
+    def wants_copy(self, entry: Entry, alone: bool) -> bool:
+        """
+        Хочет ли писатель скопировать файл сам (команда COPY) вместо потока блоков от читателя
+
+        alone - файл больше никому не нужен, так что собственное чтение источника ничего не удвоит
+        """
+
+        return False
+
+    def clone(self, entry: Entry) -> bool:
+        """
+        Склонировать файл в приемник, не читая его (reflink), прямо сейчас - из потока читателя.
+        True - клон готов, писателю остается только команда COPY с флагом
+        """
+
+        return False
+
+    def resume_offset(self, entry: Entry) -> int:
+        """С какого места можно дописать файл, недописанный прерванным проходом"""
+
+        return 0
+
+    def successor(self) -> "DestinationWriter | None":
+        """
+        Писатель следующего прохода по изменениям (см. Watcher): новый поток, а индекс и остальное
+        загруженное состояние приемника переходят к нему отсюда, не перечитываясь с диска.
+        Зовется только после прохода, дошедшего до конца без ошибок. None - так нельзя
+        """
+
+        if not self.batches:
+            return None
+        self.manifest.carry()
+        writer = copy.copy(self)
+        DestinationWriter.__init__(writer, self.root, self.queue.maxsize, self.manifest)
+        writer._next_pass()
+        return writer
+
+    def put(self, op: Op, *args) -> None:
+        """Ставит команду в очередь (блокируется если очередь заполнена)"""
+
+        t = time.perf_counter()
+        self.queue.put((op, args))
+        self.waited += time.perf_counter() - t
+
+    def lagging(self) -> bool:
+        """Отстает ли приемник: что-то отложено, он сам читает файл или в очереди больше, чем он пишет за Constants.LAG секунд"""
+
+        if not self.fetches:
+            return False
+        return self.deferring() or self._fetching or self.queue.qsize() >= self.inflight()
+
+    def starving(self) -> bool:
+        """Ждет ли приемник читателя: в очереди почти пусто"""
+
+        return not self.lagging() and self.queue.qsize() < max(1, self.inflight() // 4)
+
+    def deferring(self) -> bool:
+        """Есть отложенное: тогда и все следующие команды откладываются, чтобы шли по порядку"""
+
+        return bool(self._backlog) or self._detached is not None
+
+    def inflight(self) -> int:
+        """Сколько блоков может ждать в очереди, пока приемник не считается отстающим"""
+
+        if not self.latency:
+            return self.queue.maxsize
+        return max(self.MIN_INFLIGHT, min(self.queue.maxsize, int(Constants.LAG.value / self.latency)))
+
+    def defer(self, op: Op, *args) -> None:
+        """
+        Откладывает команду отстающему приемнику: она выполнится, когда он разберет очередь.
+        FETCH - файл, который писатель прочитает из источника сам. Если отложено уже BACKLOG команд, ждет
+        """
+
+        t = time.perf_counter()
+        with self._backlog_cond:
+            while len(self._backlog) >= self.BACKLOG and self.is_alive():
+                self._backlog_cond.wait(0.1)
+            self._backlog.append((op, args))
+        self.waited += time.perf_counter() - t
+
+    def detach(self, entry: Entry, offset: int, digest: "hashlib._Hash | None") -> None:
+        """
+        Читатель больше не шлет блоков файла, который сейчас пишется: писатель дочитает
+        его из источника сам с места offset (digest - хеш уже присланного, None - хеша не будет)
+        """
+
+        self._detached = (entry, offset, digest)
+
+    def sample_queue(self) -> int:
+        """Текущая глубина очереди (заодно запоминается для средней и максимальной)"""
+
+        depth = self.queue.qsize()
+        self._queue_max = max(self._queue_max, depth)
+        self._queue_sum += depth
+        self._queue_samples += 1
+        return depth
+
+    def report(self, started: float, elapsed: float) -> dict:
+        """Часть отчета прохода про этот приемник (см. Backup.report()), started - начало прохода"""
+
+        if self.finished:
+            elapsed = max(self.finished - started, 1e-9) # быстрый приемник закончил раньше остальных
+        return {
+            "root": self.root,
+            "files": self.files,
+            "bytes": self.bytes,
+            "kept": self.kept,
+            "deleted": self.deleted,
+            "methods": dict(self.methods),
+            "bytes_per_s": round(self.bytes / elapsed),
+            "files_per_s": round(self.files / elapsed, 1),
+            "fetched": self.fetched,
+            "finished": round(self.finished - started, 3) if self.finished else None,
+            "seconds": {
+                "write": round(self.timings["write"], 3),
+                "idle": round(self.timings["idle"], 3),
+                "throttle": round(self.timings["throttle"], 3),
+                "wait": round(self.waited, 3)},
+            "queue": {
+                "size": self.queue.maxsize,
+                "avg": round(self._queue_sum / self._queue_samples, 1) if self._queue_samples else 0,
+                "max": self._queue_max},
+            "slowest": [{"path": rel, "seconds": round(seconds, 3)} for seconds, rel in sorted(self.slowest, reverse=True)],
+            "errors": len(self.errors),
+        }
+
+    def finish(self) -> None:
+        """Дожидается записи всего, что уже в очереди, и останавливает поток"""
+
+        t = time.perf_counter()
+        self.put(Op.STOP)
+        self.join()
+        self.waited += time.perf_counter() - t
+
+    def run(self) -> None:
+        while True:
+            t = time.perf_counter()
+            op, args = self._next()
+            started = time.perf_counter()
+            self.timings["idle"] += started - t
+            if op is Op.STOP:
+                self._discard()
+                break
+            if op in (Op.OPEN, Op.COPY, Op.FETCH):
+                self._timed, self._timed_seconds = args[0].rel, 0.0
+            throttled = self.timings["throttle"]
+            self._fetching = op is Op.FETCH
+            try:
+                self._dispatch(op, *args)
+                self._pace()
+            except Exception as e:
+                # поток не должен умирать, иначе читатель навсегда повиснет на полной очереди
+                entry = self._entry or (args[0] if args and isinstance(args[0], Entry) else None)
+                self.errors.append(f"{entry.rel if entry else '?'}: {str(e).rstrip()}")
+                self._discard()
+                if entry and op is not Op.KEEP:
+                    # в приемнике осталась прежняя версия (или ничего) - как и записано в старом индексе
+                    try:
+                        self._keep(entry.rel)
+                    except OSError as e:
+                        self.errors.append(f"{entry.rel}: {e}")
+            seconds = time.perf_counter() - started
+            if op in self.STREAM:
+                self.latency = seconds if not self.latency else self.latency * 0.9 + seconds * 0.1
+            self._time_file(op, seconds - (self.timings["throttle"] - throttled))
+            self._fetching = False
+
+        self._backlog.clear()
+        with self._backlog_cond:
+            self._backlog_cond.notify_all() # читатель мог ждать места в отложенном
+        try:
+            # остановленный проход мог не доделать что-то уже после PRUNE (например, COPY)
+            if self._close() and self.complete and not self.stopping.is_set():
+                if self.batch:
+                    self.manifest.advance()
+                else:
+                    self.manifest.save()
+                    self._publish()
+            else:
+                self.manifest.suspend()
+        except OSError as e:
+            self.errors.append(f"finishing: {e}")
+        self.finished = time.monotonic()
+
+    def _next(self) -> tuple[Op, tuple]:
+        """
+        Следующая команда: из очереди, а когда она пуста - отложенная (см. defer).
+        Недочитанный файл (см. detach) дочитывается, когда пришедшие блоки кончились, но раньше
+        первой команды не про него, а PRUNE и STOP ждут, пока отложенное не кончится
+        """
+
+        while True:
+            if self._held is None:
+                if self.queue.empty():
+                    if self._detached is not None and self._detached[0] is self._streaming:
+                        return Op.FETCH, self._take_detached()
+                    if self._backlog and self._streaming is None:
+                        return self._take_backlog()
+                try:
+                    self._held = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue # отложить могли уже после того, как очередь опустела
+
+            op = self._held[0]
+            if self._detached is not None and self._detached[0] is self._streaming and op not in self.STREAM:
+                return Op.FETCH, self._take_detached()
+            if op in (Op.PRUNE, Op.STOP) and self._backlog and not self.stopping.is_set():
+                return self._take_backlog()
+            item, self._held = self._held, None
+            if op is Op.OPEN:
+                self._streaming = item[1][0]
+            elif op in (Op.CLOSE, Op.ABORT, Op.SUSPEND):
+                self._streaming = None
+            return item
+
+    def _take_backlog(self) -> tuple[Op, tuple]:
+        with self._backlog_cond:
+            item = self._backlog.popleft()
+            self._backlog_cond.notify_all()
+        return item
+
+    def _take_detached(self) -> tuple:
+        detached, self._detached = self._detached, None
+        self._streaming = None
+        return detached
+
+    def _fetch(self, entry: Entry, start: int | None = None, digest: "hashlib._Hash | None" = None) -> None:
+        """
+        **Читает файл источника сам** (см. defer, detach) и пишет его так же, как пришедший от читателя
+
+        Без start - весь файл (недописанный прерванным проходом - с места остановки),
+        иначе дочитывает начатый читателем файл с места start
+        """
+
+        with open(entry.path, "rb") as f:
+            if start is None:
+                start = self.resume_offset(entry)
+                digest = hashlib.new(Constants.HASH.value) if not start else None
+                self._dispatch(Op.OPEN, entry, start)
+            f.seek(start)
+            for op, args, data in self._read(f):
+                if self.stopping.is_set():
+                    self._dispatch(Op.SUSPEND)
+                    return
+                if digest is not None:
+                    digest.update(data)
+                self._dispatch(op, *args)
+                self._pace()
+        self._dispatch(Op.CLOSE, digest.hexdigest() if digest is not None else "")
+        self.fetched += 1
+
+    def _read(self, f: BinaryIO) -> Iterator[tuple[Op, tuple, bytes]]:
+        """Команды с блоками файла f, как их прислал бы читатель, и сами данные"""
+
+        for block in Pipeline.blocks(f):
+            yield Op.DATA, (block, None), block
+
+    def _pace(self) -> None:
+        """Держит скорость записи в пределах limit: спит, пока записанное не уложится в нее"""
+
+        if not self.limit:
+            return
+        n, self._paced = self.bytes - self._paced, self.bytes
+        if n <= 0:
+            return
+        now = time.monotonic()
+        self._due = max(self._due, now) + n / self.limit
+        if self._due - now > 0.01:
+            t = time.perf_counter()
+            self.stopping.wait(self._due - now)
+            self.timings["throttle"] += time.perf_counter() - t
+
+    def _time_file(self, op: Op, seconds: float) -> None:
+        """Копит время записи текущего файла (от OPEN до CLOSE или одного COPY) и помнит самые долгие"""
+
+        self.timings["write"] += seconds
+        if self._timed is None:
+            return
+        self._timed_seconds += seconds
+        if op in (Op.CLOSE, Op.COPY, Op.ABORT, Op.SUSPEND, Op.FETCH):
+            item = (self._timed_seconds, self._timed)
+            if len(self.slowest) < Constants.SLOWEST.value:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+            self._timed = None
+
+    def _dispatch(self, op: Op, *args) -> None:
+        if op is Op.KEEP:
+            self._keep(args[0].rel, *args[1:])
+            self.kept += 1
+        elif op is Op.META:
+            entry, old = args
+            self._apply_meta(entry)
+            self.manifest.add(entry.rel, entry.st, old.digest, old.chunks, old.pack)
+            self.kept += 1
+        elif op is Op.PRUNE:
+            if self.stopping.is_set():
+                return # часть файлов этого прохода пропущена - они не удаленные
+            self._prune(*args)
+            self.complete = True
+        elif op is Op.SUSPEND:
+            self._discard()
+        elif op is Op.FETCH:
+            self._fetch(*args)
+        else:
+            raise RuntimeError(f"unexpected command {op.name}")
+
+    def _prune(
+        self,
+        tops: frozenset[str],
+        unreadable: frozenset[str],
+        delete: bool,
+        changes: dict[str, bool] | None = None,
+    ) -> None:
+        """
+        **Разбирается с путями из старого индекса, которых не было в этом проходе**
+
+        Удаляются только если разрешено, они лежат внутри бэкапленных сейчас источников
+        (и изменившихся путей, если проход шел только по ним) и ни они, ни их родители
+        не сломались при чтении. Остальные остаются в индексе как были. Проходу с batches
+        переносить нетронутое незачем - он смотрит только пути внутри изменившихся
+        """
+
+        self.batch = self.batches and changes is not None
+        # в обратном порядке дети идут раньше своих папок
+        for rel, record in self.manifest.unseen(reverse=True, within=changes if self.batch else None):
+            parts = rel.split("/")
+            broken = any("/".join(parts[:i]) in unreadable for i in range(1, len(parts) + 1))
+            skipped = changes is not None and rel not in changes and not Watcher.inside(changes, rel)
+            if not delete or parts[0] not in tops or broken or skipped:
+                self._keep(rel, record)
+                continue
+
+            try:
+                self._remove(rel, record)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # например, в папке лежит что-то чужое - оставляем как есть
+                self.errors.append(f"{rel}: {e}")
+                self.manifest.keep(rel, record)
+                continue
+            self.manifest.drop(rel)
+            self.deleted += 1
+
+    def _keep(self, rel: str, record: "Record | None" = None) -> None:
+        """Элемент в приемнике остается таким, как записано в старом индексе (record - его запись там)"""
+
+        self.manifest.keep(rel, record)
+
+    def _apply_meta(self, entry: Entry) -> None:
+        """Изменились только права - содержимое трогать не нужно"""
+
+    def _remove(self, rel: str, record: "Record") -> None:
+        """Удаляет из приемника путь, которого больше нет в источнике"""
+
+    def _discard(self) -> None:
+        """Выбрасывает недописанный файл"""
+
+        self._entry = None
+
+    def _close(self) -> bool:
+        """Доделывает всё, что осталось после последней команды. Возвращает, нужно ли сохранять индекс"""
+
+        return True
+
+    def _publish(self) -> None:
+        """Вызывается после сохранения индекса"""
+
+    def _next_pass(self) -> None:
+        """Сбрасывает то, что у писателя свое на каждый проход (см. successor)"""
+
+class MirrorWriter(DestinationWriter):
+    """
+    **Запись в приемник-зеркало**
+
+    Приемник - обычное дерево файлов, индекс лежит в служебной папке рядом
+
+    Файлы от delta_min байт обновляются поблочно: подписи блоков прежней копии лежат
+    в служебной папке, и переписываются только блоки, подписи которых изменились.
+    Правка идет прямо по файлу приемника, а его подписи удаляются до первой записи -
+    если проход упадет, в следующий раз файл просто перепишется целиком
+
+    Обычный файл пишется во временный, и каждые CHECKPOINT байт его длина уходит в журнал.
+    Прерванный проход оставляет временный файл, следующий его дописывает
+
+    Дыры разреженных файлов (команда HOLE) в копии просто перепрыгиваются - место под них не выделяется
+
+    Файлы меньше pack_below байт не создаются в дереве, а дописываются в паки (см. PackFiles).
+    В конце полного прохода паки, где живых данных меньше половины (и совсем мелкие паки
+    прошлых проходов), переупаковываются в текущий, а сами удаляются после сохранения индекса.
+    Уже лежащие в дереве мелкие файлы уходят в паки, когда изменятся. Без pack_below
+    упакованные файлы возвращаются в дерево, а паки удаляются
+    """
+
+    batches = True
+
+    def __init__(
+        self,
+        root: str,
+        queue_size: int,
+        previous: str | None = None,
+        delta_min: int | None = None,
+        pack_below: int = 0,
+    ) -> None:
+        """
+        previous - корень, индекс которого считается старым (по умолчанию сам root)
+        delta_min - с какого размера файлы обновляются поблочно (None - никогда)
+        pack_below - файлы меньше этого размера пакуются (0 - никогда)
+        """
+
+        manifest = os.path.join(Constants.META_DIR.value, "manifest")
+        super().__init__(root, queue_size, MirrorManifest(
+            os.path.join(root, manifest),
+            os.path.join(previous or root, manifest),
+            os.path.join(root, Constants.META_DIR.value, "journal")))
+
+        self.pack_below = pack_below
+        self.packs = PackFiles(os.path.join(root, Constants.META_DIR.value, "packs"))
+        self._buffer: list[bytes] | None = None # блоки мелкого файла, который пойдет в пак
+        self._garbage: list[str] = [] # паки, которые удаляются после сохранения индекса
+        self._check_packed()
+
+        self._file = None # открытый временный файл
+        self._dirs = RecordIndex() # путь папки -> ее права и время, они ставятся в самом конце
+        self._reflink: dict[int, bool] = {} # st_dev источника -> работает ли reflink
+
+        self.delta_min = delta_min
+        self._sigs: list[bytes] | None = None # подписи блоков файла, который сейчас пишется
+        self._old_sigs: list[bytes] | None = None # подписи прежней копии (только при поблочном обновлении)
+        self._in_place = False # файл правится прямо в приемнике, а не во временной копии
+        self._end = 0 # сколько байт файла уже пришло
+        self._checkpointed = 0 # докуда файл отмечен в журнале
+        self._holes = False # в файле есть дыры (его длину надо выставить явно)
+
+    def wants_copy(self, entry: Entry, alone: bool) -> bool:
+        """
+        Способы ядра, кроме reflink, читают источник сами, поэтому годятся только если файл
+        больше никому не нужен (иначе см. clone).
+        Файлам для поблочного обновления нужны подписи блоков, их ядро не посчитает.
+        Скорость копирования ядром не ограничить, поэтому с limit файлы идут потоком
+        """
+
+        if self.limit or not FastCopy.available() or self._delta(entry) or self._packed(entry):
+            return False
+        return alone
+
+    def clone(self, entry: Entry) -> bool:
+        """
+        reflink не читает данные вовсе, поэтому файл, нужный и другим приемникам, клонируется
+        прямо в потоке читателя - без запасных способов. Не вышло - файл придет общим потоком.
+        С устройства источника, где ядро ни разу не поддержало reflink, он больше не пробуется
+        """
+
+        if self.limit or not FastCopy.available() or self._delta(entry) or self._packed(entry) \
+                or self.resume_offset(entry) or self._reflink.get(entry.st.st_dev) is False:
+            return False
+
+        tmp = self._dst_path(entry) + Constants.TMP_SUFFIX.value
+        try:
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            with open(entry.path, "rb") as src, open(tmp, "wb") as dst:
+                cloned = FastCopy.clone(src.fileno(), dst.fileno())
+            # "не поддерживается" FastCopy.clone сообщает через False - только это и запоминается
+            self._reflink[entry.st.st_dev] = self._reflink.get(entry.st.st_dev) or cloned
+        except OSError:
+            cloned = False # настоящая ошибка с этим файлом - reflink для устройства не выключает
+        if not cloned:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+        return cloned
+
+    def resume_offset(self, entry: Entry) -> int:
+        """Временный файл дописывается, только если файл источника с тех пор не менялся"""
+
+        part = self.manifest.partial.get(entry.rel)
+        if part is None or self._delta(entry) or self._packed(entry):
+            return 0
+        offset, size, mtime_ns, ino = part
+        if (size, mtime_ns, ino) != (entry.st.st_size, entry.st.st_mtime_ns, entry.st.st_ino):
+            return 0
+        try:
+            if os.path.getsize(self._dst_path(entry) + Constants.TMP_SUFFIX.value) < offset:
+                return 0
+        except OSError:
+            return 0
+        return offset
+
+    def _dispatch(self, op: Op, *args) -> None:
+        if op is Op.DIR:
+            entry = args[0]
+            path = self._dst_path(entry)
+            if os.path.islink(path) or os.path.isfile(path):
+                os.unlink(path) # раньше на этом месте был файл
+            os.makedirs(path, exist_ok=True)
+            self._dirs[path] = Record.of(entry.st)
+            self.manifest.add(entry.rel, entry.st)
+        elif op is Op.SYMLINK:
+            entry, link = args
+            path = self._dst_path(entry)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(link, path)
+            FileMeta.apply(path, entry.st)
+            self.manifest.add(entry.rel, entry.st, link)
+        elif op is Op.OPEN:
+            self._entry, start = args
+            if self._packed(self._entry):
+                self._buffer = []
+                return
+            path = self._dst_path(self._entry)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self._delta(self._entry):
+                self._sigs = []
+                self._old_sigs = self._delta_base(path)
+            if self._old_sigs is None:
+                self._open_tmp(path, start)
+            self._end = self._checkpointed = start
+        elif op is Op.HOLE:
+            if self._buffer is not None:
+                self._buffer.append(bytes(args[0]))
+            elif self._file is not None:
+                self._file.seek(args[0], os.SEEK_CUR)
+                self._end += args[0]
+                self._holes = True
+        elif op is Op.DATA:
+            if self._buffer is not None:
+                self._buffer.append(args[0])
+            elif self._file is not None: # после ошибки блоки файла просто пропускаются
+                block, sigs = args
+                if self._old_sigs is None:
+                    self._file.write(block)
+                    self.bytes += len(block)
+                else:
+                    self._patch(block, sigs)
+                if self._sigs is not None:
+                    self._sigs.extend(sigs)
+                self._end += len(block)
+                if self._sigs is None and self._end - self._checkpointed >= Constants.CHECKPOINT.value:
+                    self._checkpoint()
+        elif op is Op.CLOSE:
+            if self._buffer is not None:
+                self._commit_packed(args[0])
+            elif self._file is not None:
+                method = "delta" if self._old_sigs is not None else "sparse" if self._holes else "stream"
+                self._commit(args[0], method)
+            self._entry = None
+        elif op is Op.ABORT:
+            self._discard()
+        elif op is Op.SUSPEND:
+            self._suspend()
+        elif op is Op.COPY:
+            if len(args) > 1 and args[1]:
+                self._commit_clone(args[0])
+            elif not self.stopping.is_set(): # этот файл скопирует следующий запуск
+                self._copy(args[0])
+        else:
+            super()._dispatch(op, *args)
+
+    def _fetch(self, entry: Entry, start: int | None = None, digest: "hashlib._Hash | None" = None) -> None:
+        if start is None and self.wants_copy(entry, True):
+            self._copy(entry)
+            self.fetched += 1
+        else:
+            super()._fetch(entry, start, digest)
+
+    def _read(self, f: BinaryIO) -> Iterator[tuple[Op, tuple, bytes]]:
+        """При поблочном обновлении нужны еще и подписи блоков"""
+
+        for block in Pipeline.blocks(f):
+            yield Op.DATA, (block, Signature.of(block) if self._sigs is not None else None), block
+
+    def _copy(self, entry: Entry) -> None:
+        """
+        Копирует файл сам, без участия читателя
+
+        Содержимое при этом не проходит через питон, поэтому хеш в индексе остается пустым
+        """
+
+        self._entry = entry
+        path = self._dst_path(entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        start = self.resume_offset(entry)
+        self._open_tmp(path, start)
+        self._end = self._checkpointed = start
+
+        def progress(done: int) -> None:
+            self._end = done
+            if self.stopping.is_set():
+                raise Interrupted()
+            if done - self._checkpointed >= Constants.CHECKPOINT.value:
+                self._checkpoint()
+
+        with open(entry.path, "rb") as src:
+            reflink = self._reflink.get(entry.st.st_dev) is not False
+            try:
+                method, n = FastCopy.copy(src.fileno(), self._file.fileno(), reflink, start, progress)
+            except Interrupted:
+                self._suspend()
+                return
+        self._reflink[entry.st.st_dev] = self._reflink.get(entry.st.st_dev) or method == FastCopy.REFLINK
+        self.bytes += n
+        self._commit("", method)
+
+    def _commit_clone(self, entry: Entry) -> None:
+        """Временный файл уже склонирован читателем (см. clone) - осталось подменить им целевой"""
+
+        self._entry = entry
+        self._file = open(self._dst_path(entry) + Constants.TMP_SUFFIX.value, "r+b")
+        self.bytes += os.fstat(self._file.fileno()).st_size
+        self._commit("", FastCopy.REFLINK)
+
+    def _open_tmp(self, path: str, start: int) -> None:
+        """Открывает временный файл: новый или недописанный прерванным проходом (тогда с места start)"""
+
+        tmp = path + Constants.TMP_SUFFIX.value
+        if not start:
+            self._file = open(tmp, "wb")
+            return
+        self._file = open(tmp, "r+b")
+        self._file.truncate(start)
+        self._file.seek(start)
+
+    def _checkpoint(self) -> None:
+        """Отмечает в журнале, докуда временный файл точно записан на диск"""
+
+        if self._holes:
+            self._file.truncate(self._end) # дыра в конце - тоже записанная часть
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        Pipeline.drop(self._file.fileno(), self._end) # уже на диске, кешу страниц не нужно
+        self.manifest.checkpoint(self._entry.rel, self._end, self._entry.st)
+        self._checkpointed = self._end
+
+    def _suspend(self) -> None:
+        """Бэкап останавливают посреди файла: временный файл остается, чтобы следующий запуск его дописал"""
+
+        if self._file is None or self._old_sigs is not None or self._sigs is not None:
+            self._discard() # поблочное обновление так не продолжить
+            return
+
+        self._checkpoint()
+        self._file.close()
+        self._file = None
+        self._entry = None
+        self._reset_file()
+
+    def _commit(self, digest: str, method: str = "stream") -> None:
+        """Закрывает временный файл и атомарно подменяет им целевой"""
+
+        path = self._dst_path(self._entry)
+        if self._old_sigs is not None or self._holes:
+            self._file.truncate(self._end) # файл мог стать короче прежней копии или кончаться дырой
+        self._file.flush()
+        os.fsync(self._file.fileno()) # индекс сохранится, только когда все файлы прохода уже на диске
+        self._file.close()
+        self._file = None
+
+        if self._in_place:
+            FileMeta.apply(path, self._entry.st)
+        else:
+            FileMeta.apply(path + Constants.TMP_SUFFIX.value, self._entry.st)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path) # раньше на этом месте была папка
+            os.replace(path + Constants.TMP_SUFFIX.value, path)
+
+        sig_path = Signature.path(self.root, self._entry.rel)
+        if self._sigs is not None:
+            Signature.save(sig_path, path, self._sigs)
+        elif self.delta_min is not None and os.path.exists(sig_path):
+            os.unlink(sig_path) # файл стал меньше delta_min - подписи прежней копии больше ни к чему
+
+        self.manifest.add(self._entry.rel, self._entry.st, digest)
+        self.methods[method] += 1
+        self.files += 1
+        self._reset_file()
+
+    def _commit_packed(self, digest: str) -> None:
+        """Дописывает мелкий файл в пак"""
+
+        data = b"".join(self._buffer)
+        self._buffer = None
+        location = self.packs.add(data)
+
+        old = self.manifest.old.get(self._entry.rel)
+        path = self._dst_path(self._entry)
+        if old is not None and old.pack is None and os.path.lexists(path):
+            # раньше на этом месте лежал файл или папка дерева
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+        self.manifest.add(self._entry.rel, self._entry.st, digest, pack=location)
+        self.methods["pack"] += 1
+        self.files += 1
+        self.bytes += len(data)
+
+    def _packed(self, entry: Entry) -> bool:
+        return entry.st.st_size < self.pack_below
+
+    def _check_packed(self) -> None:
+        """
+        Прерванный проход мог упасть раньше, чем его пак дописался на диск.
+        А без упаковки упакованные раньше файлы должны снова появиться в дереве
+        """
+
+        self.manifest.drop_torn(self.packs.sizes())
+        if self.pack_below:
+            return
+        for rel, record in self.manifest.old.items():
+            if record.pack is not None:
+                self.manifest.old.discard(rel)
+                self.manifest.journaled.discard(rel)
+
+    def _compact(self) -> None:
+        """
+        Переупаковывает паки, где живых данных меньше половины, и мелкие паки прошлых проходов.
+        Их файлы сейчас переедут в текущий пак, а сами паки удалятся после сохранения индекса
+        """
+
+        used: collections.Counter = collections.Counter() # id пака -> сколько в нем живых байт
+        for rel, r in self.manifest.new.items():
+            if r.pack is not None:
+                used[r.pack[0]] += r.pack[2]
+
+        current = self.packs.current # при переупаковке он может смениться
+        for pack_id, size in self.packs.sizes().items():
+            if pack_id != current and (used[pack_id] * 2 < size or size < PackFiles.PACK_SIZE // 16):
+                self._garbage.append(pack_id)
+        if not self._garbage:
+            return
+
+        garbage = set(self._garbage)
+        for rel, r in self.manifest.new.items():
+            if r.pack is not None and r.pack[0] in garbage:
+                location = self.packs.add(self.packs.read(*r.pack))
+                self.manifest.new[rel] = Record(r.kind, r.mode, r.size, r.mtime_ns, r.ino, r.digest, pack=location)
+
+    def _delta(self, entry: Entry) -> bool:
+        return self.delta_min is not None and entry.st.st_size >= self.delta_min
+
+    def _delta_base(self, path: str) -> list[bytes] | None:
+        """
+        Открывает прежнюю копию файла для поблочной правки и возвращает подписи ее блоков.
+        None - подписей нет (или они не от этой копии), файл пишется целиком
+        """
+
+        sig_path = Signature.path(self.root, self._entry.rel)
+        sigs = Signature.load(sig_path, path)
+        if sigs is None:
+            return None
+
+        os.unlink(sig_path) # с первой же записи подписи перестанут соответствовать файлу
+        self._file = open(path, "r+b")
+        self._in_place = True
+        return sigs
+
+    def _patch(self, block: bytes, sigs: list[bytes]) -> None:
+        """Пишет поверх прежней копии только блоки, подписи которых не совпали"""
+
+        first = self._end // Signature.BLOCK
+        view = memoryview(block)
+        for i, sig in enumerate(sigs):
+            n = first + i
+            if n < len(self._old_sigs) and self._old_sigs[n] == sig:
+                continue
+            part = view[i * Signature.BLOCK:(i + 1) * Signature.BLOCK]
+            self._file.seek(n * Signature.BLOCK)
+            self._file.write(part)
+            self.bytes += len(part)
+
+    def _reset_file(self) -> None:
+        self._sigs = None
+        self._old_sigs = None
+        self._in_place = False
+        self._holes = False
+
+    def _apply_meta(self, entry: Entry) -> None:
+        if self.manifest.old[entry.rel].pack is None: # у упакованного файла права есть только в индексе
+            FileMeta.apply(self._dst_path(entry), entry.st)
+
+    def _remove(self, rel: str, record: "Record") -> None:
+        if record.pack is not None:
+            return # место в паке освободит переупаковка
+        path = os.path.join(self.root, *rel.split("/"))
+        if record.kind == Record.DIR:
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+            if self.delta_min is not None and os.path.exists(Signature.path(self.root, rel)):
+                os.unlink(Signature.path(self.root, rel))
+
+    def _discard(self) -> None:
+        """
+        Выбрасывает недописанный временный файл. Поправленный на месте файл остается
+        как есть - подписей у него уже нет, и в следующий раз он перепишется целиком
+        """
+
+        self._entry = None
+        self._buffer = None
+        in_place = self._in_place
+        self._reset_file()
+        if self._file is None:
+            return
+
+        tmp = self._file.name
+        self._file.close()
+        self._file = None
+        if in_place:
+            return
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+    def _close(self) -> bool:
+        """Время папок ставится в конце - запись содержимого его бы сбила. Паки должны быть на диске раньше индекса"""
+
+        # в обратном порядке дети идут раньше своих папок
+        for path, record in self._dirs.items(reverse=True):
+            try:
+                FileMeta.apply(path, record)
+            except OSError as e:
+                self.errors.append(f"{path}: {e}")
+        if self.complete and not self.stopping.is_set() and not self.batch:
+            self._compact() # без упаковки просто удалит оставшиеся от нее паки
+        self.packs.flush()
+        return True
+
+    def _next_pass(self) -> None:
+        self._dirs = RecordIndex()
+        self._garbage = []
+
+    def _publish(self) -> None:
+        for pack_id in self._garbage:
+            os.unlink(self.packs.path(pack_id))
+
+    def _dst_path(self, entry: Entry) -> str:
+        return os.path.join(self.root, *entry.rel.split("/"))
+
+class RepoWriter(DestinationWriter):
+    """
+    **Запись в хранилище с дедупликацией**
+
+    Файлы приходят уже нарезанными на куски (см. Chunker), каждый кусок хранится
+    в хранилище один раз. Итог прохода - новый снимок со списками кусков файлов
+    (у прохода по изменениям - журнал, см. DestinationWriter)
+    """
+
+    batches = True
+
+    def __init__(self, root: str, queue_size: int) -> None:
+        self.store = ChunkStore(root)
+        super().__init__(root, queue_size, Snapshot(self.store.snapshots_dir, os.path.join(root, "journal")))
+        self.manifest.drop_unstored(self.store)
+
+        self._chunks: list[bytes] | None = None # куски файла, который сейчас пишется
+
+    def _dispatch(self, op: Op, *args) -> None:
+        if op is Op.DIR:
+            self.manifest.add(args[0].rel, args[0].st)
+        elif op is Op.SYMLINK:
+            entry, link = args
+            self.manifest.add(entry.rel, entry.st, link)
+        elif op is Op.OPEN:
+            self._entry = args[0]
+            self._chunks = []
+        elif op is Op.CHUNK:
+            if self._chunks is not None:
+                chunk_id, data = args
+                if self.store.add(chunk_id, data):
+                    self.bytes += len(data)
+                self._chunks.append(chunk_id)
+        elif op is Op.CLOSE:
+            if self._chunks is not None:
+                self.manifest.add(self._entry.rel, self._entry.st, args[0], self._chunks)
+                self.files += 1
+            self._discard()
+        elif op is Op.ABORT:
+            self._discard()
+        else:
+            super()._dispatch(op, *args)
+
+    def _read(self, f: BinaryIO) -> Iterator[tuple[Op, tuple, bytes]]:
+        for chunk in Chunker.split(f, Constants.BLOCK_SIZE.value):
+            yield Op.CHUNK, (hashlib.sha256(chunk).digest(), chunk), chunk
+
+    def _discard(self) -> None:
+        """Уже записанные куски остаются в хранилище - они просто ни на что не ссылаются"""
+
+        self._entry = None
+        self._chunks = None
+
+    def _close(self) -> bool:
+        """Снимок можно писать только когда все его куски уже на диске"""
+
+        self.store.flush()
+        return True
+
+class SnapshotWriter(MirrorWriter):
+    """
+    **Запись очередного снимка-папки в приемник (как rsync --link-dest)**
+
+    Каждый проход создает в приемнике папку с именем по времени. Неизменившиеся файлы
+    в ней - жесткие ссылки на файлы предыдущего снимка, поэтому стоят только места
+    под запись в папке, а записываются целиком только изменившиеся. Индекс у каждого
+    снимка свой, сравнение идет с индексом предыдущего
+
+    Снимок собирается во временной папке и получает свое имя, только если проход
+    дошел до конца. После этого старые снимки сверх keep удаляются. Недособранный
+    снимок прерванного прохода (с журналом) следующий запуск продолжает собирать
+    """
+
+    batches = False # проход по изменениям - тоже целый новый снимок
+
+    def __init__(self, root: str, queue_size: int, keep: int = 0, delta_min: int | None = None) -> None:
+        self.base = root
+        self.keep = keep # сколько последних снимков хранить (0 - все)
+
+        names = self.names(root)
+        self.prev = os.path.join(root, names[-1]) if names else None
+        stale = self._remove_stale(root)
+        self.resumed = stale is not None # в папке снимка уже лежит сделанное прерванным проходом
+        self.snapshot_name = stale or Stamp.unique(root)
+
+        super().__init__(
+            os.path.join(root, self.snapshot_name + Constants.TMP_SUFFIX.value), queue_size, self.prev, delta_min)
+
+    @classmethod
+    def names(cls, root: str) -> list[str]:
+        """Имена готовых снимков в приемнике от старых к новым"""
+
+        if not os.path.isdir(root):
+            return []
+        return sorted(
+            n for n in os.listdir(root)
+            if Stamp.PATTERN.fullmatch(n) and os.path.isdir(os.path.join(root, n, Constants.META_DIR.value)))
+
+    def _keep(self, rel: str, record: "Record | None" = None) -> None:
+        """Неизменившийся элемент берется из предыдущего снимка"""
+
+        record = record or self.manifest.old.get(rel)
+        if record is None:
+            return
+        if rel in self.manifest.journaled:
+            super()._keep(rel, record) # записан в этот снимок прерванным проходом
+            return
+
+        path = os.path.join(self.root, *rel.split("/"))
+        if record.kind == Record.DIR:
+            os.makedirs(path, exist_ok=True)
+            self._dirs[path] = record
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.resumed and os.path.lexists(path):
+                os.unlink(path) # ссылка от прерванного прохода
+            if record.kind == Record.SYMLINK:
+                os.symlink(record.digest, path)
+                FileMeta.apply(path, record)
+            else:
+                try:
+                    os.link(self._prev_path(rel), path)
+                except OSError as e:
+                    if e.errno not in (errno.EMLINK, errno.EPERM, errno.EXDEV):
+                        raise
+                    # у inode кончились ссылки (или ФС их не умеет) - делаем копию
+                    self._clone(rel, path, record)
+                self._link_signature(rel)
+        super()._keep(rel, record)
+
+    def _apply_meta(self, entry: Entry) -> None:
+        """У жесткой ссылки права общие со старым снимком, поэтому тут нужна своя копия"""
+
+        if entry.rel in self.manifest.journaled:
+            super()._apply_meta(entry) # копия уже своя
+            return
+        self._clone(entry.rel, self._dst_path(entry), entry.st)
+        self._link_signature(entry.rel)
+
+    def _delta_base(self, path: str) -> list[bytes] | None:
+        """Прежняя копия - в предыдущем снимке и общая с ним, поэтому правится ее клон"""
+
+        if self.prev is None:
+            return None
+        rel = self._entry.rel
+        sigs = Signature.load(Signature.path(self.prev, rel), self._prev_path(rel))
+        if sigs is None:
+            return None
+
+        self._file = open(path + Constants.TMP_SUFFIX.value, "wb")
+        with open(self._prev_path(rel), "rb") as src:
+            FastCopy.copy(src.fileno(), self._file.fileno())
+        return sigs
+
+    def _link_signature(self, rel: str) -> None:
+        """Подписи неизменившегося файла годятся и для нового снимка"""
+
+        if self.delta_min is None:
+            return
+        sig_path = Signature.path(self.root, rel)
+        try:
+            os.makedirs(os.path.dirname(sig_path), exist_ok=True)
+            os.link(Signature.path(self.prev, rel), sig_path)
+        except OSError:
+            pass # нет подписей - файл в следующий раз перепишется целиком
+
+    def _remove(self, rel: str, record: "Record") -> None:
+        """Удаленного из источника в новом снимке просто нет"""
+
+    def _clone(self, rel: str, path: str, st: "os.stat_result | Record") -> None:
+        """Копия файла из предыдущего снимка (источник при этом не читается)"""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(self._prev_path(rel), "rb") as src, open(path, "wb") as dst:
+            FastCopy.copy(src.fileno(), dst.fileno())
+            os.fsync(dst.fileno())
+        FileMeta.apply(path, st)
+
+    def _prev_path(self, rel: str) -> str:
+        return os.path.join(self.prev, *rel.split("/"))
+
+    def _close(self) -> bool:
+        super()._close()
+        if not self.complete and not self.stopping.is_set():
+            self.errors.append(f"snapshot is incomplete, the next run will continue '{self.root}'")
+        return self.complete
+
+    def _publish(self) -> None:
+        final = os.path.join(self.base, self.snapshot_name)
+        os.replace(self.root, final)
+        self.root = final
+
+        names = self.names(self.base)
+        while self.keep and len(names) > self.keep:
+            shutil.rmtree(os.path.join(self.base, names.pop(0)))
+            self.deleted_snapshots += 1
+
+    @classmethod
+    def _remove_stale(cls, root: str) -> str | None:
+        """
+        Недособранные снимки прошлых запусков больше не нужны - кроме последнего с журналом,
+        его продолжит этот проход. Возвращает его имя
+        """
+
+        if not os.path.isdir(root):
+            return None
+
+        suffix = Constants.TMP_SUFFIX.value
+        stale = sorted(
+            name[:-len(suffix)] for name in os.listdir(root)
+            if name.endswith(suffix) and Stamp.PATTERN.fullmatch(name[:-len(suffix)]))
+        resumed = None
+        if stale and os.path.exists(os.path.join(root, stale[-1] + suffix, Constants.META_DIR.value, "journal")):
+            resumed = stale.pop()
+        for name in stale:
+            shutil.rmtree(os.path.join(root, name + suffix), ignore_errors=True)
+        return resumed
+
+class ArchiveWriter(DestinationWriter):
+    """
+    **Запись в приемник-архив**
+
+    Tar-поток собирается и сжимается один раз на все приемники (см. TarStream),
+    сюда приходят уже готовые сжатые блоки. Остальные команды только пополняют
+    индекс архива, который кладется рядом с ним. Архив получает свое имя только
+    если весь проход дошел до конца, иначе недописанный файл удаляется
+
+    Поток архива общий, поэтому отставший архив ничего не дочитывает сам - его ждут
+    """
+
+    fetches = False
+
+    def __init__(self, root: str, queue_size: int, name: str) -> None:
+        self.archive_path = os.path.join(root, name)
+        super().__init__(root, queue_size, Manifest(self.archive_path + ".manifest"))
+
+        os.makedirs(root, exist_ok=True)
+        self._file = open(self.archive_path + Constants.TMP_SUFFIX.value, "wb")
+        self._failed = False # блок потока не записался - архив испорчен и не публикуется
+
+    def _dispatch(self, op: Op, *args) -> None:
+        if op is Op.DATA:
+            if self._failed:
+                return # после дыры в потоке дописывать его бессмысленно
+            try:
+                self._file.write(args[0])
+            except OSError:
+                self._failed = True
+                raise
+            self.bytes += len(args[0])
+        elif op in (Op.DIR, Op.SYMLINK):
+            entry = args[0]
+            self.manifest.add(entry.rel, entry.st, args[1] if op is Op.SYMLINK else "")
+        elif op is Op.OPEN:
+            self._entry = args[0]
+        elif op is Op.CLOSE:
+            if self._entry is not None: # None - файл уже выброшен после ошибки записи
+                self.manifest.add(self._entry.rel, self._entry.st, args[0])
+                self.files += 1
+            self._entry = None
+        elif op is Op.ABORT:
+            self._entry = None
+        elif op is Op.PRUNE:
+            # PRUNE приходит после последнего блока архива
+            self.complete = True
+        else:
+            super()._dispatch(op, *args)
+
+    def _close(self) -> bool:
+        tmp = self._file.name
+        if not self.complete or self._failed:
+            try:
+                self._file.close()
+            except OSError:
+                pass # недописанное в буфере уже не нужно
+            finally:
+                os.unlink(tmp)
+            if self._failed:
+                self.errors.append(f"{self.archive_path}: archive stream is broken by a write error, not published")
+            return False
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        return True
+
+    def _publish(self) -> None:
+        os.replace(self._file.name, self.archive_path)
+
+class Change(Enum):
+    """Чем элемент источника отличается от записи в индексе приемника"""
+
+    SAME = 1 # ничего не изменилось
+    META = 2 # изменились только права
+    DATA = 3 # новый элемент или изменилось содержимое
+
+class Record:
+    """Запись индекса приемника"""
+
+    FILE = "f"
+    DIR = "d"
+    SYMLINK = "l"
+
+    __slots__ = ("kind", "mode", "size", "mtime_ns", "ino", "digest", "chunks", "pack")
+
+    def __init__(
+        self,
+        kind: str,
+        mode: int,
+        size: int,
+        mtime_ns: int,
+        ino: int,
+        digest: str,
+        chunks: list[bytes] | None = None,
+        pack: tuple[str, int, int] | None = None,
+    ) -> None:
+        self.kind = kind
+        self.mode = mode
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ino = ino # inode файла в источнике (ловит подмену файла с тем же размером и временем)
+        self.digest = digest # хеш содержимого у файлов (пустой если его копировало ядро), куда указывает - у симлинков
+        self.chunks = chunks # куски файла в хранилище (только у снимков)
+        self.pack = pack # где лежит упакованный мелкий файл: id пака, смещение, длина (только у зеркал)
+
+    # Record можно передать вместо os.stat_result туда, где нужны только права и время (FileMeta)
+
+    @property
+    def st_mode(self) -> int:
+        kind = {self.DIR: stat.S_IFDIR, self.SYMLINK: stat.S_IFLNK}.get(self.kind, stat.S_IFREG)
+        return kind | self.mode
+
+    @property
+    def st_mtime_ns(self) -> int:
+        return self.mtime_ns
+
+    @property
+    def st_atime_ns(self) -> int:
+        return self.mtime_ns
+
+    @classmethod
+    def of(
+        cls,
+        st: os.stat_result,
+        digest: str = "",
+        chunks: list[bytes] | None = None,
+        pack: tuple[str, int, int] | None = None,
+    ) -> "Record":
+        if stat.S_ISDIR(st.st_mode):
+            kind = cls.DIR
+        elif stat.S_ISLNK(st.st_mode):
+            kind = cls.SYMLINK
+        else:
+            kind = cls.FILE
+        return cls(kind, stat.S_IMODE(st.st_mode), st.st_size, st.st_mtime_ns, st.st_ino, digest, chunks, pack)
+
+class Manifest:
+    """
+    **Индекс приемника**
+
+    Для каждого пути хранит тип, права, размер, mtime_ns, inode источника и хеш содержимого.
+    Старый индекс (old) переливается при старте во временную базу на диске (см. RecordIndex), новый (new)
+    набирается там же писателем по ходу бэкапа. В конце они сливаются по порядку путей во временный файл,
+    который атомарно подменяет старый. Поэтому упавший посреди бэкапа процесс оставляет приемник
+    со старым, но целым индексом, а память не зависит от числа путей
+
+    Формат - текст: заголовок, затем строка на путь
+    kind<TAB>mode<TAB>size<TAB>mtime_ns<TAB>ino<TAB>digest<TAB>path
+
+    **Журнал**
+
+    Пока проход идет, всё сделанное дописывается в журнал рядом: готовые файлы (строкой
+    индекса), удаленные пути и докуда записаны недописанные файлы. Дошедший до конца
+    проход журнал удаляет. Иначе следующий запуск накладывает журнал на старый индекс
+    и не повторяет уже сделанное. Проходы по изменениям (см. Watcher) индекс не переписывают,
+    их итог копится в журнале до следующего полного прохода (см. advance). Строки журнала:
+    done<TAB><строка индекса>
+    drop<TAB>path
+    part<TAB>offset<TAB>size<TAB>mtime_ns<TAB>ino<TAB>path
+    """
+
+    HEADER = "ark-manifest 1"
+    JOURNAL_HEADER = "ark-journal 1"
+
+    def __init__(self, path: str, source: str | None = None, journal: str | None = None) -> None:
+        """
+        path - куда пишется новый индекс, source - откуда читается старый (по умолчанию оттуда же),
+        journal - где ведется журнал (None - без журнала)
+        """
+
+        self.path = path
+        self.old = self._load(source or path) # удаленные из приемника пути из него выбрасываются
+        self.new = RecordIndex()
+
+        self.journaled = PathSet() # пути, уже сделанные прерванным проходом
+        self.partial: dict[str, tuple[int, int, int, int]] = {} # недописанные файлы: offset, size, mtime_ns, ino
+        self._journal_path = journal
+        self._journal = None
+        if journal is not None:
+            self._open_journal(journal, self._replay(journal))
+
+    def change(self, entry: Entry) -> tuple[Change, Record | None]:
+        """
+        Сравнивает элемент источника с тем, что лежит в приемнике по версии индекса.
+        Запись из индекса тоже возвращается - писателю незачем искать ее второй раз
+        """
+
+        old = self.old.get(entry.rel)
+        new = Record.of(entry.st)
+        if (old is None or old.kind != new.kind or old.size != new.size
+                or old.mtime_ns != new.mtime_ns or old.ino != new.ino):
+            return Change.DATA, old
+        if old.mode != new.mode:
+            return Change.META, old
+        return Change.SAME, old
+
+    def add(
+        self,
+        rel: str,
+        st: os.stat_result,
+        digest: str = "",
+        chunks: list[bytes] | None = None,
+        pack: tuple[str, int, int] | None = None,
+    ) -> None:
+        record = self.new[rel] = Record.of(st, digest, chunks, pack)
+        # время папок ставится в самом конце прохода, так что прерванный проход их не доделал
+        if self._journal is not None and record.kind != Record.DIR:
+            self._journal.write("done\t" + self._dump(rel, record))
+
+    def keep(self, rel: str, record: Record | None = None) -> None:
+        """Переносит запись из старого индекса в новый как есть (если она там была, record - она сама)"""
+
+        record = record or self.old.get(rel)
+        if record is not None:
+            self.new[rel] = record
+
+    def drop(self, rel: str) -> None:
+        self.old.discard(rel)
+        if self._journal is not None:
+            self._journal.write(f"drop\t{self._escape(rel)}\n")
+
+    def unseen(self, reverse: bool = False, within: dict[str, bool] | None = None) -> Iterator[tuple[str, Record]]:
+        """
+        Пути старого индекса (с записями), до которых в этом проходе дело не дошло, по порядку путей.
+        Пока они перебираются, текущий путь можно переносить в новый индекс или выбрасывать.
+        within - только среди этих путей (путь -> вместе ли со всем содержимым, см. Watcher):
+        тогда перебор стоит по их числу, а не по всему индексу
+        """
+
+        if within is None:
+            for rel, old, new in self._join(reverse):
+                if new is None:
+                    yield rel, old
+            return
+
+        rels = set()
+        for rel, recursive in within.items():
+            if recursive:
+                rels.update(r for r, _ in self.old.items(rel) if r == rel or r.startswith(rel + "/"))
+            elif rel in self.old:
+                rels.add(rel)
+        for rel in sorted(rels, reverse=reverse):
+            record = self.old.get(rel)
+            if record is not None and rel not in self.new:
+                yield rel, record
+
+    def save(self) -> None:
+        """
+        **Атомарно записывает новый индекс**
+
+        Всё, до чего не дошли (например, источник, который в этот раз не бэкапился), переносится
+        из старого индекса. Файлы прохода приемник сбрасывает на диск еще при закрытии, так что
+        здесь fsync нужен только самому индексу и его папке - после подмены. Журнал после этого
+        больше не нужен
+        """
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + Constants.TMP_SUFFIX.value
+        with open(tmp, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+            f.write(self.HEADER + "\n")
+            for rel, old, new in self._join():
+                f.write(self._dump(rel, new or old))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._sync_dir(os.path.dirname(self.path))
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            os.unlink(self._journal_path)
+
+    @staticmethod
+    def _sync_dir(path: str) -> None:
+        """Сбрасывает на диск саму папку - иначе после сбоя переименование в ней может потеряться"""
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return # например, Windows: папку так не открыть, но и fsync ей там не нужен
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def advance(self) -> None:
+        """
+        **Итог прохода по изменениям - без переписывания всего индекса**
+
+        Журнал дополняется папками (их время ставится в конце прохода, поэтому add их туда
+        не пишет) и сбрасывается на диск: следующий запуск наложит его на старый индекс, как после
+        прерванного прохода. Индекс перепишет и журнал удалит только следующий полный проход
+        """
+
+        if self._journal is None:
+            return
+        for rel, record in self.new.items():
+            if record.kind == Record.DIR:
+                self._journal.write("done\t" + self._dump(rel, record))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def carry(self) -> None:
+        """
+        Готовит индекс к следующему проходу того же приемника (см. DestinationWriter.successor):
+        новый индекс вливается в старый, а после save журнал начинается заново
+        """
+
+        self.old.update(self.new.items())
+        self.new = RecordIndex()
+        if self._journal is None and self._journal_path is not None:
+            self.journaled.clear() # всё это уже в сохраненном индексе
+            self.partial = {}
+            self._open_journal(self._journal_path, False)
+
+    def follow(self, journal: str) -> None:
+        """Накладывает журнал на старый индекс, не открывая его на запись (его может вести идущий бэкап)"""
+
+        self._replay(journal)
+
+    def checkpoint(self, rel: str, offset: int, st: os.stat_result) -> None:
+        """Отмечает, что первые offset байт файла уже на диске (файл должен быть сброшен заранее)"""
+
+        if self._journal is None:
+            return
+        self._journal.write(f"part\t{offset}\t{st.st_size}\t{st.st_mtime_ns}\t{st.st_ino}\t{self._escape(rel)}\n")
+        self._journal.flush()
+
+    def suspend(self) -> None:
+        """Проход не дошел до конца: индекс остается старым, а журнал сбрасывается на диск"""
+
+        if self._journal is None:
+            return
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal.close()
+        self._journal = None
+
+    def _join(self, reverse: bool = False) -> Iterator[tuple[str, Record | None, Record | None]]:
+        """
+        **Слияние старого и нового индексов**
+
+        Оба обходятся по порядку путей одновременно, как при сортировке слиянием, так что
+        сравнение двух деревьев не держит в памяти ни одно из них. Выдает каждый путь
+        с записями из старого и нового индексов (None - там его нет)
+        """
+
+        old, new = self.old.items(reverse=reverse), self.new.items(reverse=reverse)
+        o, n = next(old, None), next(new, None)
+        while o is not None or n is not None:
+            if o is not None and n is not None and o[0] == n[0]:
+                yield o[0], o[1], n[1]
+                o, n = next(old, None), next(new, None)
+            elif n is None or o is not None and (o[0] > n[0]) == reverse:
+                yield o[0], o[1], None
+                o = next(old, None)
+            else:
+                yield n[0], None, n[1]
+                n = next(new, None)
+
+    def _replay(self, path: str) -> bool:
+        """
+        Накладывает журнал прерванного прохода на старый индекс.
+        Возвращает, можно ли его дописывать дальше (иначе он начинается заново)
+        """
+
+        try:
+            f = open(path, encoding="utf-8", errors="surrogateescape", newline="\n")
+        except FileNotFoundError:
+            return False
+
+        with f:
+            if f.readline().rstrip("\n") != self.JOURNAL_HEADER:
+                return False
+            for line in f:
+                if not line.endswith("\n"):
+                    return False # оборванная последняя строка
+                kind, _, rest = line.partition("\t")
+                try:
+                    if kind == "done":
+                        rel, record = self._parse(rest)
+                        self.old[rel] = record
+                        self.journaled.add(rel)
+                        self.partial.pop(rel, None)
+                    elif kind == "drop":
+                        self.old.discard(self._unescape(rest.rstrip("\n")))
+                    elif kind == "part":
+                        offset, size, mtime_ns, ino, rel = rest.rstrip("\n").split("\t", 4)
+                        self.partial[self._unescape(rel)] = (int(offset), int(size), int(mtime_ns), int(ino))
+                    else:
+                        raise ValueError(f"unknown journal record '{kind}'")
+                except ValueError as e:
+                    ColorPrinter.red(f"journal '{path}' is damaged, the rest is ignored: {e}")
+                    return False
+        return True
+
+    def _open_journal(self, path: str, append: bool) -> None:
+        """
+        Журнал только дописывается: новый проход продолжает журнал прерванного.
+        Испорченный журнал переписывается заново - уже прочитанное из него при этом
+        сразу переносится, чтобы не потеряться при следующем прерывании
+        """
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._journal = open(path, "a" if append else "w", encoding="utf-8", errors="surrogateescape", newline="\n")
+        if append:
+            return
+        self._journal.write(self.JOURNAL_HEADER + "\n")
+        for rel in self.journaled:
+            self._journal.write("done\t" + self._dump(rel, self.old[rel]))
+        for rel, (offset, size, mtime_ns, ino) in self.partial.items():
+            self._journal.write(f"part\t{offset}\t{size}\t{mtime_ns}\t{ino}\t{self._escape(rel)}\n")
+
+    def _dump(self, rel: str, r: Record) -> str:
+        return f"{r.kind}\t{r.mode}\t{r.size}\t{r.mtime_ns}\t{r.ino}\t{self._escape(r.digest)}\t{self._escape(rel)}\n"
+
+    def _parse(self, line: str) -> tuple[str, Record]:
+        kind, mode, size, mtime_ns, ino, digest, rel = line.rstrip("\n").split("\t", 6)
+        return self._unescape(rel), Record(kind, int(mode), int(size), int(mtime_ns), int(ino), self._unescape(digest))
+
+    def _load(self, path: str) -> "RecordIndex":
+        """Битый или чужой индекс не страшен - просто всё будет скопировано заново"""
+
+        records = RecordIndex()
+        try:
+            with open(path, encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+                parse = self._parser(f.readline().rstrip("\n"))
+                if parse is None:
+                    raise ValueError("unknown format")
+                records.update(map(parse, f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            ColorPrinter.red(f"ignoring broken manifest '{path}': {e}")
+            records.clear()
+        return records
+
+    def _parser(self, header: str) -> Callable[[str], tuple[str, Record]] | None:
+        """Чем разбирать строки индекса с таким заголовком (None - формат не поддерживается)"""
+
+        return self._parse if header == self.HEADER else None
+
+    _UNESCAPE = {"n": "\n", "t": "\t"}
+
+    @classmethod
+    def _escape(cls, text: str) -> str:
+        """Перевод строки или табуляция в имени файла сломали бы построчный формат"""
+
+        return text.replace("\\", "\\\\").replace("\n", "\\n").replace("\t", "\\t")
+
+    @classmethod
+    def _unescape(cls, text: str) -> str:
+        if "\\" not in text:
+            return text
+        return re.sub(r"\\(.)", lambda m: cls._UNESCAPE.get(m.group(1), m.group(1)), text)
+
+class Snapshot(Manifest):
+    """
+    **Снимок хранилища**
+
+    Тот же индекс, только у файлов добавлена колонка со списком кусков (hex через запятую)
+    перед путем. Каждый проход пишет новый снимок рядом со старыми, а сравнивает источник
+    с последним из них - неизменившиеся файлы просто забирают его списки кусков
+    """
+
+    HEADER = "ark-snapshot 1"
+    SUFFIX = ".snap"
+
+    def __init__(self, snapshots_dir: str, journal: str | None = None, name: str | None = None) -> None:
+        """name - какой снимок читать (по умолчанию последний)"""
+
+        self.dir = snapshots_dir
+        names = self.names(snapshots_dir)
+        name = name or (names[-1] if names else Stamp.unique(snapshots_dir, self.SUFFIX))
+        super().__init__(os.path.join(snapshots_dir, name), journal=journal)
+
+    @classmethod
+    def names(cls, snapshots_dir: str) -> list[str]:
+        """Имена снимков от старых к новым"""
+
+        if not os.path.isdir(snapshots_dir):
+            return []
+        return sorted(n for n in os.listdir(snapshots_dir) if n.endswith(cls.SUFFIX))
+
+    def save(self) -> None:
+        self.path = os.path.join(self.dir, Stamp.unique(self.dir, self.SUFFIX))
+        super().save()
+
+    def drop_unstored(self, store: "ChunkStore") -> None:
+        """Прерванный проход мог упасть раньше, чем индексы его паков попали на диск - такие файлы из журнала выбрасываются"""
+
+        for rel in self.journaled:
+            record = self.old.get(rel)
+            if record is not None and any(c not in store.index for c in record.chunks or ()):
+                self.old.discard(rel)
+                self.journaled.discard(rel)
+
+    def _dump(self, rel: str, r: Record) -> str:
+        chunks = ",".join(c.hex() for c in r.chunks or ())
+        return (f"{r.kind}\t{r.mode}\t{r.size}\t{r.mtime_ns}\t{r.ino}\t{self._escape(r.digest)}"
+                f"\t{chunks}\t{self._escape(rel)}\n")
+
+    def _parse(self, line: str) -> tuple[str, Record]:
+        kind, mode, size, mtime_ns, ino, digest, chunks, rel = line.rstrip("\n").split("\t", 7)
+        chunk_ids = [bytes.fromhex(c) for c in chunks.split(",")] if chunks else None
+        return self._unescape(rel), Record(
+            kind, int(mode), int(size), int(mtime_ns), int(ino), self._unescape(digest), chunk_ids)
+
+class MirrorManifest(Manifest):
+    """
+    **Индекс зеркала**
+
+    Тот же индекс, только у файлов добавлена колонка с местом в паке (pack_id:offset:length,
+    у обычных файлов пустая) перед путем - мелкие файлы зеркало может хранить в паках (см. PackFiles).
+    Индексы старого формата читаются как есть
+    """
+
+    HEADER = "ark-mirror 1"
+    JOURNAL_HEADER = "ark-mirror-journal 1"
+
+    def _dump(self, rel: str, r: Record) -> str:
+        pack = ":".join(map(str, r.pack)) if r.pack else ""
+        return (f"{r.kind}\t{r.mode}\t{r.size}\t{r.mtime_ns}\t{r.ino}\t{self._escape(r.digest)}"
+                f"\t{pack}\t{self._escape(rel)}\n")
+
+    def _parse(self, line: str) -> tuple[str, Record]:
+        kind, mode, size, mtime_ns, ino, digest, pack, rel = line.rstrip("\n").split("\t", 7)
+        location = None
+        if pack:
+            pack_id, offset, length = pack.split(":")
+            location = (pack_id, int(offset), int(length))
+        return self._unescape(rel), Record(
+            kind, int(mode), int(size), int(mtime_ns), int(ino), self._unescape(digest), pack=location)
+
+    def _parser(self, header: str) -> Callable[[str], tuple[str, Record]] | None:
+        if header == Manifest.HEADER:
+            return super()._parse
+        return super()._parser(header)
+
+    def drop_torn(self, sizes: dict[str, int]) -> None:
+        """Прерванный проход мог упасть раньше, чем его пак дописался на диск (sizes - размеры паков, см. PackFiles)"""
+
+        for rel in self.journaled:
+            record = self.old.get(rel)
+            if record is not None and record.pack is not None and sizes.get(record.pack[0], 0) < record.pack[1] + record.pack[2]:
+                self.old.discard(rel)
+                self.journaled.discard(rel)
+
+class RecordIndex:
+    """
+    **Записи индекса (путь -> Record) в ограниченной памяти**
+
+    Пока путей немного (до Constants.INDEX_MEMORY), они лежат в словаре. Индекс побольше
+    переезжает во временную базу sqlite на диске (ее файл удаляется сам при закрытии): в памяти
+    тогда остаются только кеш базы (CACHE_MIB) и последние записанные пути - они сбрасываются
+    в базу пачками по BATCH. Так на десятках миллионов путей память не растет, а на обычных
+    деревьях индекс не медленнее словаря
+
+    Обход всегда идет по порядку путей (из базы - порциями по BATCH, каждая отдельным запросом
+    от последнего выданного пути). Поэтому два индекса сравниваются слиянием (см. Manifest._join),
+    а текущий путь можно менять или выбрасывать прямо во время обхода. В базе пути лежат
+    байтами utf-8 с surrogatepass - у них тот же порядок, что и у строк питона
+
+    Каждый запрос к базе отпускает GIL, и потоки бэкапа начинают за него толкаться. Поэтому
+    читатель перед сравнением пачки элементов источника достает их записи одним запросом (prefetch)
+    """
+
+    BATCH = 1000
+    CACHE_MIB = 16
+    SELECT = "SELECT rel, value FROM records"
+    _MISSING = object()
+
+    def __init__(self) -> None:
+        self._memory: dict = {} # весь индекс, а после переезда в базу - еще не сброшенные в нее записи
+        self._sorted: list[str] | None = None # пути словаря по порядку (сбрасывается при добавлении новых)
+        self._fetched: dict = {} # записи последней пачки prefetch (None - такого пути в базе нет)
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock() # пишет в индекс один поток, а читать его могут и другие
+
+    def get(self, rel: str, default: Record | None = None) -> Record | None:
+        record = self._memory.get(rel)
+        if record is None and self._db is not None:
+            fetched = self._fetched
+            if rel in fetched:
+                record = fetched[rel]
+            else:
+                with self._lock:
+                    row = self._db.execute(self.SELECT + " WHERE rel = ?", (self._key(rel),)).fetchone()
+                record = self._loads(row[1]) if row is not None else None
+        return record if record is not None else default
+
+    def prefetch(self, rels: list[str]) -> None:
+        """Достает записи путей из базы одним запросом - get найдет их без нее, пока не придет следующая пачка"""
+
+        if self._db is None:
+            return
+        fetched = dict.fromkeys(rels)
+        keys = [self._key(rel) for rel in rels]
+        for i in range(0, len(keys), 500): # старые sqlite не берут больше 999 параметров
+            part = keys[i:i + 500]
+            with self._lock:
+                rows = self._db.execute(f"{self.SELECT} WHERE rel IN ({', '.join('?' * len(part))})", part).fetchall()
+            fetched.update((self._unkey(rel), self._loads(value)) for rel, value in rows)
+        self._fetched = fetched
+
+    def __getitem__(self, rel: str) -> Record:
+        record = self.get(rel)
+        if record is None:
+            raise KeyError(rel)
+        return record
+
+    def __setitem__(self, rel: str, record: Record) -> None:
+        if rel not in self._memory:
+            self._sorted = None
+        self._memory[rel] = record
+        self._fetched.pop(rel, None)
+        if len(self._memory) >= (self.BATCH if self._db is not None else Constants.INDEX_MEMORY.value):
+            self._flush()
+
+    def __contains__(self, rel: str) -> bool:
+        if rel in self._memory:
+            return True
+        if self._db is None:
+            return False
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM records WHERE rel = ?", (self._key(rel),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        if self._db is None:
+            return len(self._memory)
+        self._flush()
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        for rel, _ in self.items():
+            yield rel
+
+    def update(self, items: Iterable[tuple[str, Record]]) -> None:
+        for rel, record in items:
+            self[rel] = record
+
+    def discard(self, rel: str) -> None:
+        self._memory.pop(rel, None)
+        self._fetched.pop(rel, None)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM records WHERE rel = ?", (self._key(rel),))
+
+    def clear(self) -> None:
+        self._memory = {}
+        self._sorted = None
+        self._fetched = {}
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM records")
+
+    def items(self, prefix: str = "", reverse: bool = False) -> Iterator[tuple[str, Record]]:
+        """Записи путей, начинающихся с prefix, по порядку (reverse - в обратном: дети раньше своих папок)"""
+
+        if self._db is None:
+            yield from self._memory_items(prefix, reverse)
+            return
+
+        self._flush()
+        start = self._key(prefix) if prefix else b""
+        order, beyond = ("DESC", "<") if reverse else ("ASC", ">")
+        last = None
+        while True:
+            with self._lock:
+                if last is None:
+                    rows = self._db.execute(
+                        f"{self.SELECT} WHERE rel >= ? ORDER BY rel {order} LIMIT ?", (start, self.BATCH)).fetchall()
+                else:
+                    rows = self._db.execute(
+                        f"{self.SELECT} WHERE rel >= ? AND rel {beyond} ? ORDER BY rel {order} LIMIT ?",
+                        (start, last, self.BATCH)).fetchall()
+            for rel, value in rows:
+                if not rel.startswith(start):
+                    if reverse:
+                        continue # пути после поддерева
+                    return
+                yield self._unkey(rel), self._loads(value)
+            if len(rows) < self.BATCH:
+                return
+            last = rows[-1][0]
+
+    def _memory_items(self, prefix: str, reverse: bool) -> Iterator[tuple[str, Record]]:
+        """Обход словаря - по его сортированным путям, которые выдаются, если они всё еще в индексе"""
+
+        if self._sorted is None:
+            self._sorted = sorted(self._memory)
+        rels = self._sorted
+        first, end = 0, len(rels)
+        if prefix: # без префикса - все ключи, и они не обязаны быть строками (см. ChunkMap)
+            first = end = bisect.bisect_left(rels, prefix)
+            while end < len(rels) and rels[end].startswith(prefix):
+                end += 1
+
+        for i in range(end - 1, first - 1, -1) if reverse else range(first, end):
+            value = self._memory.get(rels[i], self._MISSING)
+            if value is self._MISSING:
+                # путь выбросили прямо во время обхода - или индекс уже переехал в базу
+                if self._db is None or rels[i] not in self:
+                    continue
+                value = self.get(rels[i])
+            yield rels[i], value
+
+    def _flush(self) -> None:
+        """Сбрасывает словарь в базу (при первом переезде создает ее)"""
+
+        if self._db is not None and not self._memory:
+            return
+        with self._lock:
+            if self._db is None:
+                self._db = sqlite3.connect("", isolation_level=None, check_same_thread=False)
+                self._db.execute(f"PRAGMA cache_size = -{self.CACHE_MIB * 1024}")
+                self._db.execute("PRAGMA journal_mode = OFF")
+                self._db.execute("CREATE TABLE records (rel BLOB PRIMARY KEY, value BLOB) WITHOUT ROWID")
+                self._db.execute("BEGIN") # база временная, фиксировать в ней нечего
+            self._db.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?)",
+                ((self._key(rel), self._dumps(value)) for rel, value in self._memory.items()))
+        self._memory = {}
+        self._sorted = None
+
+    @classmethod
+    def _key(cls, rel: str) -> bytes:
+        return rel.encode("utf-8", "surrogatepass")
+
+    @classmethod
+    def _unkey(cls, key: bytes) -> str:
+        return key.decode("utf-8", "surrogatepass")
+
+    def _dumps(self, r: Record) -> bytes:
+        # marshal - самое быстрое, что есть в stdlib, а переносимость формата временной базе не нужна
+        return marshal.dumps((r.kind, r.mode, r.size, r.mtime_ns, r.ino, r.digest, r.chunks, r.pack))
+
+    def _loads(self, value: bytes) -> Record:
+        return Record(*marshal.loads(value))
+
+class PathSet(RecordIndex):
+    """Множество путей - тот же RecordIndex, только без записей"""
+
+    def add(self, rel: str) -> None:
+        self[rel] = None
+
+    def _dumps(self, value: None) -> None:
+        return None
+
+    def _loads(self, value: None) -> None:
+        return None
+
+class PathMap(RecordIndex):
+    """Путь -> значение (строка или что угодно еще, что берет marshal), тот же RecordIndex"""
+
+    def _dumps(self, value: str) -> bytes:
+        return marshal.dumps(value)
+
+    def _loads(self, value: bytes) -> str:
+        return marshal.loads(value)
+
+class ChunkMap(PathMap):
+    """
+    hash куска -> (id пака, смещение, длина) - тот же RecordIndex, ключи - сами байты хеша.
+    Обход по префиксу тут не нужен, только get/in и обход целиком
+    """
+
+    @classmethod
+    def _key(cls, chunk_id: bytes) -> bytes:
+        return chunk_id
+
+    @classmethod
+    def _unkey(cls, key: bytes) -> bytes:
+        return key
+
+class StatMap(PathMap):
+    """(dev, ino, size, mtime_ns) -> (день последнего использования, хеш) для HashCache"""
+
+    @classmethod
+    def _key(cls, key: tuple[int, int, int, int]) -> bytes:
+        return marshal.dumps(key)
+
+    @classmethod
+    def _unkey(cls, key: bytes) -> tuple[int, int, int, int]:
+        return marshal.loads(key)
+
+class ChunkStore:
+    """
+    **Хранилище кусков с дедупликацией**
+
+    Раскладка в корне приемника:
+        ark-repo                    маркер формата
+        packs/<xx>/<id>.pack        куски подряд, пак закрывается после PACK_SIZE байт
+        packs/<xx>/<id>.idx         индекс пака: записи (hash, offset, length)
+        snapshots/<time>.snap       снимки (см. Snapshot)
+        journal                     журнал прерванного прохода (см. Manifest)
+
+    Индекс пака пишется только после fsync самого пака, а снимок - после всех паков,
+    поэтому пак без индекса (упали посреди записи) просто игнорируется
+    """
+
+    MARKER = "ark-repo 1"
+    PACK_SIZE = 128 * 1024 * 1024
+    IDX_RECORD = struct.Struct("<32sQI")
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.packs_dir = os.path.join(root, "packs")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        self._check_marker()
+
+        # hash куска -> (id пака, смещение, длина); у большого хранилища - во временной базе на диске
+        self.index = self._load_index()
+
+        self._pack = None # пак, в который сейчас дописываются куски
+        self._pack_id = ""
+        self._pack_entries: list[tuple[bytes, int, int]] = []
+
+    def add(self, chunk_id: bytes, data: bytes) -> bool:
+        """Кладет кусок в хранилище, если его там еще нет. Возвращает True если кусок новый"""
+
+        if chunk_id in self.index:
+            return False
+
+        if self._pack is None:
+            self._open_pack()
+        offset = self._pack.tell()
+        self._pack.write(data)
+        self._pack_entries.append((chunk_id, offset, len(data)))
+        self.index[chunk_id] = (self._pack_id, offset, len(data))
+
+        if offset + len(data) >= self.PACK_SIZE:
+            self.flush()
+        return True
+
+    def read(self, chunk_id: bytes) -> bytes:
+        pack_id, offset, length = self.index[chunk_id]
+        with open(self._pack_path(pack_id, ".pack"), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise RuntimeError(f"pack {pack_id} is truncated")
+        return data
+
+    def flush(self) -> None:
+        """Закрывает текущий пак: fsync данных, затем атомарная запись его индекса"""
+
+        if self._pack is None:
+            return
+
+        self._pack.flush()
+        os.fsync(self._pack.fileno())
+        self._pack.close()
+        self._pack = None
+
+        idx = self._pack_path(self._pack_id, ".idx")
+        with open(idx + Constants.TMP_SUFFIX.value, "wb") as f:
+            for entry in self._pack_entries:
+                f.write(self.IDX_RECORD.pack(*entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(idx + Constants.TMP_SUFFIX.value, idx)
+        self._pack_entries = []
+
+    def _open_pack(self) -> None:
+        self._pack_id = os.urandom(16).hex()
+        path = self._pack_path(self._pack_id, ".pack")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._pack = open(path, "wb")
+
+    def _pack_path(self, pack_id: str, suffix: str) -> str:
+        return os.path.join(self.packs_dir, pack_id[:2], pack_id + suffix)
+
+    def _load_index(self) -> ChunkMap:
+        index = ChunkMap()
+        if not os.path.isdir(self.packs_dir):
+            return index
+
+        for sub in os.scandir(self.packs_dir):
+            if not sub.is_dir():
+                continue
+            for item in os.scandir(sub.path):
+                if not item.name.endswith(".idx"):
+                    continue
+                pack_id = item.name[:-len(".idx")]
+                with open(item.path, "rb") as f:
+                    for chunk_id, offset, length in self.IDX_RECORD.iter_unpack(f.read()):
+                        index[chunk_id] = (pack_id, offset, length)
+        return index
+
+    def _check_marker(self) -> None:
+        """Пишем только в пустую папку или в уже существующее хранилище"""
+
+        marker = os.path.join(self.root, "ark-repo")
+        if os.path.exists(marker):
+            with open(marker, encoding="utf-8") as f:
+                if f.read().strip() != self.MARKER:
+                    raise RuntimeError(f"unsupported repository format: {self.root}")
+            return
+
+        if os.path.isdir(self.root) and os.listdir(self.root):
+            raise RuntimeError(f"not an ark repository (and not empty): {self.root}")
+        os.makedirs(self.root, exist_ok=True)
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(self.MARKER + "\n")
+
+class PackFiles:
+    """
+    **Паки мелких файлов зеркала**
+
+    Содержимое мелких файлов пишется подряд в паки .ark/packs/<id>.pack (пак закрывается
+    после PACK_SIZE байт), а где чей файл - записано в индексе зеркала (см. MirrorManifest).
+    Поэтому приемник видит несколько больших последовательных записей вместо
+    миллиона создаваемых файлов, а любой файл читается одним seek + read
+
+    Пак только дописывается. Место от изменившихся и удаленных файлов освобождает
+    зеркало, переупаковывая полупустые паки (см. MirrorWriter)
+    """
+
+    PACK_SIZE = 64 * 1024 * 1024
+    SUFFIX = ".pack"
+
+    def __init__(self, directory: str) -> None:
+        self.dir = directory
+        self.current = "" # id пака, в который сейчас дописываются файлы
+        self._pack = None
+
+    def add(self, data: bytes) -> tuple[str, int, int]:
+        """Дописывает файл в пак, возвращает его место: id пака, смещение, длина"""
+
+        if self._pack is None:
+            self.current = os.urandom(16).hex()
+            os.makedirs(self.dir, exist_ok=True)
+            self._pack = open(self.path(self.current), "wb")
+
+        location = (self.current, self._pack.tell(), len(data))
+        self._pack.write(data)
+        if self._pack.tell() >= self.PACK_SIZE:
+            self.flush()
+        return location
+
+    def read(self, pack_id: str, offset: int, length: int) -> bytes:
+        if pack_id == self.current and self._pack is not None:
+            self._pack.flush()
+        with open(self.path(pack_id), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise RuntimeError(f"pack {pack_id} is truncated")
+        return data
+
+    def flush(self) -> None:
+        """Закрывает текущий пак (с fsync) - следующий файл начнет новый"""
+
+        if self._pack is None:
+            return
+        self._pack.flush()
+        os.fsync(self._pack.fileno())
+        self._pack.close()
+        self._pack = None
+
+    def sizes(self) -> dict[str, int]:
+        """Размеры всех паков на диске"""
+
+        if not os.path.isdir(self.dir):
+            return {}
+        return {
+            item.name[:-len(self.SUFFIX)]: item.stat().st_size
+            for item in os.scandir(self.dir) if item.name.endswith(self.SUFFIX)}
+
+    def path(self, pack_id: str) -> str:
+        return os.path.join(self.dir, pack_id + self.SUFFIX)
+
+class TarStream:
+    """
+    **Tar-поток (PAX), который сразу сжимается параллельно (см. ParallelCompressor)**
+
+    Размер файла в заголовке берется из stat при обходе. Если файл успел измениться,
+    в архив попадает ровно столько байт, сколько обещано заголовком (лишнее отрезается,
+    недостающее добивается нулями), а end_file() сообщает об этом
+    """
+
+    def __init__(self, codec: str, sink: Callable[[bytes], None]) -> None:
+        self._compressor = ParallelCompressor(codec, sink)
+        self._offset = 0 # сколько байт tar-потока уже выдано
+        self._left = 0 # сколько байт данных текущего файла еще ждет заголовок
+
+    def add(self, entry: Entry, link: str = "") -> None:
+        """Заголовок элемента. Для файлов дальше должны идти write() и end_file()"""
+
+        st = entry.st
+        info = tarfile.TarInfo(entry.rel)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = st.st_mtime
+        info.uid, info.gid = st.st_uid, st.st_gid
+        if entry.is_dir:
+            info.type = tarfile.DIRTYPE
+        elif entry.is_symlink:
+            info.type = tarfile.SYMTYPE
+            info.linkname = link
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+            self._left = st.st_size
+        self._write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    def write(self, data: bytes) -> None:
+        if len(data) > self._left:
+            data = data[:self._left]
+        self._left -= len(data)
+        self._write(data)
+
+    def end_file(self) -> bool:
+        """Добивает данные файла до размера из заголовка и до границы блока tar"""
+
+        ok = self._left == 0
+        self._write(bytes(self._left))
+        self._left = 0
+        self._write(bytes(-self._offset % tarfile.BLOCKSIZE))
+        return ok
+
+    def close(self) -> None:
+        """Два нулевых блока в конце архива и добивка до размера записи, как у tarfile"""
+
+        self._write(bytes(2 * tarfile.BLOCKSIZE))
+        self._write(bytes(-self._offset % tarfile.RECORDSIZE))
+        self._compressor.close()
+
+    def _write(self, data: bytes) -> None:
+        if data:
+            self._offset += len(data)
+            self._compressor.write(data)
+
+class ParallelCompressor:
+    """
+    **Сжатие потока на всех ядрах, как у pigz**
+
+    Поток режется на блоки, каждый блок сжимается в пуле потоков в отдельный
+    самостоятельный член (gzip member / bz2 stream / xz stream). Склеенные подряд
+    такие члены - корректный файл, который читают gzip/bzip2/xz и tarfile.
+    zlib, bz2 и lzma отпускают GIL, поэтому потоки действительно работают параллельно
+
+    Результаты отдаются в sink строго по порядку, а в работе одновременно не больше
+    2 * threads блоков - если sink не успевает, write() ждет
+    """
+
+    # расширение -> (функция сжатия, размер блока)
+    CODECS: dict[str, tuple[Callable[[bytes], bytes], int]] = {
+        "gz": (lambda data: gzip.compress(data, compresslevel=6, mtime=0), 1024 * 1024),
+        "bz2": (lambda data: bz2.compress(data, compresslevel=9), 900 * 1000),
+        "xz": (lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, preset=6), 8 * 1024 * 1024),
+    }
+
+    def __init__(self, codec: str, sink: Callable[[bytes], None], threads: int | None = None) -> None:
+        self._compress, self._block_size = self.CODECS[codec]
+        self._sink = sink
+        self._threads = threads or os.cpu_count() or 1
+        self._pool = concurrent.futures.ThreadPoolExecutor(self._threads, thread_name_prefix="ark-compress")
+        self._pending: collections.deque = collections.deque()
+        self._buf = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._buf += data
+        if len(self._buf) < self._block_size:
+            return
+
+        view = memoryview(self._buf)
+        pos = 0
+        while len(self._buf) - pos >= self._block_size:
+            self._submit(bytes(view[pos:pos + self._block_size]))
+            pos += self._block_size
+        view.release()
+        del self._buf[:pos]
+
+    def close(self) -> None:
+        """Дожимает хвост и отдает всё, что еще в работе"""
+
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._sink(self._pending.popleft().result())
+        self._pool.shutdown()
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._pool.submit(self._compress, block))
+        while len(self._pending) > 2 * self._threads:
+            self._sink(self._pending.popleft().result())
+
+class Chunker:
+    """
+    **Content-defined нарезка файлов на куски**
+
+    Граница куска ставится там, где rolling hash последних WINDOW байт имеет MASK_BITS нулевых бит,
+    то есть зависит только от содержимого. Вставка или удаление байтов в середине файла
+    меняет только соседние куски, остальные совпадут с уже лежащими в хранилище
+
+    Побайтовый цикл на питоне слишком медленный, поэтому hash считается для целого отрезка
+    длинной арифметикой: translate превращает каждый байт в случайное 8-битное значение,
+    а XOR по окну - это log2(WINDOW) сдвигов всего числа. Несколько таких дорожек
+    с разными таблицами дают нужное число бит. Ищется граница только начиная с MIN_SIZE
+    """
+
+    MIN_SIZE = 512 * 1024
+    MAX_SIZE = 8 * 1024 * 1024
+    MASK_BITS = 19 # средний кусок ~ MIN_SIZE + 2^MASK_BITS
+    WINDOW = 64 # должно быть степенью двойки
+    STEP = 256 * 1024 # по сколько байт за раз ищется граница
+
+    # таблицы не должны меняться никогда, иначе пропадет дедупликация со старыми бэкапами
+    _TABLES = [hashlib.shake_256(f"ark chunker lane {i}".encode()).digest(256) for i in range((MASK_BITS + 7) // 8)]
+
+    @classmethod
+    def split(cls, f, read_size: int) -> Iterator[bytes]:
+        """Режет открытый файл на куски"""
+
+        buf = bytearray()
+        head = 0 # начало текущего куска в буфере (сдвигать буфер после каждого куска дорого)
+        eof = False
+        while True:
+            while not eof and len(buf) - head < cls.MAX_SIZE:
+                block = f.read(read_size)
+                if block:
+                    buf += block
+                else:
+                    eof = True
+            if head == len(buf):
+                return
+            cut = cls._cut(buf, head)
+            yield bytes(buf[head:cut])
+            head = cut
+            if head >= cls.MAX_SIZE:
+                del buf[:head]
+                head = 0
+
+    @classmethod
+    def _cut(cls, buf: bytearray, head: int) -> int:
+        """Конец куска, который начинается в буфере с head"""
+
+        limit = min(len(buf), head + cls.MAX_SIZE)
+        pos = head + cls.MIN_SIZE - 1
+        while pos < limit:
+            end = min(pos + cls.STEP, limit)
+            found = cls._find(buf, pos, end)
+            if found >= 0:
+                return found + 1
+            pos = end
+        return limit
+
+    @classmethod
+    def _find(cls, buf: bytearray, start: int, end: int) -> int:
+        """Первая позиция в [start, end), на которой заканчивается окно с нужным hash, или -1"""
+
+        lo = start - cls.WINDOW + 1
+        seg = buf[lo:end]
+        n = len(seg)
+
+        acc = 0
+        bits = cls.MASK_BITS
+        for table in cls._TABLES:
+            x = int.from_bytes(seg.translate(table), "little")
+            shift = 8
+            while shift < 8 * cls.WINDOW:
+                x ^= x << shift # после всех шагов байт i = XOR значений байтов i-WINDOW+1..i
+                shift <<= 1
+            if bits < 8:
+                x &= cls._lane_mask(bits, n)
+            acc |= x
+            bits -= 8
+
+        # нулевой байт acc - все дорожки в этой позиции нулевые (старшие байты - хвосты сдвигов)
+        found = acc.to_bytes(n + cls.WINDOW, "little").find(0, cls.WINDOW - 1, n)
+        return -1 if found < 0 else lo + found
+
+    @classmethod
+    @functools.cache
+    def _lane_mask(cls, bits: int, n: int) -> int:
+        """Число, у которого в каждом из n байт взведены младшие bits бит"""
+
+        return int.from_bytes(bytes([(1 << bits) - 1]) * n, "little")
+
+class Signature:
+    """
+    **Подписи блоков файла для поблочного обновления**
+
+    Файл режется на блоки по BLOCK байт с начала, у каждого блока - короткий blake2b.
+    Сравниваются блоки на тех же местах: образы дисков и базы данных меняются
+    по месту, а не сдвигаются. Подписи копии в приемнике хранятся рядом с ним,
+    поэтому для сравнения саму копию перечитывать не нужно
+
+    Файл подписей: заголовок (magic, размер блока, размер и mtime_ns копии,
+    для которой они посчитаны), затем подписи подряд. Если копия с тех пор
+    поменялась (не совпали размер или mtime), подписи не используются
+    """
+
+    BLOCK = 128 * 1024
+    DIGEST_SIZE = 16
+    HEADER = struct.Struct("<4sIQq")
+    MAGIC = b"arks"
+
+    @classmethod
+    def of(cls, data: bytes) -> list[bytes]:
+        view = memoryview(data)
+        return [hashlib.blake2b(view[i:i + cls.BLOCK], digest_size=cls.DIGEST_SIZE).digest()
+                for i in range(0, len(data), cls.BLOCK)]
+
+    @classmethod
+    def path(cls, root: str, rel: str) -> str:
+        """Где лежат подписи копии rel в приемнике root"""
+
+        name = hashlib.sha1(rel.encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(root, Constants.META_DIR.value, "sigs", name[:2], name + ".sig")
+
+    @classmethod
+    def load(cls, sig_path: str, file_path: str) -> list[bytes] | None:
+        """Подписи копии file_path или None, если их нет или они от другой версии копии"""
+
+        try:
+            st = os.lstat(file_path)
+            with open(sig_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or len(data) < cls.HEADER.size:
+            return None
+
+        magic, block, size, mtime_ns = cls.HEADER.unpack_from(data)
+        body = data[cls.HEADER.size:]
+        if (magic != cls.MAGIC or block != cls.BLOCK or size != st.st_size or mtime_ns != st.st_mtime_ns
+                or len(body) != -(-size // cls.BLOCK) * cls.DIGEST_SIZE):
+            return None
+        return [body[i:i + cls.DIGEST_SIZE] for i in range(0, len(body), cls.DIGEST_SIZE)]
+
+    @classmethod
+    def save(cls, sig_path: str, file_path: str, sigs: list[bytes]) -> None:
+        """Атомарно пишет подписи уже готовой копии file_path"""
+
+        st = os.stat(file_path)
+        os.makedirs(os.path.dirname(sig_path), exist_ok=True)
+        tmp = sig_path + Constants.TMP_SUFFIX.value
+        with open(tmp, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.BLOCK, st.st_size, st.st_mtime_ns))
+            f.write(b"".join(sigs))
+        os.replace(tmp, sig_path)
+
+class Verifier:
+    """
+    **Проверяет, что в приемниках лежит то же, что в источниках**
+
+    Сравниваются файлы, которые по версии индекса приемника не менялись с последнего
+    бэкапа: хеши источника и копии должны совпасть. Хеши считает пул потоков
+    (hashlib отпускает GIL на больших блоках, так что параллельно по-настоящему),
+    а для обычных файлов они еще и кешируются (см. HashCache) - повторная проверка
+    читает только изменившееся
+    """
+
+    def __init__(
+        self,
+        sources: list[str],
+        destinations: list[str],
+        snapshots: bool = False,
+        fmt: Format = Format.MIRROR,
+        threads: int = Constants.VERIFY_THREADS.value,
+        cache: bool = True,
+        scan_threads: int = Constants.SCAN_THREADS.value,
+        git: bool = False,
+    ) -> None:
+        """git - источники бэкапились с --git: сверяются бандлы из кеша (см. GitBundles), а не .git"""
+
+        self.sources = [os.path.abspath(s) for s in sources]
+        self.destinations = [os.path.abspath(d) for d in destinations]
+        self.snapshots = snapshots
+        self.fmt = fmt
+        self.threads = threads
+        self.cache = HashCache(HashCache.default_path() if cache else None)
+        self.scan_threads = scan_threads
+        self.repos = GitBundles(GitBundles.default_path(), update=False) if git else None
+        self.errors: list[str] = []
+
+    def run(self) -> None:
+        """
+        **Запускает проверку**
+
+        Несовпадения и ошибки чтения собираются и выводятся в конце, если они есть - инициирует RuntimeError
+        """
+
+        for src in self.sources:
+            if not os.path.lexists(src):
+                raise RuntimeError(f"source not found: {src}")
+        replicas = [Replica(d, self.fmt, self.snapshots) for d in self.destinations]
+
+        # сколько файлов может ждать хешей - дальше обход источника подождет
+        pending: collections.deque = collections.deque()
+        limit = self.threads * 4
+
+        excluded = set(self.destinations) | ({self.repos.path} if self.repos is not None else set())
+        scanner = Scanner(self.scan_threads, excluded, self.repos)
+        pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="ark-verify")
+        try:
+            for src in self.sources:
+                ColorPrinter.blue(f"verifying '{src}'...")
+                for item in scanner.scan(src, Backup._top_name(src)):
+                    if isinstance(item, ScanError):
+                        self.errors.append(f"{item.path}: {item.error}")
+                    elif item.is_file:
+                        self._submit(item, replicas, pool, pending)
+                        while len(pending) > limit:
+                            self._check(*pending.popleft())
+            while pending:
+                self._check(*pending.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
+            self.cache.save()
+
+        for r in replicas:
+            ColorPrinter.green(
+                f"'{r.root}': {r.verified} files verified ({Humanize.size(r.bytes)}), {r.mismatched} mismatched, "
+                f"{r.changed} changed since backup, {r.missing} not in backup")
+
+        if self.errors:
+            for e in self.errors:
+                ColorPrinter.red(e)
+            raise RuntimeError(f"{len(self.errors)} problems found while verifying")
+
+    def _submit(self, entry: Entry, replicas: list["Replica"], pool: concurrent.futures.Executor,
+                pending: collections.deque) -> None:
+        """Ставит в пул хеши файла источника и его копий, которые есть смысл сравнивать"""
+
+        checks = []
+        for r in replicas:
+            record = r.records.get(entry.rel)
+            if record is None or record.kind != Record.FILE:
+                r.missing += 1
+            elif (record.size, record.mtime_ns, record.ino) != (entry.st.st_size, entry.st.st_mtime_ns, entry.st.st_ino):
+                r.changed += 1 # бэкап этого файла просто устарел, это не ошибка
+            else:
+                checks.append((r, r.submit(pool, self.cache, entry.rel, record)))
+
+        if checks:
+            pending.append((entry, pool.submit(self.cache.digest, entry.path).result, checks))
+
+    def _check(self, entry: Entry, source: Callable[[], str], checks: list[tuple["Replica", Callable[[], str]]]) -> None:
+        try:
+            expected = source()
+        except OSError as e:
+            self.errors.append(f"{entry.path}: {e}")
+            return
+
+        for r, copy in checks:
+            try:
+                digest = copy()
+            except Exception as e:
+                self.errors.append(f"'{r.root}': {entry.rel}: {e}")
+                r.mismatched += 1
+                continue
+            if digest != expected:
+                self.errors.append(f"'{r.root}': {entry.rel}: copy differs from source")
+                r.mismatched += 1
+            else:
+                r.verified += 1
+                r.bytes += entry.st.st_size
+
+class Replica:
+    """
+    **Бэкап в одном приемнике с точки зрения проверки и восстановления**
+
+    records - что в приемнике лежит по версии его индекса (у снимков и хранилищ - последнего),
+    submit() - как посчитать хеш копии файла, copy() - как достать копию файла
+    """
+
+    def __init__(self, root: str, fmt: Format, snapshots: bool, name: str | None = None) -> None:
+        """name - начало имени снимка или архива (по умолчанию берется последний)"""
+
+        self.root = root
+        self.fmt = fmt
+        self.verified = 0
+        self.bytes = 0
+        self.mismatched = 0
+        self.changed = 0
+        self.missing = 0
+
+        self._members: concurrent.futures.Future | None = None # хеши файлов архива (он читается один раз целиком)
+
+        if fmt is Format.REPO:
+            if not os.path.exists(os.path.join(root, "ark-repo")):
+                raise RuntimeError(f"not an ark repository: {root}")
+            self.store = ChunkStore(root)
+            names = Snapshot.names(self.store.snapshots_dir)
+            snapshot = self._pick(names, name, "snapshots")
+            self.location = os.path.join(self.store.snapshots_dir, snapshot)
+            manifest = Snapshot(self.store.snapshots_dir, name=snapshot)
+            if snapshot == names[-1]:
+                # проходы --watch после последнего снимка пока лежат только в журнале
+                manifest.follow(os.path.join(root, "journal"))
+                manifest.drop_unstored(self.store)
+            self.records = manifest.old
+        elif fmt is Format.ARCHIVE:
+            names = sorted(n for n in os.listdir(root) if self._is_archive(n)) if os.path.isdir(root) else []
+            self.archive = self.location = os.path.join(root, self._pick(names, name, "archives"))
+            self.records = Manifest(self.archive + ".manifest").old
+        else:
+            self.tree = root
+            if snapshots:
+                self.tree = os.path.join(root, self._pick(SnapshotWriter.names(root), name, "snapshots"))
+            self.location = self.tree
+            meta = os.path.join(self.tree, Constants.META_DIR.value)
+            if not os.path.exists(os.path.join(meta, "manifest")):
+                raise RuntimeError(f"no backup found in '{root}'")
+            self.packs = PackFiles(os.path.join(meta, "packs"))
+            manifest = MirrorManifest(os.path.join(meta, "manifest"))
+            manifest.follow(os.path.join(meta, "journal")) # проходы --watch после последнего полного
+            manifest.drop_torn(self.packs.sizes())
+            self.records = manifest.old
+
+    def submit(self, pool: concurrent.futures.Executor, cache: "HashCache", rel: str, record: Record) -> Callable[[], str]:
+        """Ставит в пул подсчет хеша копии rel, возвращает функцию, которая его дождется"""
+
+        if self.fmt is Format.REPO:
+            return pool.submit(self._repo_digest, record).result
+        if self.fmt is Format.ARCHIVE:
+            if self._members is None:
+                self._members = pool.submit(self._archive_digests)
+            return lambda: self._members.result().get(rel, "")
+        if record.pack is not None:
+            return pool.submit(self._pack_digest, record).result
+        return pool.submit(cache.digest, os.path.join(self.tree, *rel.split("/"))).result
+
+    def copy(self, rel: str, record: Record, dst: BinaryIO) -> None:
+        """Пишет содержимое копии файла rel в dst (кроме архивов - их читает только поток целиком)"""
+
+        if self.fmt is Format.REPO:
+            for chunk_id in record.chunks or ():
+                if chunk_id not in self.store.index:
+                    raise RuntimeError(f"chunk {chunk_id.hex()} is missing")
+                Sparse.write(dst, self.store.read(chunk_id))
+            dst.truncate(record.size)
+        elif record.pack is not None:
+            dst.write(self.packs.read(*record.pack))
+        else:
+            with open(os.path.join(self.tree, *rel.split("/")), "rb") as src:
+                FastCopy.copy(src.fileno(), dst.fileno())
+
+    def _pick(self, names: list[str], name: str | None, what: str) -> str:
+        """Последний из снимков (архивов), имя которого начинается с name"""
+
+        if name:
+            names = [n for n in names if n.startswith(name)]
+        if not names:
+            raise RuntimeError(f"no {what} found in '{self.root}'" + (f" matching '{name}'" if name else ""))
+        return names[-1]
+
+    @classmethod
+    def _is_archive(cls, name: str) -> bool:
+        stem, _, codec = name.partition(".tar.")
+        return codec in ParallelCompressor.CODECS and Stamp.PATTERN.fullmatch(stem) is not None
+
+    def _repo_digest(self, record: Record) -> str:
+        """Собирает файл из кусков, заодно проверяя каждый кусок по его хешу"""
+
+        digest = hashlib.new(Constants.HASH.value)
+        for chunk_id in record.chunks or ():
+            if chunk_id not in self.store.index:
+                raise RuntimeError(f"chunk {chunk_id.hex()} is missing")
+            data = self.store.read(chunk_id)
+            if hashlib.sha256(data).digest() != chunk_id:
+                raise RuntimeError(f"chunk {chunk_id.hex()} is corrupted")
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _pack_digest(self, record: Record) -> str:
+        """Мелкий файл читается из пака (кешировать тут нечего - пак не меняется)"""
+
+        return hashlib.new(Constants.HASH.value, self.packs.read(*record.pack)).hexdigest()
+
+    def _archive_digests(self) -> dict[str, str]:
+        """Хеши всех файлов архива за одно его чтение"""
+
+        digests = {}
+        with tarfile.open(self.archive, "r:*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                digest = hashlib.new(Constants.HASH.value)
+                f = tar.extractfile(member)
+                while block := f.read(Constants.BLOCK_SIZE.value):
+                    digest.update(block)
+                digests[member.name] = digest.hexdigest()
+        return digests
+
+class Restore:
+    """
+    **Восстанавливает выбранные пути из бэкапа в одном приемнике**
+
+    Пути ищутся прямо в индексе приемника: он упорядочен по путям, так что поддеревья
+    достаются из него по началу пути, а шаблоны (fnmatch, * матчит и через /) перебирают
+    только пути с их постоянным началом. Так что время зависит от того, сколько
+    восстанавливается, а не от размера бэкапа - дерево приемника не обходится.
+    Выбранное тоже копится на диске (см. RecordIndex) и перебирается несколько раз
+
+    Файлы копируются пулом потоков (из зеркал и снимков - через FastCopy, как при бэкапе),
+    архив читается один раз потоком. Файлы с одним inode в источнике (жесткие ссылки)
+    копируются один раз, остальные становятся ссылками на копию. Права и время ставятся
+    на место, папкам - в самом конце, после всего содержимого. git-репозитории,
+    сохраненные бандлами (--git), собираются из них заново (см. GitBundles.restore)
+    """
+
+    def __init__(
+        self,
+        backup: str,
+        target: str,
+        patterns: list[str],
+        fmt: Format = Format.MIRROR,
+        snapshots: bool = False,
+        name: str | None = None,
+        threads: int = Constants.RESTORE_THREADS.value,
+    ) -> None:
+        """
+        backup - приемник бэкапа, target - куда восстанавливать (пути внутри как в приемнике),
+        patterns - пути или шаблоны (пусто - всё), name - начало имени снимка или архива
+        """
+
+        self.backup = os.path.abspath(backup)
+        self.target = os.path.abspath(target)
+        self.patterns = [p.replace(os.sep, "/").strip("/") for p in patterns]
+        self.fmt = fmt
+        self.snapshots = snapshots
+        self.name = name
+        self.threads = max(1, threads)
+        self.errors: list[str] = []
+        self.files = 0
+        self.bytes = 0
+        self.links = 0
+        self.repos = 0
+        self._stop = threading.Event()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self) -> None:
+        """
+        **Запускает восстановление**
+
+        Ошибки отдельных путей не прерывают работу, а собираются и выводятся в конце - тогда инициирует RuntimeError
+        """
+
+        replica = Replica(self.backup, self.fmt, self.snapshots, self.name)
+        selected = self._select(replica.records)
+        total = len(selected)
+        if not total:
+            raise RuntimeError(f"nothing matches {' '.join(self.patterns)} in '{replica.location}'")
+        ColorPrinter.blue(f"restoring {total} paths from '{replica.location}' to '{self.target}'...")
+
+        dirs = symlinks = 0
+        repos = [] # папки бандлов (см. GitBundles)
+        files = PathSet() # файлы, которые копируются (остальные - жесткие ссылки на них)
+        first = PathMap() # inode в источнике (см. _inode) -> первый файл с ним
+        for rel, record in selected.items():
+            if record.kind == Record.DIR:
+                self._try(rel, os.makedirs, self._path(rel), exist_ok=True)
+                dirs += 1
+            elif record.kind == Record.FILE and self._inode(rel, record) not in first:
+                first[self._inode(rel, record)] = rel
+                files.add(rel)
+
+        if self.fmt is Format.ARCHIVE:
+            self._restore_archive(replica, selected, files)
+        else:
+            self._restore_files(replica, selected, files)
+        for rel, record in selected.items():
+            if record.kind == Record.SYMLINK:
+                self._try(rel, self._restore_symlink, rel, record)
+                symlinks += 1
+            elif record.kind == Record.FILE and (original := first[self._inode(rel, record)]) != rel:
+                self._try(rel, self._restore_link, replica, rel, record, original)
+            if rel.endswith(f"/{GitBundles.DIR}/{GitBundles.STATE}"):
+                repos.append(rel.rsplit("/", 1)[0])
+        rebuilt = set()
+        for rel in repos:
+            try:
+                GitBundles.restore(self._path(rel.rsplit("/", 1)[0]))
+            except (OSError, RuntimeError) as e:
+                self.errors.append(f"{rel}: {e}")
+                continue
+            rebuilt.add(rel)
+            self.repos += 1
+        # в обратном порядке дети идут раньше своих папок
+        for rel, record in selected.items(reverse=True):
+            if record.kind == Record.DIR and rel not in rebuilt:
+                self._try(rel, FileMeta.apply, self._path(rel), record)
+
+        ColorPrinter.green(
+            f"'{self.target}': {self.files} files restored ({Humanize.size(self.bytes)}), "
+            f"{self.links} hard links, {symlinks} symlinks, {dirs} dirs"
+            + (f", {self.repos} git repositories rebuilt" if self.repos else ""))
+        if self.errors:
+            for e in self.errors:
+                ColorPrinter.red(e)
+        if self.stopping:
+            raise RuntimeError("restore is interrupted")
+        if self.errors:
+            raise RuntimeError(f"{len(self.errors)} errors while restoring")
+
+    def _select(self, records: RecordIndex) -> RecordIndex:
+        """Записи индекса, которые подходят под шаблоны, вместе с содержимым подходящих папок"""
+
+        if not self.patterns:
+            return records
+
+        selected = RecordIndex()
+        dirs = PathSet()
+        for pattern in self.patterns:
+            literal = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+            if literal == pattern:
+                record = records.get(pattern)
+                matched = [(pattern, record)] if record is not None else []
+            else:
+                matched = ((rel, r) for rel, r in records.items(literal) if fnmatch.fnmatchcase(rel, pattern))
+            for rel, record in matched:
+                selected[rel] = record
+                if record.kind == Record.DIR:
+                    dirs.add(rel)
+
+        for rel in dirs:
+            selected.update(records.items(rel + "/"))
+        return selected
+
+    def _inode(self, rel: str, record: Record) -> str:
+        """У жестких ссылок общие inode, размер и время; источники могли лежать на разных ФС"""
+
+        return f"{rel.split('/')[0]}\0{record.ino}\0{record.size}\0{record.mtime_ns}"
+
+    def _restore_files(self, replica: Replica, selected: RecordIndex, files: PathSet) -> None:
+        # сколько файлов может ждать в пуле - дальше новые не ставятся
+        pending: collections.deque = collections.deque()
+        limit = self.threads * 4
+
+        pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="ark-restore")
+        try:
+            for rel in files:
+                if self.stopping:
+                    break
+                record = selected[rel]
+                pending.append((rel, record, pool.submit(self._restore_file, replica, rel, record)))
+                while len(pending) > limit:
+                    self._wait(*pending.popleft())
+            while pending:
+                self._wait(*pending.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
 
-        script_name = os.path.basename(__file__)
-        
-        usage = \
-f"""
-ark - hard drive backuper
+    def _restore_file(self, replica: Replica, rel: str, record: Record) -> None:
+        if self.stopping:
+            return
+        path = self._path(rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + Constants.TMP_SUFFIX.value, "wb") as dst:
+            replica.copy(rel, record, dst)
+        self._commit(path, record)
 
-Usage examples:
-    Backup files/folders (src) to multiple destinations:
-        {script_name} --src src1 src2 ... --dst dst1 dst2 ...
-"""
+    def _restore_archive(self, replica: Replica, selected: RecordIndex, wanted: PathSet) -> None:
+        """
+        Архив сжат потоком, поэтому читается один раз по порядку, а нужные файлы достаются по пути.
+        Найденные выбрасываются из wanted - в конце там остается то, чего в архиве не нашлось
+        """
 
-        def custom_print_help():
-            ColorPrinter.blue(usage)
+        left = len(wanted)
+        with tarfile.open(replica.archive, "r:*") as tar:
+            for member in tar:
+                if self.stopping or not left:
+                    break
+                if member.name not in wanted or not member.isfile():
+                    continue
+                wanted.discard(member.name)
+                left -= 1
 
-        def custom_error(message):
-            custom_print_help()
-            ColorPrinter.red(f"{message}")
-            sys.exit(1)
+                path = self._path(member.name)
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with tar.extractfile(member) as src, open(path + Constants.TMP_SUFFIX.value, "wb") as dst:
+                        while block := src.read(Constants.BLOCK_SIZE.value):
+                            Sparse.write(dst, block)
+                        dst.truncate(member.size)
+                    self._commit(path, selected[member.name])
+                    self._count(selected[member.name])
+                except OSError as e:
+                    self.errors.append(f"{member.name}: {e}")
+        if not self.stopping:
+            self.errors.extend(f"{rel}: not found in the archive" for rel in wanted)
 
-        parser.print_help = custom_print_help
-        parser.error = custom_error
+    def _restore_symlink(self, rel: str, record: Record) -> None:
+        path = self._path(rel)
+        tmp = path + Constants.TMP_SUFFIX.value
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(record.digest, tmp)
+        FileMeta.apply(tmp, record)
+        self._replace(tmp, path)
+
+    def _restore_link(self, replica: Replica, rel: str, record: Record, original: str) -> None:
+        path = self._path(rel)
+        tmp = path + Constants.TMP_SUFFIX.value
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(self._path(original), tmp)
+        except OSError:
+            # первая копия не восстановилась (или ФС без жестких ссылок) - копируем отдельно
+            self._restore_file(replica, rel, record)
+            self._count(record)
+            return
+        self._replace(tmp, path)
+        self.links += 1
+
+    def _commit(self, path: str, record: Record) -> None:
+        FileMeta.apply(path + Constants.TMP_SUFFIX.value, record)
+        self._replace(path + Constants.TMP_SUFFIX.value, path)
+
+    def _count(self, record: Record) -> None:
+        self.files += 1
+        self.bytes += record.size
+
+    def _replace(self, tmp: str, path: str) -> None:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path) # на этом месте сейчас папка
+        os.replace(tmp, path)
+
+    def _wait(self, rel: str, record: Record, future: concurrent.futures.Future) -> None:
+        try:
+            future.result()
+        except (OSError, RuntimeError) as e:
+            self.errors.append(f"{rel}: {str(e).rstrip()}")
+            return
+        if not self.stopping:
+            self._count(record)
 
-        parser.add_argument('--src', nargs='+', required=True)
-        parser.add_argument('--dst', nargs='+', required=True)
-        return parser.parse_args()
+    def _try(self, rel: str, func: Callable, *args, **kwargs) -> None:
+        try:
+            func(*args, **kwargs)
+        except OSError as e:
+            self.errors.append(f"{rel}: {e}")
+
+    def _path(self, rel: str) -> str:
+        return os.path.join(self.target, *rel.split("/"))
+
+class Watcher:
+    """
+    **Непрерывный бэкап: после полного прохода бэкапятся только изменившиеся пути**
+
+    Поток-читатель собирает события inotify (см. Inotify) в набор изменившихся путей.
+    Пачка уходит в бэкап, когда изменения затихли на delay секунд (но не позже MAX_DELAY
+    от первого изменения в пачке), так что сохраняемый частями файл копируется один раз.
+    Раз в rescan секунд (и когда ядро теряет события) проходится всё дерево - страховка
+    от того, чего inotify не видит: изменений на сетевых ФС, папок сверх лимита слежений.
+    Индексы приемников между полными проходами не переписываются и не перечитываются:
+    итог пачек копится в их журналах (см. DestinationWriter.successor)
+    """
+
+    MAX_DELAY = 60
+
+    def __init__(
+        self,
+        make_backup: Callable[[], Backup],
+        sources: list[str],
+        destinations: list[str],
+        delay: float = Constants.WATCH_DELAY.value,
+        rescan: float = Constants.RESCAN.value * 60,
+    ) -> None:
+        """make_backup - создает бэкап для очередного прохода (у каждого прохода свои писатели)"""
+
+        self.sources = [os.path.abspath(s) for s in sources]
+        self.excluded = {os.path.abspath(d) for d in destinations} # события в приемниках не интересны
+        self.delay = delay
+        self.rescan = rescan
+
+        self._make_backup = make_backup
+        self._backup: Backup | None = None # идущий сейчас проход
+        self._previous: Backup | None = None # прошлый проход, если он прошел без ошибок
+        self._stop = threading.Event()
+        self._cond = threading.Condition()
+        self._changes: dict[str, bool] = {} # путь -> изменилось ли всё его содержимое
+        self._first = 0.0 # когда в пачку попало первое изменение
+        self._last = 0.0 # и последнее
+        self._full = True # нужен полный проход
+        self._watches: dict[int, tuple[str, str]] = {} # слежение -> путь папки и ее путь в приемнике
+        self._limited = False # слежений не хватило на всё дерево
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def stop(self) -> None:
+        """Останавливает слежение и идущий проход. Можно звать из обработчика сигнала"""
+
+        self._stop.set()
+        if self._backup is not None:
+            self._backup.stop()
+
+    def run(self) -> None:
+        """
+        **Бэкапит, пока не остановят**
+
+        Ошибки проходов выводятся и не прерывают слежение - недоделанное подберет полный проход
+        """
+
+        inotify = Inotify()
+        reader = threading.Thread(target=self._read, args=(inotify,), name="ark-watch", daemon=True)
+        try:
+            # слежение ставится до первого прохода, чтобы не пропустить изменений во время него
+            for src in self.sources:
+                self._watch_tree(inotify, src, Backup._top_name(src))
+            reader.start()
+
+            next_full = 0.0
+            while True:
+                changes = self._wait(next_full)
+                if self.stopping:
+                    break
+                if changes is None:
+                    next_full = time.monotonic() + self.rescan
+                self._pass(changes)
+                if changes is None:
+                    ColorPrinter.blue("watching for changes...")
+        finally:
+            self._stop.set()
+            if reader.is_alive():
+                reader.join()
+            inotify.close()
 
     @classmethod
-    def main(cls) -> None:
-        def on_exit():
-            ColorPrinter.red("\nhandle exit signal")
-            sys.exit(1)
+    def inside(cls, changes: dict[str, bool], rel: str) -> bool:
+        """Лежит ли rel внутри папки, которая изменилась вместе со всем содержимым"""
 
-        SignalHandler(on_exit)
-        args = cls._args_parse()
+        parts = rel.split("/")
+        return any(changes.get("/".join(parts[:i])) for i in range(1, len(parts)))
+
+    def _wait(self, next_full: float) -> dict[str, bool] | None:
+        """Дожидается следующего прохода: изменившиеся пути или None, если пора пройти всё дерево"""
+
+        with self._cond:
+            while not self.stopping:
+                now = time.monotonic()
+                if self._full or now >= next_full:
+                    self._full = False
+                    self._changes = {}
+                    return None
+
+                timeout = next_full - now
+                if self._changes:
+                    ready = min(self._last + self.delay, self._first + self.MAX_DELAY)
+                    if now >= ready:
+                        changes, self._changes = self._changes, {}
+                        return changes
+                    timeout = min(timeout, ready - now)
+                # сигнал остановки ждать не должен
+                self._cond.wait(min(timeout, 1.0))
+        return None
+
+    def _pass(self, changes: dict[str, bool] | None) -> None:
+        """
+        Проход по изменениям продолжает состояние приемников прошлого прохода, если тот прошел
+        без ошибок (см. Backup.run). После ошибки оно читается с диска заново, вместе с журналом
+        """
+
+        backup = self._backup = self._make_backup()
+        previous, self._previous = self._previous, None
+        if self.stopping:
+            return
         try:
-            for src in args.src:
-                print(src)
-            for dst in args.dst:
-                print(dst)
-        except Exception as e:
+            backup.run(changes, previous)
+            self._previous = backup
+        except RuntimeError as e:
+            if self.stopping:
+                raise
             ColorPrinter.red(f"backuping error: {str(e).rstrip()}")
         finally:
-            ColorPrinter.blue("\nsee you later!")
+            self._backup = None
 
-class Backup:
-    pass
+    def _read(self, inotify: "Inotify") -> None:
+        while not self.stopping:
+            events = inotify.read(1.0)
+            with self._cond:
+                for wd, mask, name in events:
+                    self._event(inotify, wd, mask, name)
+
+    def _event(self, inotify: "Inotify", wd: int, mask: int, name: str) -> None:
+        if mask & Inotify.Q_OVERFLOW:
+            self._full = True # ядро потеряло события - остается только пройти всё дерево
+            self._cond.notify_all()
+            return
+        if mask & Inotify.IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        watch = self._watches.get(wd)
+        if watch is None:
+            return
+        path, rel = watch
+        if name:
+            path, rel = os.path.join(path, name), f"{rel}/{name}"
+            if path in self.excluded:
+                return
+            if mask & (Inotify.CREATE | Inotify.DELETE | Inotify.MOVED_FROM | Inotify.MOVED_TO):
+                self._add(watch[1], False) # у папки поменялось время
+
+        if mask & Inotify.ISDIR and mask & (Inotify.CREATE | Inotify.MOVED_TO):
+            # в новую папку до постановки слежения могли успеть что-то положить
+            self._watch_tree(inotify, path, rel)
+            self._add(rel, True)
+        elif mask & (Inotify.DELETE | Inotify.MOVED_FROM | Inotify.DELETE_SELF):
+            self._add(rel, True) # пропало вместе со всем содержимым
+        else:
+            self._add(rel, False)
+
+    def _add(self, rel: str, recursive: bool) -> None:
+        now = time.monotonic()
+        if not self._changes:
+            self._first = now
+        self._last = now
+        self._changes[rel] = self._changes.get(rel, False) or recursive
+        self._cond.notify_all()
+
+    def _watch_tree(self, inotify: "Inotify", path: str, rel: str) -> None:
+        """Ставит слежение на path и все папки внутри (у переехавших папок слежения просто обновляются)"""
+
+        self._watch(inotify, path, rel)
+        if os.path.islink(path) or not os.path.isdir(path):
+            return
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [
+                d for d in dirnames
+                if os.path.join(dirpath, d) not in self.excluded and not os.path.islink(os.path.join(dirpath, d))]
+            base = rel + "/" + os.path.relpath(dirpath, path).replace(os.sep, "/") if dirpath != path else rel
+            for d in dirnames:
+                if not self._watch(inotify, os.path.join(dirpath, d), f"{base}/{d}"):
+                    return
+
+    def _watch(self, inotify: "Inotify", path: str, rel: str) -> bool:
+        """Возвращает, стоит ли ставить слежения дальше"""
+
+        try:
+            self._watches[inotify.add(path, Inotify.CHANGES)] = (path, rel)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                if not self._limited:
+                    ColorPrinter.red(
+                        "inotify watch limit reached (sysctl fs.inotify.max_user_watches), "
+                        "the rest of the tree is backuped by full rescans only")
+                self._limited = True
+                return False
+            # пропавшее уже отмечено событием, а нечитаемое подберет полный проход
+        return True
+
+# bench
+
+class SyntheticTree:
+    """
+    **Воспроизводимое синтетическое дерево источника для замеров**
+
+    Одинаковые seed и scale дают одинаковое дерево: содержимое, размеры и время файлов.
+    В нем собрано то, на чем бэкап обычно и тормозит: много мелких файлов (половина
+    сжимается, половина - случайные байты), несколько огромных, разреженный образ,
+    глубокая вложенность, жесткие ссылки и симлинки. scale множит количества и размеры
+    """
+
+    SMALL_FILES = 20000
+    SMALL_MAX = 16 * 1024
+    HUGE_FILES = 2
+    HUGE_SIZE = 128 * 1024 * 1024
+    SPARSE_SIZE = 1024 * 1024 * 1024
+    SPARSE_EXTENTS = 8 # кусков данных по 1 МиБ в разреженном файле
+    DEPTH = 100
+    LINK_GROUPS = 200
+    MTIME = 1_600_000_000 # у всех файлов одно время, чтобы дерево не зависело от момента генерации
+    WORDS = b"ark backup mirror snapshot chunk pack journal manifest delta sparse restore watch ".split()
+
+    def __init__(self, root: str, seed: int = 1, scale: float = 1.0) -> None:
+        self.root = root
+        self.seed = seed
+        self.scale = scale
+        self.files = 0
+        self.bytes = 0
+
+    def generate(self) -> None:
+        if os.path.lexists(self.root):
+            shutil.rmtree(self.root)
+        rng = random.Random(self.seed)
+
+        for i in range(self._count(self.SMALL_FILES)):
+            # раскладка как у типичного проекта: сотня папок по паре десятков подпапок
+            self._write(os.path.join("small", f"{i % 100:02d}", f"{i // 100 % 20:02d}", f"f{i}"),
+                        self._content(rng, rng.randrange(self.SMALL_MAX), i % 2 == 0))
+
+        for i in range(self.HUGE_FILES):
+            path = self._path(os.path.join("huge", f"huge{i}.bin"))
+            with open(path, "wb") as f:
+                left = self._count(self.HUGE_SIZE)
+                while left:
+                    block = rng.randbytes(min(left, 8 * 1024 * 1024))
+                    f.write(block)
+                    left -= len(block)
+            self._done(path)
+
+        path = self._path(os.path.join("sparse", "disk.img"))
+        size = self._count(self.SPARSE_SIZE)
+        extent = min(1024 * 1024, size) # на малом scale файл может быть меньше куска
+        with open(path, "wb") as f:
+            f.truncate(size)
+            for _ in range(self.SPARSE_EXTENTS):
+                f.seek(rng.randrange(0, max(1, size - extent), 4096))
+                f.write(rng.randbytes(extent))
+        self._done(path)
+
+        parts = ["deep"]
+        for level in range(self.DEPTH):
+            parts.append(f"level{level}")
+            self._write(os.path.join(*parts, "file"), self._content(rng, 512, False))
+
+        for i in range(self._count(self.LINK_GROUPS)):
+            original = os.path.join("links", f"group{i}", "original")
+            self._write(original, self._content(rng, rng.randrange(self.SMALL_MAX), True))
+            for name in (os.path.join("links", f"group{i}", "link"), os.path.join("links", "all", f"group{i}")):
+                os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+                os.link(self._path(original), self._path(name))
+            os.symlink(os.path.join("..", f"group{i}", "original"), self._path(os.path.join("links", "symlinks", f"s{i}")))
+
+    def churn(self, fraction: float = 0.01) -> int:
+        """
+        Меняет долю fraction файлов так же воспроизводимо: большая часть переписывается,
+        часть удаляется, столько же появляется новых, а в одном огромном файле переписывается
+        1 МиБ посередине. Возвращает, сколько файлов тронуто
+        """
+
+        rng = random.Random(self.seed + 1)
+        files = sorted(
+            os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(os.path.join(self.root, "small")) for name in names)
+        touched = rng.sample(files, max(1, int(len(files) * fraction)))
+        mtime = self.MTIME + 86400
+        for n, path in enumerate(touched):
+            if n % 7 == 0:
+                os.unlink(path)
+                path += ".new" # вместо удаленного - новый файл рядом
+            with open(path, "wb") as f:
+                f.write(self._content(rng, rng.randrange(self.SMALL_MAX), n % 2 == 0))
+            os.utime(path, (mtime, mtime))
+
+        huge = self._path(os.path.join("huge", "huge0.bin"))
+        with open(huge, "r+b") as f:
+            f.seek(os.fstat(f.fileno()).st_size // 2)
+            f.write(rng.randbytes(1024 * 1024))
+        os.utime(huge, (mtime, mtime))
+        return len(touched) + 1
+
+    def _content(self, rng: random.Random, size: int, compressible: bool) -> bytes:
+        if not compressible:
+            return rng.randbytes(size)
+        text = b" ".join(rng.choices(self.WORDS, k=size // 6 + 1))
+        return text[:size]
+
+    def _write(self, rel: str, data: bytes) -> None:
+        path = self._path(rel)
+        with open(path, "wb") as f:
+            f.write(data)
+        self._done(path)
+
+    def _done(self, path: str) -> None:
+        os.utime(path, (self.MTIME, self.MTIME))
+        self.files += 1
+        self.bytes += os.path.getsize(path)
+
+    def _path(self, rel: str) -> str:
+        path = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _count(self, n: int) -> int:
+        return max(1, int(n * self.scale))
+
+class Bench:
+    """
+    **Замеры бэкапа на синтетическом дереве (см. SyntheticTree)**
+
+    Для каждого формата на свежем дереве по очереди замеряются: полный бэкап,
+    инкрементальный без изменений, инкрементальный после изменения 1% файлов
+    и полное восстановление - всё в локальные временные папки. Результаты можно
+    сохранить в JSON и сравнить со старыми: регрессия движка копирования видна
+    как число, а не как бэкап, который вдруг закончился к обеду
+
+    Файлы читаются из кеша страниц (дерево только что создано), так что замер -
+    про сам движок, а не про диск. С runs > 1 всё повторяется на свежем дереве
+    и берется лучшее время каждого замера - так меньше шума
+    """
+
+    REGRESSION = 1.1 # во сколько раз медленнее базового замера - уже регрессия
+
+    def __init__(
+        self,
+        directory: str | None = None,
+        formats: list[Format] | None = None,
+        seed: int = 1,
+        scale: float = 1.0,
+        runs: int = 1,
+        keep: bool = False,
+    ) -> None:
+        """directory - где создать временную папку для деревьев и приемников (удаляется в конце, если не keep)"""
+
+        self.directory = directory
+        self.formats = formats or [Format.MIRROR]
+        self.seed = seed
+        self.scale = scale
+        self.runs = max(1, runs)
+        self.keep = keep
+        self.results: list[dict] = []
+
+    def run(self, baseline: str | None = None, report: str | None = None) -> None:
+        """baseline - JSON прошлого замера, с которым сравнивать, report - куда записать этот"""
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        base = tempfile.mkdtemp(prefix="ark-bench-", dir=self.directory)
+        old = self._load(baseline) if baseline else {}
+        try:
+            for fmt in self.formats:
+                self._run_format(base, fmt, old)
+        finally:
+            if self.keep:
+                ColorPrinter.blue(f"trees and destinations are kept in '{base}'")
+            else:
+                shutil.rmtree(base, ignore_errors=True)
+
+        if report:
+            with open(report, "w", encoding="utf-8") as f:
+                json.dump({
+                    "seed": self.seed,
+                    "scale": self.scale,
+                    "runs": self.runs,
+                    "python": sys.version.split()[0],
+                    "platform": sys.platform,
+                    "results": self.results,
+                }, f, indent=2, ensure_ascii=False)
+
+        if any(r.get("error") for r in self.results):
+            raise RuntimeError("some benchmarks failed")
+
+    def _run_format(self, base: str, fmt: Format, old: dict[tuple[str, str], float]) -> None:
+        src = os.path.join(base, "src")
+        dst = os.path.join(base, f"dst-{fmt.value}")
+        restored = os.path.join(base, f"restored-{fmt.value}")
+
+        best: dict[str, dict] = {}
+        for _ in range(self.runs):
+            for path in (dst, restored):
+                shutil.rmtree(path, ignore_errors=True)
+            tree = SyntheticTree(src, self.seed, self.scale)
+            t = time.perf_counter()
+            tree.generate()
+            ColorPrinter.blue(
+                f"{fmt.value}: generated {tree.files} files ({Humanize.size(tree.bytes)}) "
+                f"in {time.perf_counter() - t:.1f}s")
+
+            results = []
+            backup = functools.partial(Backup, [src], [dst], incremental=True, fmt=fmt)
+            results.append(self._measure(fmt, "full backup", backup))
+            if fmt is not Format.ARCHIVE: # архивы всегда полные
+                results.append(self._measure(fmt, "no changes", backup))
+                tree.churn(0.01)
+                results.append(self._measure(fmt, "1% churn", backup))
+            results.append(self._measure(fmt, "restore", functools.partial(Restore, dst, restored, [], fmt=fmt)))
+
+            for r in results:
+                kept = best.get(r["scenario"])
+                if kept is None or "error" in kept or ("error" not in r and r["seconds"] < kept["seconds"]):
+                    best[r["scenario"]] = r
+
+        for r in best.values():
+            self._show(r, old.get((r["format"], r["scenario"])))
+            self.results.append(r)
+
+    def _measure(self, fmt: Format, scenario: str, make: Callable) -> dict:
+        job = make()
+        result = {"format": fmt.value, "scenario": scenario}
+        t = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()): # у самого бэкапа вывод подробный
+                job.run()
+        except RuntimeError as e:
+            result["error"] = str(e).rstrip()
+        result["seconds"] = round(time.perf_counter() - t, 3)
+
+        if isinstance(job, Backup):
+            report = job.report()
+            w = report["destinations"][0]
+            bottleneck = (report["bottleneck"] or {}).get("what", "")
+            # путь приемника тут временный и ни о чем не говорит
+            result.update(files=w["files"], bytes=w["bytes"], bottleneck=bottleneck.split(" '")[0])
+        else:
+            result.update(files=job.files, bytes=job.bytes)
+        return result
+
+    def _show(self, result: dict, before: float | None) -> None:
+        """Строка результата, с baseline - и насколько стало медленнее или быстрее"""
+
+        line = (f"{result['format']:8} {result['scenario']:12} {result['seconds']:8.2f}s {result['files']:8} files "
+                f"{Humanize.size(result['bytes']):>9} {Humanize.size(result['bytes'] / max(result['seconds'], 1e-9)):>9}/s")
+        if result.get("bottleneck"):
+            line += f"  bottleneck: {result['bottleneck']}"
+        if "error" in result:
+            ColorPrinter.red(f"{line}  error: {result['error']}")
+            return
+        if not before:
+            ColorPrinter.green(line)
+            return
+        ratio = result["seconds"] / before
+        line += f"  {ratio - 1:+.0%} vs baseline"
+        if ratio > self.REGRESSION:
+            ColorPrinter.red(line)
+        else:
+            ColorPrinter.green(line)
+
+    def _load(self, path: str) -> dict[tuple[str, str], float]:
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline.get("seed"), baseline.get("scale")) != (self.seed, self.scale):
+            ColorPrinter.red(
+                f"baseline was measured with --seed {baseline.get('seed')} --scale {baseline.get('scale')}, "
+                f"the numbers are not comparable")
+        return {(r["format"], r["scenario"]): r["seconds"] for r in baseline["results"] if "error" not in r}
 
 # tools
 
+class FileMeta:
+    """Перенос метаданных (права и время) с источника на копию"""
+
+    @classmethod
+    def apply(cls, path: str, st: "os.stat_result | Record") -> None:
+        if stat.S_ISLNK(st.st_mode):
+            # у симлинков права не меняются, а время - только там где это умеет ОС
+            if os.utime in os.supports_follow_symlinks:
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+            return
+
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+class Stamp:
+    """Имена по времени создания: сортировка по имени совпадает с хронологической"""
+
+    FORMAT = "%Y-%m-%dT%H-%M-%S"
+    PATTERN = re.compile(r"\d{4}-\d\d-\d\dT\d\d-\d\d-\d\d(_\d+)?")
+
+    @classmethod
+    def unique(cls, directory: str, suffix: str = "") -> str:
+        """Новое имя, которого еще нет в directory (в том числе с суффиксом временного файла)"""
+
+        base = time.strftime(cls.FORMAT)
+        name, n = base, 1
+        while any(os.path.lexists(os.path.join(directory, name + s))
+                  for s in (suffix, suffix + Constants.TMP_SUFFIX.value)):
+            name, n = f"{base}_{n}", n + 1
+        return name + suffix
+
+class FastCopy:
+    """
+    **Копирование файла целиком самым быстрым доступным способом**
+
+    reflink (FICLONE, на CoW файловых системах - только метаданные) -> os.copy_file_range ->
+    os.sendfile -> обычный цикл read/write. Следующий способ пробуется только если
+    предыдущий не поддерживается, настоящие ошибки (нет места, ошибка чтения) пробрасываются
+
+    У разреженных файлов (см. Sparse) копируются только куски с данными, дыры остаются дырами
+    """
+
+    REFLINK = "reflink"
+    COPY_FILE_RANGE = "copy_file_range"
+    SENDFILE = "sendfile"
+    USERSPACE = "read/write"
+
+    FICLONE = 0x40049409 # _IOW(0x94, 9, int) из linux/fs.h
+    CHUNK = 1024 * 1024 * 1024 # сколько байт просить у ядра за один вызов
+
+    # так ядро говорит "не умею" (а не "сломалось")
+    UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EPERM, errno.EBADF}
+
+    @classmethod
+    def available(cls) -> bool:
+        """Есть ли вообще что-то быстрее обычного цикла"""
+
+        return sys.platform.startswith("linux")
+
+    @classmethod
+    def copy(
+        cls,
+        src_fd: int,
+        dst_fd: int,
+        reflink: bool = True,
+        start: int = 0,
+        progress: Callable[[int], None] | None = None,
+    ) -> tuple[str, int]:
+        """
+        Копирует src_fd в dst_fd, в котором уже есть первые start байт (обычно - пустой).
+        progress(сколько всего скопировано) зовется по ходу и может прервать копирование исключением.
+        Возвращает способ и число скопированных байт
+        """
+
+        if reflink and not start and cls._reflink(src_fd, dst_fd):
+            return cls.REFLINK, os.fstat(dst_fd).st_size
+
+        # (начало, конец) кусков, которые надо скопировать; None - до конца файла
+        ranges: list[tuple[int, int | None]] = [(start, None)]
+        st = os.fstat(src_fd)
+        sparse = Sparse.is_sparse(st)
+        if sparse:
+            ranges = list(Sparse.extents(src_fd, start))
+
+        for method, func in (
+            (cls.COPY_FILE_RANGE, cls._copy_file_range),
+            (cls.SENDFILE, cls._sendfile),
+        ):
+            n = func(src_fd, dst_fd, ranges, progress)
+            if n is not None:
+                break
+        else:
+            method, n = cls.USERSPACE, cls._userspace(src_fd, dst_fd, ranges, progress)
+
+        if sparse:
+            os.ftruncate(dst_fd, st.st_size) # дыра в конце файла
+        return method, n
+
+    @classmethod
+    def clone(cls, src_fd: int, dst_fd: int) -> bool:
+        """Только reflink, без запасных способов: False - не поддерживается (dst_fd не тронут)"""
+
+        return cls._reflink(src_fd, dst_fd)
+
+    @classmethod
+    def _reflink(cls, src_fd: int, dst_fd: int) -> bool:
+        try:
+            import fcntl
+            fcntl.ioctl(dst_fd, cls.FICLONE, src_fd)
+        except ImportError:
+            return False
+        except OSError as e:
+            if e.errno in cls.UNSUPPORTED:
+                return False
+            raise
+        return True
+
+    @classmethod
+    def _copy_file_range(cls, src_fd: int, dst_fd: int, ranges: list, progress: Callable | None) -> int | None:
+        if not hasattr(os, "copy_file_range"):
+            return None
+        return cls._kernel_loop(
+            lambda offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset), ranges, progress)
+
+    @classmethod
+    def _sendfile(cls, src_fd: int, dst_fd: int, ranges: list, progress: Callable | None) -> int | None:
+        if not hasattr(os, "sendfile"):
+            return None
+
+        def call(offset: int, count: int) -> int:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+
+        return cls._kernel_loop(call, ranges, progress)
+
+    @classmethod
+    def _kernel_loop(cls, call: Callable[[int, int], int], ranges: list, progress: Callable | None) -> int | None:
+        """
+        Гоняет call(offset, count) по каждому куску до его конца (или до конца файла - call вернет 0).
+        Возвращает число байт или None, если способ не поддерживается - это выясняется на самом первом вызове
+        """
+
+        copied = 0
+        first = True
+        for offset, end in ranges:
+            while end is None or offset < end:
+                count = cls.CHUNK if end is None else min(cls.CHUNK, end - offset)
+                try:
+                    n = call(offset, count)
+                except OSError as e:
+                    if first and e.errno in cls.UNSUPPORTED:
+                        return None
+                    raise
+                first = False
+                if n == 0:
+                    break
+                offset += n
+                copied += n
+                if progress is not None:
+                    progress(offset)
+        return copied
+
+    @classmethod
+    def _userspace(cls, src_fd: int, dst_fd: int, ranges: list, progress: Callable | None) -> int:
+        copied = 0
+        size = os.fstat(src_fd).st_size
+        for offset, end in ranges:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            if Pipeline.large((size if end is None else end) - offset): # пишем, пока читается следующий блок
+                with open(src_fd, "rb", buffering=0, closefd=False) as src:
+                    for block in Pipeline.views(src, offset, end):
+                        view = block
+                        while view:
+                            view = view[os.write(dst_fd, view):]
+                        offset += len(block)
+                        copied += len(block)
+                        if progress is not None:
+                            progress(offset)
+                continue
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            while end is None or offset < end:
+                count = Constants.BLOCK_SIZE.value if end is None else min(Constants.BLOCK_SIZE.value, end - offset)
+                block = os.read(src_fd, count)
+                if not block:
+                    break
+                view = memoryview(block)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+                offset += len(block)
+                copied += len(block)
+                if progress is not None:
+                    progress(offset)
+        return copied
+
+class Sparse:
+    """
+    **Разреженные файлы (образы виртуалок, базы данных): поиск кусков с данными**
+
+    Куски ищутся через os.lseek SEEK_DATA/SEEK_HOLE. Где этого нет (Windows, старые ФС),
+    файл не считается разреженным и копируется целиком как обычно
+    """
+
+    @classmethod
+    def is_sparse(cls, st: os.stat_result) -> bool:
+        """Места на диске занято меньше, чем размер файла - значит, в нем есть дыры"""
+
+        return hasattr(os, "SEEK_DATA") and hasattr(st, "st_blocks") and st.st_blocks * 512 < st.st_size
+
+    @classmethod
+    def extents(cls, fd: int, start: int = 0) -> Iterator[tuple[int, int]]:
+        """(начало, конец) кусков с данными от start до конца файла"""
+
+        size = os.fstat(fd).st_size
+        offset = start
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    return # дальше только дыра
+                if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                    yield offset, size # ФС не умеет искать дыры
+                    return
+                raise
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+            yield data, hole
+            offset = hole
+
+    @classmethod
+    def write(cls, f: BinaryIO, data: bytes) -> None:
+        """
+        Пишет блок, а блок из одних нулей перепрыгивает - на его месте остается дыра.
+        Если файл может кончаться дырой, в конце его нужно обрезать до размера (truncate)
+        """
+
+        if data.count(0) == len(data):
+            f.seek(len(data), os.SEEK_CUR)
+        else:
+            f.write(data)
+
+class Pipeline:
+    """
+    **Конвейерное чтение больших файлов**
+
+    Отдельный поток читает файл наперед (readinto) в DEPTH заранее выделенных буферов, пока
+    потребитель разбирает уже прочитанное: чтение идет одновременно с записью или хешированием,
+    а новый объект на каждый блок не создается. Поэтому блок (memoryview) действителен только
+    до следующего шага - дальше в его буфер читается следующий
+
+    Прочитанное выбрасывается из кеша страниц (posix_fadvise DONTNEED), чтобы многогигабайтный
+    файл не вытеснял оттуда все остальное. Поток и буферы окупаются только на больших файлах
+    (см. large), остальные читаются как обычно
+    """
+
+    DEPTH = 2 # буферов: в один читается, другой разбирается
+
+    @classmethod
+    def large(cls, size: int) -> bool:
+        return size >= Constants.PIPELINE_MIN.value * 1024 * 1024
+
+    @classmethod
+    def views(
+        cls,
+        f: BinaryIO,
+        start: int = 0,
+        end: int | None = None,
+        size: int = Constants.BLOCK_SIZE.value,
+    ) -> Iterator[memoryview]:
+        """
+        Блоки файла по size байт (кроме последнего) с места start до end (None - до конца).
+        Пока блоки берутся, позицию f трогать нельзя - ее двигает поток чтения
+        """
+
+        fd = f.fileno()
+        cls._advise(fd, start, 0, "POSIX_FADV_SEQUENTIAL")
+        f.seek(start)
+        free: queue.Queue = queue.Queue() # пустые буферы, None - читать больше не нужно
+        for _ in range(cls.DEPTH):
+            free.put(memoryview(bytearray(size)))
+        full: queue.Queue = queue.Queue() # (буфер, сколько в нем прочитано) или (None, исключение)
+
+        def read() -> None:
+            pos = start
+            try:
+                while (view := free.get()) is not None:
+                    n = cls._fill(f, view[:size if end is None else max(0, min(size, end - pos))])
+                    full.put((view, n))
+                    if not n:
+                        return
+                    pos += n
+            except Exception as e:
+                full.put((None, e))
+
+        reader = threading.Thread(target=read, name=f"ark-read:{f.name}", daemon=True)
+        reader.start()
+        pos = start
+        try:
+            while True:
+                view, n = full.get()
+                if view is None:
+                    raise n
+                if not n:
+                    return
+                yield view[:n]
+                free.put(view)
+                cls._advise(fd, pos, n, "POSIX_FADV_DONTNEED")
+                pos += n
+        finally:
+            free.put(None)
+            reader.join()
+
+    @classmethod
+    def blocks(cls, f: BinaryIO, size: int = Constants.BLOCK_SIZE.value) -> Iterator[bytes]:
+        """
+        Блоки файла с текущей позиции, каждый - отдельный bytes (для очередей писателей, где блок
+        живет дольше одного шага). Большой файл все равно читается конвейером, блок из буфера копируется
+        """
+
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or not cls.large(st.st_size):
+            while block := f.read(size):
+                yield block
+            return
+        for view in cls.views(f, f.tell(), size=size):
+            yield bytes(view)
+
+    @classmethod
+    def drop(cls, fd: int, end: int) -> None:
+        """Выбрасывает из кеша страниц первые end байт файла (грязные страницы ядро оставит до записи на диск)"""
+
+        cls._advise(fd, 0, end, "POSIX_FADV_DONTNEED")
+
+    @classmethod
+    def _fill(cls, f: BinaryIO, view: memoryview) -> int:
+        """Читает до заполнения view или конца файла (readinto небуферизованного файла может вернуть меньше)"""
+
+        got = 0
+        while got < len(view):
+            n = f.readinto(view[got:])
+            if not n:
+                break
+            got += n
+        return got
+
+    @classmethod
+    def _advise(cls, fd: int, offset: int, length: int, advice: str) -> None:
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass # это только подсказка ядру
+
+class HashCache:
+    """
+    **Кеш хешей содержимого файлов**
+
+    Ключ - (устройство, inode, размер, mtime_ns): пока они те же, файл не перечитывается.
+    Подмену содержимого без изменения mtime (в том числе порчу диска) кеш поэтому
+    не замечает - на такой случай его можно отключить (path=None).
+    Записи, которые не пригодились EXPIRE_DAYS дней, выбрасываются. Кеш большого дерева
+    уходит во временную базу на диске (см. RecordIndex), как и индекс приемника
+
+    Формат - текст: заголовок, затем строка на файл
+    dev<TAB>ino<TAB>size<TAB>mtime_ns<TAB>день последнего использования<TAB>digest
+    """
+
+    HEADER = "ark-hashes 1"
+    EXPIRE_DAYS = 60
+
+    def __init__(self, path: str | None) -> None:
+        self.path = path
+        self.today = int(time.time() // 86400)
+        # (dev, ino, size, mtime_ns) -> (день последнего использования, хеш)
+        self.hashes = self._load() if path else StatMap()
+        self._dirty = False
+        self._lock = threading.Lock() # хеши считают разные потоки, а StatMap пишет только один
+
+    @classmethod
+    def default_path(cls) -> str:
+        base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") \
+            or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "ark", "hashes")
+
+    def digest(self, path: str) -> str:
+        """Хеш содержимого файла (из кеша, если файл с тех пор не менялся). Вызывается из разных потоков"""
+
+        with open(path, "rb") as f:
+            key = self._key(os.fstat(f.fileno()))
+            cached = self.hashes.get(key)
+            if cached is not None:
+                if cached[0] != self.today:
+                    with self._lock:
+                        self.hashes[key] = (self.today, cached[1])
+                    self._dirty = True
+                return cached[1]
+
+            digest = hashlib.new(Constants.HASH.value)
+            if Pipeline.large(key[2]):
+                for view in Pipeline.views(f):
+                    digest.update(view)
+            else:
+                buf = bytearray(Constants.BLOCK_SIZE.value)
+                view = memoryview(buf)
+                while n := f.readinto(buf):
+                    digest.update(view[:n])
+            changed = self._key(os.fstat(f.fileno())) != key
+
+        if self.path is not None and not changed: # файл меняли прямо во время чтения - такой хеш не запоминаем
+            with self._lock:
+                self.hashes[key] = (self.today, digest.hexdigest())
+            self._dirty = True
+        return digest.hexdigest()
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + Constants.TMP_SUFFIX.value
+        with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+            f.write(self.HEADER + "\n")
+            for (dev, ino, size, mtime_ns), (day, digest) in self.hashes.items():
+                if self.today - day <= self.EXPIRE_DAYS:
+                    f.write(f"{dev}\t{ino}\t{size}\t{mtime_ns}\t{day}\t{digest}\n")
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def _load(self) -> StatMap:
+        """Битый кеш не страшен - файлы просто будут прочитаны заново"""
+
+        hashes = StatMap()
+        try:
+            with open(self.path, encoding="utf-8", newline="\n") as f:
+                if f.readline().rstrip("\n") != self.HEADER:
+                    raise ValueError("unknown format")
+                for line in f:
+                    dev, ino, size, mtime_ns, day, digest = line.rstrip("\n").split("\t")
+                    hashes[(int(dev), int(ino), int(size), int(mtime_ns))] = (int(day), digest)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            ColorPrinter.red(f"ignoring broken hash cache '{self.path}': {e}")
+            hashes.clear()
+        return hashes
+
+    @classmethod
+    def _key(cls, st: os.stat_result) -> tuple[int, int, int, int]:
+        if not stat.S_ISREG(st.st_mode):
+            raise OSError(errno.EINVAL, "not a regular file")
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+class Inotify:
+    """
+    **События изменения файлов от ядра Linux**
+
+    inotify вызывается прямо из libc через ctypes. Слежение ставится на каждую папку
+    отдельно, события приходят про элементы внутри нее (с именем) или про нее саму (без имени)
+    """
+
+    MODIFY = 0x2
+    ATTRIB = 0x4
+    CLOSE_WRITE = 0x8
+    MOVED_FROM = 0x40
+    MOVED_TO = 0x80
+    CREATE = 0x100
+    DELETE = 0x200
+    DELETE_SELF = 0x400
+    Q_OVERFLOW = 0x4000
+    IGNORED = 0x8000
+    DONT_FOLLOW = 0x2000000
+    EXCL_UNLINK = 0x4000000
+    ISDIR = 0x40000000
+    # всё, что меняет дерево (симлинки не разыменовываются, удаленные файлы событий больше не шлют)
+    CHANGES = (MODIFY | ATTRIB | CLOSE_WRITE | MOVED_FROM | MOVED_TO | CREATE | DELETE | DELETE_SELF
+               | DONT_FOLLOW | EXCL_UNLINK)
+
+    EVENT = struct.Struct("iIII") # wd, mask, cookie, длина имени (имя идет следом)
+
+    def __init__(self) -> None:
+        libc = None
+        if sys.platform.startswith("linux"):
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            raise RuntimeError("--watch needs inotify (Linux)")
+
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify: {os.strerror(e)}")
+
+    def add(self, path: str, mask: int) -> int:
+        """Ставит слежение, возвращает его номер (у уже отслеживаемого пути - прежний)"""
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self, timeout: float) -> list[tuple[int, int, str]]:
+        """События (wd, mask, имя), которые пришли за timeout секунд"""
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class Humanize:
+    """Человекочитаемые величины для вывода"""
+
+    @classmethod
+    def size(cls, n: float) -> str:
+        if abs(n) < 1024:
+            return f"{int(n)} B"
+        for unit in ("KB", "MB", "GB"):
+            n /= 1024
+            if abs(n) < 1024:
+                return f"{n:.1f} {unit}"
+        return f"{n / 1024:.1f} TB"
+
+class Progress:
+    """
+    **Строка прогресса, пока идет долгая работа**
+
+    В терминале строка перерисовывается на месте раз в TTY_INTERVAL секунд, в лог
+    (вывод не в терминал) пишется отдельной строкой раз в LOG_INTERVAL секунд.
+    tick() зовется чаще, раз в SAMPLE секунд (например, чтобы снимать глубину очередей),
+    и возвращает текущую строку
+    """
+
+    SAMPLE = 0.5
+    TTY_INTERVAL = 1
+    LOG_INTERVAL = 60
+
+    def __init__(self, tick: Callable[[], str]) -> None:
+        self._tick = tick
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ark-progress", daemon=True)
+        self._tty = sys.stdout.isatty()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        del exc_type, exc_val, exc_tb
+        self._stop.set()
+        self._thread.join()
+        if self._tty:
+            ColorPrinter.status()
+
+    def _run(self) -> None:
+        interval = self.TTY_INTERVAL if self._tty else self.LOG_INTERVAL
+        shown = time.monotonic()
+        while not self._stop.wait(self.SAMPLE):
+            line = self._tick()
+            if time.monotonic() - shown < interval:
+                continue
+            shown = time.monotonic()
+            if self._tty:
+                ColorPrinter.status(line)
+            else:
+                ColorPrinter.blue(line)
+
 class SignalHandler:
 
     def __init__(self, on_exit: Callable) -> None:
@@ -117,6 +5307,9 @@ class ConsoleColors(Enum):
 class ColorPrinter:
     """Цветной вывод в консоль"""
 
+    _lock = threading.RLock() # печатают и из потоков (строка прогресса), и из обработчика сигнала
+    _status = False # внизу терминала сейчас строка прогресса
+
     @classmethod
     def red(cls, message: str = "") -> None:
         cls._color_print(message, ConsoleColors.RED.value)
@@ -129,15 +5322,33 @@ class ColorPrinter:
     def blue(cls, message: str = "") -> None:
         cls._color_print(message, ConsoleColors.BLUE.value)
 
+    @classmethod
+    def status(cls, message: str = "") -> None:
+        """Строка прогресса: перерисовывается на месте, следующий вывод ее стирает (пустая - просто стирает)"""
+
+        with cls._lock:
+            message = message[:shutil.get_terminal_size().columns - 1] # перенос строки не стереть
+            try:
+                cls._enable_windows_ansi()
+                sys.stdout.write(f"\r\033[K{ConsoleColors.BLUE.value}{message}{ConsoleColors.RESET.value}" if message else "\r\033[K")
+                sys.stdout.flush()
+            except Exception:
+                return
+            cls._status = bool(message)
+
     @classmethod
     def _color_print(cls, message: str, color_code: str) -> None:
         """Вывод сообщения _message_ в цвете _color_code_"""
 
-        try:
-            cls._enable_windows_ansi()
-            print(f"{color_code}{message}{ConsoleColors.RESET.value}")
-        except Exception:
-            print(message)
+        with cls._lock:
+            if cls._status:
+                sys.stdout.write("\r\033[K")
+                cls._status = False
+            try:
+                cls._enable_windows_ansi()
+                print(f"{color_code}{message}{ConsoleColors.RESET.value}")
+            except Exception:
+                print(message)
 
     @classmethod
     def _enable_windows_ansi(cls) -> None:
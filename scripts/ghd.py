@@ -3,9 +3,15 @@
 from types import FrameType
 from typing import Callable
 from enum import Enum
+import concurrent.futures
+import urllib.parse
 import subprocess
+import threading
 import argparse
 import requests
+import hashlib
+import json
+import time
 import signal
 import sys
 import os
@@ -16,6 +22,13 @@ class Constants(Enum):
     """
 
     REPOS_DIR = "./repos" # Папка куда будут скачиваться репозитории (создастся сама если ее нет)
+    MIRRORS_DIR = "./mirrors" # Папка для голых зеркал репозиториев в режиме --mirror (создастся сама если ее нет)
+    JOBS = 1 # Сколько репозиториев скачивается одновременно (если не указан --jobs)
+    DIRECT_REPOS = 10 # До скольких --repos запрашиваются у API по одному, а не всем списком репозиториев
+    API_THREADS = 8 # Сколько страниц списка репозиториев запрашивается одновременно (и соединений с API держится открытыми)
+    API_RETRIES = 5 # Сколько раз запрос к API повторяется после лимита запросов, ошибки сервера или сети
+    API_TIMEOUT = 30 # Сколько секунд ждать ответа API
+    RATE_RESERVE = 100 # Когда до сброса лимита остается меньше запросов, они растягиваются до сброса
 
 class App:
     """Основной класс приложения"""
@@ -36,6 +49,15 @@ Usage examples:
 
     Download all repositories:
         {script_name} --token YOUR_TOKEN --all
+
+    Download several repositories at once (a failed one does not stop the rest, summary at the end):
+        {script_name} --token YOUR_TOKEN --all --jobs 8
+
+    Repositories nobody pushed to since the last download are skipped, download them anyway:
+        {script_name} --token YOUR_TOKEN --all --force
+
+    Keep bare mirrors (all refs, no working trees) instead, forks of one repository share objects:
+        {script_name} --token YOUR_TOKEN --all --mirror
 """
 
         def custom_print_help():
@@ -52,13 +74,22 @@ Usage examples:
         group = parser.add_mutually_exclusive_group(required=True) # либо --all, либо --repos
         group.add_argument('--repos', nargs='+')
         group.add_argument('--all', action="store_true")
-        return parser.parse_args()
+        parser.add_argument('--jobs', type=int, default=Constants.JOBS.value)
+        parser.add_argument('--force', action="store_true")
+        parser.add_argument('--mirror', action="store_true")
+        args = parser.parse_args()
+        if args.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        return args
 
     @classmethod
     def main(cls) -> None:
-        
+        loader = None
+
         def on_exit():
             ColorPrinter.red("\nhandle exit signal")
+            if loader is not None:
+                loader.stop() # будит потоки, которые ждут сброса лимита запросов
             sys.exit(1)
 
         SignalHandler(on_exit)
@@ -67,33 +98,73 @@ Usage examples:
         try:
             loader = Downloader(
                 args.token, 
-                Constants.REPOS_DIR.value,)
+                Constants.MIRRORS_DIR.value if args.mirror else Constants.REPOS_DIR.value,
+                force=args.force,
+                mirror=args.mirror,)
             if args.all:
-                loader.download_all_repos()
-            elif args.repos:
-                for repo in args.repos:
-                    loader.download_repo_by_name(repo)
+                results = loader.download_all_repos(args.jobs)
+            else:
+                results = loader.download_repos_by_name(args.repos, args.jobs)
+            cls._print_summary(results)
         except Exception as e:
             ColorPrinter.red(f"downloading error: {str(e).rstrip()}")
         finally:
             ColorPrinter.blue("\nsee you later!")
 
+    @classmethod
+    def _print_summary(cls, results: list["RepoResult"]) -> None:
+        """Общие числа, затем каждый репозиторий, который не скачался, и почему"""
+
+        failed = [r for r in results if r.error]
+        cloned = sum(r.action == RepoResult.CLONED for r in results)
+        updated = sum(r.action == RepoResult.UPDATED for r in results)
+        unchanged = sum(r.action == RepoResult.UNCHANGED for r in results)
+        print_summary = ColorPrinter.red if failed else ColorPrinter.green
+        print_summary(
+            f"\n{len(results)} repositories: {cloned} cloned, {updated} updated, "
+            f"{unchanged} unchanged, {len(failed)} failed")
+        for r in failed:
+            ColorPrinter.red(f"'{r.name}': {r.error}")
+
 # downloader
 
 class Downloader:
     """
     Управляет загрузкой репозиториев с GitHub
+
+    После каждой загрузки в .git репозитория запоминается его pushed_at из GitHub API.
+    Пока он тот же, в репозиторий никто не пушил - он пропускается, даже не запуская git
+
+    Список репозиториев запрашивается только когда он нужен, а ответы API кешируются на диске
+    (см. ApiCache). Несколько --repos запрашиваются у API прямо по имени
+
+    Запросы к API идут через одну сессию с пулом соединений. Лимит запросов читается из ответов:
+    когда он почти кончился, запросы растягиваются до его сброса, а отказ по лимиту (403/429)
+    пережидается и запрос повторяется (см. _request)
+
+    С mirror вместо рабочих копий хранятся голые зеркала (<имя>.git, git clone --mirror,
+    обновляются git fetch --prune). Форки одного репозитория (и он сам) - одна сеть: объекты
+    всей сети лежат в общем хранилище NETWORKS_DIR/<владелец>/<репо>.git, а зеркала берут их
+    оттуда через objects/info/alternates. Общая история поэтому скачивается и хранится один раз
     """
 
-    def __init__(self, token: str, target_dir: str) -> None:
+    SYNCED_FILE = "ghd-pushed-at" # в .git репозитория: pushed_at на момент последней загрузки
+    NETWORKS_DIR = ".networks" # в папке зеркал: общие хранилища объектов сетей форков
+
+    def __init__(self, token: str, target_dir: str, force: bool = False, mirror: bool = False) -> None:
         """
         Принимает токен GitHub
         
         Для корректной работы необходимо чтобы токен имел доступ ко всем репозиториям
+
+        force - скачивать и те репозитории, которые не менялись с прошлой загрузки,
+        mirror - хранить голые зеркала вместо рабочих копий
         """
 
         self.token = token
         self.target_dir = target_dir
+        self.force = force
+        self.mirror = mirror
 
         self.base_url = "https://github.com"
         self.api_url = "https://api.github.com"
@@ -101,97 +172,483 @@ class Downloader:
             "Authorization": f"token {self.token}",
             "Accept": "application/vnd.github.v3+json"
         }
+        self.cache = ApiCache(ApiCache.default_path(token))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=Constants.API_THREADS.value)
+        self.session.mount("https://", adapter)
+        self._rate_lock = threading.Lock()
+        self._remaining: int | None = None # запросов до сброса лимита (из последнего ответа)
+        self._reset = 0.0 # когда лимит сбросится (time.time)
+        self._stopping = threading.Event()
+
+        self._networks: dict[str, str] = {} # full_name репо -> full_name корня его сети (только у сетей из 2+ репо)
+        self._network_locks: dict[str, threading.Lock] = {} # хранилище сети обновляет один поток за раз
+
+        self._repos: list[dict] | None = None
+        self._by_name: dict[str, dict] | None = None
+        self._login: str | None = None # владелец токена
+
+    @property
+    def repos(self) -> list[dict]:
+        """Все репозитории, к которым есть доступ у токена (запрашиваются при первом обращении)"""
+
+        if self._repos is None:
+            self._repos = self._get_repos_info()
+        return self._repos
 
-        self.repos = self._get_repos_info()
+    def stop(self) -> None:
+        """Прерывает ожидание сброса лимита запросов (выход по сигналу)"""
 
-    def download_all_repos(self) -> None:
+        self._stopping.set()
+
+    def download_all_repos(self, jobs: int = 1) -> list["RepoResult"]:
         """
         **Скачивает все репозитории**
 
-        Если уже есть репо, то обновляет его
+        Если уже есть репо, то обновляет его. Одновременно скачивается до jobs репозиториев,
+        ошибка одного не останавливает остальные - она остается в его результате
         """
 
-        for repo in self.repos:
-            self._download_repo(repo)
+        return self._download_many(self.repos, jobs)
+
+    def download_repos_by_name(self, repo_names: list[str], jobs: int = 1) -> list["RepoResult"]:
+        """
+        **Скачивает репозитории по их именам**
 
-    def download_repo_by_name(self, repo_name: str) -> None:
+        Как download_all_repos, а имя, которого нет на GitHub или которое не удалось у него
+        запросить, тоже становится ошибкой в результате
+        """
+
+        direct = len(repo_names) <= Constants.DIRECT_REPOS.value
+        repos = [self._resolve(name, direct) for name in repo_names]
+        self.cache.save()
+        return self._download_many(repos, jobs)
+
+    def _resolve(self, repo_name: str, direct: bool) -> "dict | RepoResult":
+        """Информация о репо по имени или сразу его результат с ошибкой"""
+
+        try:
+            repo = self._find_repo(repo_name, direct)
+        except RuntimeError as e:
+            return RepoResult(repo_name, error=str(e).rstrip())
+        return repo if repo is not None else RepoResult(repo_name, error="not found")
+
+    def download_repo_by_name(self, repo_name: str) -> "RepoResult":
         """
         **Скачивает репозиторий по его имени**
 
-        Если уже есть репо, то обновляет его
+        Если уже есть репо, то обновляет его. То же, что download_repos_by_name с одним именем
+        """
+
+        return self.download_repos_by_name([repo_name])[0]
+
+    def _find_repo(self, repo_name: str, direct: bool = True) -> dict | None:
         """
+        Информация о репо по имени. Пока список репозиториев не запрашивался, а direct,
+        репо запрашивается у API прямо по имени владельца токена. Не нашлось (например,
+        репо организации) - ищется во всем списке
+        """
+
+        if self._repos is None and direct:
+            if self._login is None:
+                self._login = self._get_json(f"{self.api_url}/user", "user")["login"]
+            repo = self._get_json(f"{self.api_url}/repos/{self._login}/{repo_name}", f"repo '{repo_name}'")
+            if repo is not None:
+                return repo
+        if self._by_name is None:
+            self._by_name = {r["name"]: r for r in self.repos}
+        return self._by_name.get(repo_name)
+
+    def _download_many(self, repos: list["dict | RepoResult"], jobs: int) -> list["RepoResult"]:
+        """
+        Скачивает репозитории пулом из jobs потоков: git почти все время ждет сеть.
+        Вместо словаря может быть уже готовый результат - репо не нашлось.
+        Результаты - в том же порядке. При выходе по сигналу еще не начатые отменяются
+        """
+
+        if self.mirror:
+            self._plan_networks([r for r in repos if isinstance(r, dict)])
 
-        for r in self.repos:
-            if r["name"] == repo_name:
-                self._download_repo(r)
-                return
+        pool = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix="ghd")
+        try:
+            futures = [pool.submit(self._try_download, repo) for repo in repos]
+            return [f.result() for f in futures]
+        finally:
+            pool.shutdown(cancel_futures=True)
 
-        raise RuntimeError(f"repo '{repo_name}' not found")
+    def _try_download(self, repo: "dict | RepoResult") -> "RepoResult":
+        if isinstance(repo, RepoResult):
+            return repo
+        try:
+            return RepoResult(repo["name"], action=self._download_repo(repo))
+        except (RuntimeError, OSError) as e:
+            return RepoResult(repo["name"], error=str(e).rstrip())
 
-    def _download_repo(self, repo: dict) -> None:
+    def _download_repo(self, repo: dict) -> str:
         """
         **Скачивание репозитория**
 
-        Принимает словарь с информацией о репо, который возвращает GitHub API
+        Принимает словарь с информацией о репо, который возвращает GitHub API.
+        Возвращает, что сделано (RepoResult.CLONED, UPDATED или UNCHANGED)
         """
 
-        if not os.path.exists(self.target_dir):
-            os.makedirs(self.target_dir, exist_ok=True)
+        os.makedirs(self.target_dir, exist_ok=True)
 
         repo_name = repo["name"]
         clone_url = repo["clone_url"].replace(
             "https://",
             f"https://{self.token}@"
         )
-        repo_path = os.path.join(self.target_dir, repo_name)
-        
+        repo_path = self._repo_path(repo)
+        pushed_at = repo.get("pushed_at") or ""
+
+        if self._unchanged(repo):
+            return RepoResult.UNCHANGED
+
+        ColorPrinter.blue(f"downloading '{repo_name}' from github...")
+        if self.mirror:
+            action = self._download_mirror(repo, clone_url, repo_path)
+        elif os.path.exists(repo_path):
+            self._git("-C", repo_path, "reset", "--hard")
+            self._git("-C", repo_path, "pull")
+            action = RepoResult.UPDATED
+        else:
+            self._git("clone", clone_url, repo_path)
+            action = RepoResult.CLONED
+        if pushed_at:
+            with open(self._synced_path(repo), "w", encoding="utf-8") as f:
+                f.write(pushed_at)
+        ColorPrinter.blue(f"downloaded '{repo_name}' from github")
+        return action
+
+    def _repo_path(self, repo: dict) -> str:
+        return os.path.join(self.target_dir, repo["name"] + (".git" if self.mirror else ""))
+
+    def _synced_path(self, repo: dict) -> str:
+        gitdir = self._repo_path(repo) if self.mirror else os.path.join(self._repo_path(repo), ".git")
+        return os.path.join(gitdir, self.SYNCED_FILE)
+
+    def _unchanged(self, repo: dict) -> bool:
+        """Не пушили ли в репо с прошлой загрузки (с force - считается, что пушили)"""
+
+        pushed_at = repo.get("pushed_at") or ""
+        return not self.force and bool(pushed_at) and self._read_synced(self._synced_path(repo)) == pushed_at
+
+    def _plan_networks(self, repos: list[dict]) -> None:
+        """
+        Раскладывает репо по сетям форков. Корень сети форка (source) есть только в полной
+        информации о нем, поэтому она запрашивается (из кеша API, если не менялась) - одновременно
+        и только у форков, которые будут скачиваться. Форк, о котором не удалось узнать, считается
+        корнем своей сети: скачается сам по себе, без общего хранилища.
+        Общее хранилище нужно сетям хотя бы из двух репо
+        """
+
+        forks = [r for r in repos if r.get("fork") and not self._unchanged(r)]
+
+        def source(repo: dict) -> str:
+            if repo.get("source"): # запрошенный по имени (--repos) уже полный
+                return repo["source"]["full_name"]
+            try:
+                info = self._get_json(f"{self.api_url}/repos/{repo['full_name']}", f"repo '{repo['name']}'")
+            except RuntimeError:
+                return repo["full_name"]
+            return info["source"]["full_name"] if info and info.get("source") else repo["full_name"]
+
+        with concurrent.futures.ThreadPoolExecutor(Constants.API_THREADS.value, thread_name_prefix="ghd-api") as pool:
+            roots = dict(zip((r["full_name"] for r in forks), pool.map(source, forks)))
+        self.cache.save()
+
+        members: dict[str, list[str]] = {}
+        for r in repos:
+            root = roots.get(r["full_name"], r["full_name"])
+            members.setdefault(root, []).append(r["full_name"])
+        self._networks = {name: root for root, names in members.items() if len(names) > 1 for name in names}
+        self._network_locks = {root: threading.Lock() for root in set(self._networks.values())}
+
+    def _download_mirror(self, repo: dict, clone_url: str, repo_path: str) -> str:
+        """
+        Голое зеркало: git clone --mirror, потом git fetch --prune. Зеркало из сети форков
+        сначала берет уже известные объекты из хранилища сети, а свои новые затем отдает туда
+        (refs/networks/<full_name>/*) и удаляет у себя - после этого они хранятся только в сети
+        """
+
+        network = self._networks.get(repo["full_name"])
+        if network is None:
+            return self._update_mirror(clone_url, repo_path, None)
+
+        with self._network_locks[network]:
+            shared = os.path.join(self.target_dir, self.NETWORKS_DIR, *network.split("/")) + ".git"
+            if not os.path.exists(shared):
+                self._git("init", "-q", "--bare", shared)
+            action = self._update_mirror(clone_url, repo_path, shared)
+            self._git(
+                "-C", shared, "fetch", "-q", "--prune", os.path.abspath(repo_path),
+                f"+refs/*:refs/networks/{repo['full_name']}/*")
+            # мелкий fetch распаковывает объекты по одному: в сети они пакуются, а у зеркала -
+            # переупаковываются без того, что есть в сети (-l), и выбрасываются уже упакованные там
+            self._git("-C", shared, "repack", "-q", "-d")
+            self._git("-C", repo_path, "repack", "-q", "-a", "-d", "-l")
+            self._git("-C", repo_path, "prune-packed", "-q")
+        return action
+
+    def _update_mirror(self, clone_url: str, repo_path: str, shared: str | None) -> str:
+        if os.path.exists(repo_path):
+            if shared is not None:
+                self._link_objects(repo_path, shared) # зеркало могло появиться раньше своей сети
+            self._git("-C", repo_path, "fetch", "-q", "--prune")
+            return RepoResult.UPDATED
+
+        reference = ["--reference", shared] if shared is not None else []
+        self._git("clone", "-q", "--mirror", *reference, clone_url, repo_path)
+        if shared is not None:
+            self._link_objects(repo_path, shared)
+        return RepoResult.CLONED
+
+    @classmethod
+    def _link_objects(cls, repo_path: str, shared: str) -> None:
+        """Берет объекты из хранилища сети: alternates с путем относительно objects, чтобы папку зеркал можно было переносить"""
+
+        objects = os.path.join(repo_path, "objects")
+        with open(os.path.join(objects, "info", "alternates"), "w", encoding="utf-8") as f:
+            f.write(os.path.relpath(os.path.join(shared, "objects"), objects) + "\n")
+
+    @classmethod
+    def _read_synced(cls, path: str) -> str:
+        """pushed_at репозитория на момент его последней загрузки (пусто - не загружался или запись пропала)"""
+
         try:
-            ColorPrinter.blue(f"downloading '{repo_name}' from github...")
-            if os.path.exists(repo_path):
-                subprocess.run(
-                    ["git", "-C", repo_path, "reset", "--hard"],
-                    check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                )
-                subprocess.run(
-                    ["git", "-C", repo_path, "pull"],
-                    check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                )
-            else:
-                subprocess.run(
-                    ["git", "clone", clone_url, repo_path],
-                    check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                )
-            ColorPrinter.blue(f"downloaded '{repo_name}' from github")
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"git command failed: {e}") from e
+            with open(path, encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return ""
+
+    def _git(self, *args: str) -> None:
+        """
+        Запускает git и ждет его. Если он упал - RuntimeError с последней строкой его ошибки (токен вырезается).
+        Спросить пароль в терминале ему не дают: при параллельной загрузке этот вопрос некому увидеть
+        """
+
+        result = subprocess.run(
+            ["git", *args],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+        )
+        if result.returncode != 0:
+            command = args[2] if args[0] == "-C" else args[0]
+            lines = result.stderr.strip().splitlines()
+            message = lines[-1] if lines else f"exit code {result.returncode}"
+            raise RuntimeError(f"git {command} failed: {message.replace(self.token, '***')}")
 
     def _get_repos_info(self) -> list[dict]:
         """
         **Получает информацию обо всех репозиториях**
 
-        В случае если статус-код ответа не 200 инициирует RuntimeError
+        Первая страница говорит (заголовок Link), сколько их всего, остальные запрашиваются
+        одновременно. Если последняя оказалась полной (репозитории добавились), дальше - по одной.
+        В случае если статус-код ответа не 200 (или 304) инициирует RuntimeError
         """
 
-        page, repos = 1, []
-        
+        url, per_page = f"{self.api_url}/user/repos", 100
+
+        def get_page(page: int) -> tuple[list[dict] | None, int | None]:
+            return self._fetch(url, "repos", {"page": page, "per_page": per_page})
+
+        items, last = get_page(1)
+        pages = [items]
+        if last is not None and last > 1:
+            with concurrent.futures.ThreadPoolExecutor(Constants.API_THREADS.value, thread_name_prefix="ghd-api") as pool:
+                pages.extend(items for items, _ in pool.map(get_page, range(2, last + 1)))
+
+        while pages[-1] is not None and len(pages[-1]) == per_page: # неполная страница - последняя
+            pages.append(get_page(len(pages) + 1)[0])
+
+        self.cache.save()
+        return [r for items in pages for r in items or []]
+
+    def _get_json(self, url: str, what: str, params: dict | None = None) -> dict | list | None:
+        return self._fetch(url, what, params)[0]
+
+    def _fetch(self, url: str, what: str, params: dict | None = None) -> tuple[dict | list | None, int | None]:
+        """
+        GET к API с ответом из кеша, если GitHub подтвердил, что он не изменился (304).
+        Возвращает ответ и номер последней страницы из заголовка Link (None - ссылки нет).
+        Ответ None - если такого нет (404), при остальных ошибках инициирует RuntimeError
+        """
+
+        key = url + ("?" + urllib.parse.urlencode(params) if params else "")
+        cached = self.cache.get(key)
+        headers = self.api_headers
+        if cached is not None:
+            headers = {**headers, "If-None-Match": cached[0]}
+
+        response = self._request(url, headers, params)
+        if response.status_code == 304 and cached is not None:
+            return cached[1], self._last_page(response) or cached[2]
+        if response.status_code == 404:
+            return None, None
+        if response.status_code != 200:
+            raise RuntimeError(f"failed to get {what}: {response.text}")
+
+        data = response.json()
+        last = self._last_page(response)
+        etag = response.headers.get("ETag")
+        if etag:
+            self.cache.put(key, etag, data, last)
+        return data, last
+
+    def _request(self, url: str, headers: dict, params: dict | None) -> requests.Response:
+        """
+        **GET с учетом лимита запросов GitHub**
+
+        Когда до сброса лимита остается меньше RATE_RESERVE запросов, каждый следующий ждет
+        свою долю времени до сброса. Отказ по лимиту (429, 403 с Retry-After или с исчерпанным
+        лимитом) пережидается: Retry-After, иначе до сброса. Ошибки сервера и сети повторяются
+        с растущей паузой. Всего до API_RETRIES повторов, дальше - последний ответ или ошибка
+        """
+
+        attempt = 0
         while True:
-            response = requests.get(
-                f"{self.api_url}/user/repos",
-                headers=self.api_headers,
-                params={"page": page, "per_page": 100}
-            )
-            
-            if response.status_code != 200:
-                raise RuntimeError(f"failed to get repos: {response.text}")
-            
-            items = response.json()
-            if not items:
-                break
-                
-            repos.extend(items)
-            page += 1
-        
-        return repos
+            self._wait(self._pace())
+            try:
+                response = self.session.get(
+                    url, headers=headers, params=params, timeout=Constants.API_TIMEOUT.value)
+            except requests.RequestException as e:
+                if attempt == Constants.API_RETRIES.value:
+                    raise RuntimeError(f"GitHub API is unreachable: {e}") from e
+                self._wait(2 ** attempt)
+                attempt += 1
+                continue
+
+            self._note_rate(response)
+            delay = self._retry_delay(response, attempt)
+            if delay is None or attempt == Constants.API_RETRIES.value:
+                return response
+            ColorPrinter.blue(f"GitHub API answered {response.status_code}, retrying in {delay:.0f}s...")
+            self._wait(delay)
+            attempt += 1
+
+    def _note_rate(self, response: requests.Response) -> None:
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self._rate_lock:
+            self._remaining = int(remaining)
+            self._reset = float(reset)
+
+    def _pace(self) -> float:
+        """Сколько подождать перед запросом, чтобы оставшихся запросов хватило до сброса лимита"""
+
+        with self._rate_lock:
+            if self._remaining is None or self._remaining >= Constants.RATE_RESERVE.value:
+                return 0.0
+            left = max(0.0, self._reset - time.time())
+            if not left:
+                return 0.0
+            delay = left / max(1, self._remaining)
+            self._remaining -= 1 # следующий поток подождет уже свою долю
+            return delay
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float | None:
+        """Через сколько секунд повторить запрос, None - не повторять (ответ окончательный)"""
+
+        status = response.status_code
+        retry_after = response.headers.get("Retry-After")
+        if status in (403, 429):
+            if retry_after is not None:
+                return float(retry_after)
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                return max(1.0, float(response.headers.get("X-RateLimit-Reset", 0)) - time.time() + 1)
+            if status == 429 or "rate limit" in response.text.lower(): # вторичный лимит без подсказки
+                return 60.0 * 2 ** attempt
+            return None # 403 - просто нет доступа
+        if status >= 500:
+            return float(2 ** attempt)
+        return None
+
+    def _wait(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        if self._stopping.wait(seconds):
+            raise RuntimeError("interrupted")
+
+    @classmethod
+    def _last_page(cls, response: requests.Response) -> int | None:
+        """Номер последней страницы из заголовка Link (requests разбирает его в response.links)"""
+
+        last = response.links.get("last")
+        if last is None:
+            return None
+        page = urllib.parse.parse_qs(urllib.parse.urlparse(last["url"]).query).get("page")
+        return int(page[0]) if page else None
+
+class ApiCache:
+    """
+    **Кеш ответов GitHub API на диске**
+
+    Ответ хранится вместе с его ETag, и в следующий раз тот же запрос уходит с If-None-Match:
+    если ничего не поменялось, GitHub отвечает 304 без тела, а такие ответы не тратят лимит запросов.
+    Ответы для разных токенов видны разным, поэтому у каждого токена свой файл (по хешу, сам токен не хранится)
+    """
+
+    HEADER = "ghd-api-cache 2"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # запрос -> (ETag, ответ, последняя страница из Link - 304 может прийти без него)
+        self.entries: dict[str, tuple[str, dict | list, int | None]] = self._load()
+        self._dirty = False
+
+    @classmethod
+    def default_path(cls, token: str) -> str:
+        base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") \
+            or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "ghd", hashlib.sha256(token.encode()).hexdigest()[:16] + ".json")
+
+    def get(self, key: str) -> tuple[str, dict | list, int | None] | None:
+        return self.entries.get(key)
+
+    def put(self, key: str, etag: str, data: dict | list, last: int | None = None) -> None:
+        """Вызывается из разных потоков (страницы списка запрашиваются одновременно)"""
+
+        self.entries[key] = (etag, data, last)
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"header": self.HEADER, "entries": self.entries}, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def _load(self) -> dict[str, tuple[str, dict | list, int | None]]:
+        """Нет файла, он битый или от другой версии - кеш просто пустой"""
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(content, dict) or content.get("header") != self.HEADER:
+            return {}
+        return {key: (etag, data, last) for key, (etag, data, last) in content["entries"].items()}
+
+class RepoResult:
+    """Чем кончилась загрузка одного репозитория"""
+
+    CLONED = "cloned"
+    UPDATED = "updated"
+    UNCHANGED = "unchanged" # с прошлой загрузки в него не пушили
+
+    def __init__(self, name: str, action: str = "", error: str = "") -> None:
+        self.name = name
+        self.action = action # CLONED, UPDATED или UNCHANGED, пусто - не получилось
+        self.error = error
 
 # recipes
 